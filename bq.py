@@ -1,12 +1,27 @@
 import os
+import asyncio
+import functools
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import pyarrow as pa
 from google.cloud import bigquery
 from google.oauth2 import service_account
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 import logging
 import json
 from google.api_core.exceptions import Forbidden, NotFound, BadRequest
 
+try:
+    # google-cloud-bigquery-storage – אופציונלי (Storage Read API לתוצאות גדולות)
+    from google.cloud import bigquery_storage
+except ImportError:
+    bigquery_storage = None
+
 # טען את קובץ .env מהספרייה הנוכחית של הקובץ הזה
 dotenv_path = Path(__file__).parent / '.env'
 load_dotenv(dotenv_path)
@@ -15,51 +30,498 @@ PROJECT_ID = "practicode-2025"
 BQ_LOCATION = "EU"
 BQ_DATA_FILE_PATH = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
 
+# גודל ה-connection pool של ה-HTTP session המשותף (keep-alive)
+BQ_HTTP_POOL_SIZE = int(os.getenv("BQ_HTTP_POOL_SIZE", "32"))
+
+# executor חסום לקריאות חוסמות (BigQuery / to_arrow / to_dataframe) מתוך asyncio
+BQ_MAX_WORKERS = int(os.getenv("BQ_MAX_WORKERS", "16"))
+BQ_QUERY_TIMEOUT_SECONDS = float(os.getenv("BQ_QUERY_TIMEOUT_SECONDS", "120"))
+
+# מעל כמות שורות זו to_arrow קורא דרך ה-Storage Read API (אם מותקן)
+BQ_STORAGE_MIN_ROWS = int(os.getenv("BQ_STORAGE_MIN_ROWS", "5000"))
+
+# תקרת bytes לשאילתה אחת ולכל ה-session (0 = בלי תקרה);
+# נבדק ב-dry run לפני ההרצה, ונאכף גם ע"י maximum_bytes_billed של BigQuery
+BQ_MAX_BYTES_PER_QUERY = int(os.getenv("BQ_MAX_BYTES_PER_QUERY", str(10 * 1024 ** 3)))
+BQ_MAX_BYTES_PER_SESSION = int(os.getenv("BQ_MAX_BYTES_PER_SESSION", str(50 * 1024 ** 3)))
+
+# retrieval preview דרך tabledata.list (בלי job, בלי bytes): כמה זמן לזכור את
+# ה-partitions / schema של טבלה, ועל כמה partitions אחרונים לעבור לכל היותר
+PREVIEW_METADATA_TTL_SECONDS = float(os.getenv("PREVIEW_METADATA_TTL_SECONDS", "300"))
+PREVIEW_MAX_PARTITIONS = int(os.getenv("PREVIEW_MAX_PARTITIONS", "3"))
+# preview עם order_by קורא partitions שלמים כדי למיין; partition גדול מזה → SQL
+PREVIEW_MAX_SORT_ROWS = int(os.getenv("PREVIEW_MAX_SORT_ROWS", "200000"))
+
+_bq_executor = ThreadPoolExecutor(max_workers=BQ_MAX_WORKERS, thread_name_prefix="bq")
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """מריץ פונקציה חוסמת על ה-executor של BigQuery בלי לחסום את ה-event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_bq_executor, functools.partial(fn, *args, **kwargs))
+
+
+def format_bytes(n) -> str:
+    n = float(n or 0)
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024:
+            return f"{n:.1f} {unit}"
+        n /= 1024
+    return f"{n:.1f} TB"
+
+
+class QueryCostRefused(Exception):
+    """
+    השאילתה לא הורצה כי היא חורגת מתקרת ה-bytes.
+    reason: "query_limit" (שאילתה אחת) / "session_limit" (מצטבר ל-session).
+    """
+
+    def __init__(self, reason: str, estimated_bytes: int, limit_bytes: int, session_bytes: int = 0):
+        self.reason = reason
+        self.estimated_bytes = estimated_bytes
+        self.limit_bytes = limit_bytes
+        self.session_bytes = session_bytes
+        super().__init__(
+            f"Query refused ({reason}): estimated {format_bytes(estimated_bytes)} "
+            f"exceeds limit {format_bytes(limit_bytes)}"
+            + (f" (session already used {format_bytes(session_bytes)})" if session_bytes else "")
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            "reason": self.reason,
+            "estimated_bytes": self.estimated_bytes,
+            "limit_bytes": self.limit_bytes,
+            "session_bytes": self.session_bytes,
+        }
+
+
+class SessionByteBudget:
+    """bytes שחויבו לכל session (בזיכרון התהליך, חסום במספר ה-sessions)."""
+
+    def __init__(self, max_sessions: int = 10000):
+        self.max_sessions = max_sessions
+        self._used: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def used(self, session_id: str | None) -> int:
+        if not session_id:
+            return 0
+        with self._lock:
+            return self._used.get(session_id, 0)
+
+    def charge(self, session_id: str | None, n: int):
+        if not session_id or not n:
+            return
+        with self._lock:
+            self._used[session_id] = self._used.get(session_id, 0) + int(n)
+            self._used.move_to_end(session_id)
+            while len(self._used) > self.max_sessions:
+                self._used.popitem(last=False)
+
+
+session_bytes = SessionByteBudget()
+
+
+def _load_service_account(path):
+    """קורא את קובץ ה-service account פעם אחת ומחזיר (creds, email, project)."""
+    with open(path, 'r') as f:
+        info = json.load(f)
+    creds = service_account.Credentials.from_service_account_info(
+        info, scopes=bigquery.Client.SCOPE
+    )
+    return creds, info.get("client_email"), info.get("project_id")
+
 
 class BQClient:
-    def __init__(self):
+    def __init__(self, credentials=None, sa_email=None, sa_project=None,
+                 http=None, project=None, location=BQ_LOCATION):
         self.path_of_bq_data_user = BQ_DATA_FILE_PATH
-        self.creds, self.sa_email, self.sa_project = self._load_bq_creds()
-        self.project_id = PROJECT_ID or self.sa_project
+        if credentials is None:
+            self.creds, self.sa_email, self.sa_project = self._load_bq_creds()
+        else:
+            self.creds, self.sa_email, self.sa_project = credentials, sa_email, sa_project
+        self.project_id = project or PROJECT_ID or self.sa_project
+        self.location = location
         self.bq_client = bigquery.Client(
-            location=BQ_LOCATION,
+            location=location,
             project=self.project_id,
-            credentials=self.creds
+            credentials=self.creds,
+            _http=http,
         )
+        self._bqstorage = None
+        self._bqstorage_lock = threading.Lock()
+        self._preview_metadata = {}   # table_id -> (loaded_at, schema, partition ids)
+        self._preview_lock = threading.Lock()
         logging.info("BQ client project=%s location=%s sa_email=%s",
-                     self.project_id, BQ_LOCATION, self.sa_email)
+                     self.project_id, location, self.sa_email)
 
-    def execute_query(self, query, query_type):
+    def execute_query(self, query, query_type, job_config=None):
         logging.info('*********** QUERY %s START ***********', query_type)
         logging.info(query)
         try:
-            job = self.bq_client.query(query)
+            job = self.bq_client.query(query, job_config=job_config)
             result = job.result()  # RowIterator
             logging.info('*********** QUERY %s DONE ***********', query_type)
             return result
         except Forbidden as e:
-            raise PermissionError(
-                f"BigQuery permission error for service account '{self.sa_email}' "
-                f"on project '{self.project_id}'. "
-                f"Ask an admin to grant at least roles/bigquery.jobUser (and dataViewer) "
-                f"on project {self.project_id}. Original error: {e}"
-            ) from e
+            raise self._permission_error(e) from e
+        except (BadRequest, NotFound) as e:
+            raise RuntimeError(f"BigQuery query failed: {e}") from e
+
+    async def execute_query_async(self, query, query_type, job_config=None,
+                                  timeout=BQ_QUERY_TIMEOUT_SECONDS,
+                                  max_bytes_billed=None, job_stats=None, estimated_bytes=None):
+        """
+        כמו execute_query, בלי לחסום את ה-event loop:
+        - ה-job נשלח ונבדק (polling) על ה-executor החסום.
+        - timeout → ה-job מבוטל ב-BigQuery ונזרק TimeoutError.
+        - ביטול ה-task (למשל ניתוק לקוח) → גם ה-job מבוטל, גם אם הביטול
+          הגיע בזמן שליחת ה-job.
+        - max_bytes_billed → maximum_bytes_billed של ה-job (חריגה → QueryCostRefused);
+          נקבע על עותק – ה-job_config של הקורא לא משתנה. estimated_bytes (ה-dry run
+          של check_cost) נכנס ל-QueryCostRefused; ה-job חרג מהתקרה, אז לא פחות ממנה.
+        - job_stats (dict) → מתמלא ב-bytes processed/billed, slot_ms, cache_hit.
+        """
+        logging.info('*********** QUERY %s START (async) ***********', query_type)
+        logging.info(query)
+        if max_bytes_billed:
+            job_config = (
+                bigquery.QueryJobConfig.from_api_repr(job_config.to_api_repr())
+                if job_config else bigquery.QueryJobConfig()
+            )
+            job_config.maximum_bytes_billed = int(max_bytes_billed)
+        try:
+            submit = asyncio.ensure_future(
+                run_blocking(self.bq_client.query, query, job_config=job_config)
+            )
+            try:
+                job = await asyncio.shield(submit)
+            except asyncio.CancelledError:
+                # ה-job אולי כבר נשלח – מבטלים אותו כשה-submit מסתיים
+                submit.add_done_callback(self._cancel_submitted_job)
+                raise
+
+            try:
+                await asyncio.wait_for(self._wait_for_job(job), timeout=timeout)
+            except asyncio.TimeoutError:
+                self._cancel_job(job)
+                raise TimeoutError(
+                    f"BigQuery query {query_type} exceeded {timeout:.0f}s and was cancelled"
+                ) from None
+            except asyncio.CancelledError:
+                self._cancel_job(job)
+                raise
+
+            result = await run_blocking(job.result)  # RowIterator
+            if job_stats is not None:
+                job_stats.update(self.job_stats(job))
+            logging.info('*********** QUERY %s DONE (async) ***********', query_type)
+            return result
+        except Forbidden as e:
+            raise self._permission_error(e) from e
+        except (BadRequest, NotFound) as e:
+            if max_bytes_billed and self._bytes_limit_exceeded(e):
+                limit = int(max_bytes_billed)
+                raise QueryCostRefused("query_limit", max(int(estimated_bytes or 0), limit), limit) from e
+            raise RuntimeError(f"BigQuery query failed: {e}") from e
+
+    # ------------------------------------------------------------------ #
+    #  Cost guard
+    # ------------------------------------------------------------------ #
+    def dry_run(self, query, job_config=None) -> int:
+        """מחזיר total_bytes_processed המשוער (dry run – לא מחויב ולא רץ)."""
+        dry_config = bigquery.QueryJobConfig(
+            dry_run=True,
+            use_query_cache=False,
+            query_parameters=list(job_config.query_parameters) if job_config else [],
+        )
+        try:
+            job = self.bq_client.query(query, job_config=dry_config)
+        except Forbidden as e:
+            raise self._permission_error(e) from e
         except (BadRequest, NotFound) as e:
             raise RuntimeError(f"BigQuery query failed: {e}") from e
+        return int(job.total_bytes_processed or 0)
+
+    def check_cost(self, query, job_config=None, session_id=None,
+                   max_bytes_per_query=BQ_MAX_BYTES_PER_QUERY,
+                   max_bytes_per_session=BQ_MAX_BYTES_PER_SESSION) -> tuple[int, int | None]:
+        """
+        dry run + בדיקת התקרות. מחזיר (estimated_bytes, max_bytes_billed להרצה),
+        או זורק QueryCostRefused.
+        """
+        estimated = self.dry_run(query, job_config)
+
+        if max_bytes_per_query and estimated > max_bytes_per_query:
+            raise QueryCostRefused("query_limit", estimated, max_bytes_per_query)
+
+        used = session_bytes.used(session_id)
+        if max_bytes_per_session and used + estimated > max_bytes_per_session:
+            raise QueryCostRefused("session_limit", estimated, max_bytes_per_session, used)
+
+        limits = [limit for limit in (
+            max_bytes_per_query,
+            (max_bytes_per_session - used) if max_bytes_per_session else 0,
+        ) if limit]
+        return estimated, (min(limits) if limits else None)
+
+    @staticmethod
+    def job_stats(job) -> dict:
+        return {
+            "job_id": job.job_id,
+            "total_bytes_processed": job.total_bytes_processed or 0,
+            "total_bytes_billed": job.total_bytes_billed or 0,
+            "slot_ms": job.slot_millis or 0,
+            "cache_hit": bool(job.cache_hit),
+        }
+
+    @staticmethod
+    def _bytes_limit_exceeded(e) -> bool:
+        return any(err.get("reason") == "bytesBilledLimitExceeded" for err in (e.errors or []))
+
+    def to_arrow(self, rows, storage_min_rows=BQ_STORAGE_MIN_ROWS):
+        """
+        RowIterator → pyarrow.Table (חוסם – להריץ דרך run_blocking).
+        תוצאה גדולה (total_rows >= storage_min_rows) נקראת דרך ה-Storage Read API;
+        קטנה – דרך ה-REST הרגיל, בלי לפתוח session של Storage.
+        """
+        storage = None
+        if rows.total_rows is not None and rows.total_rows >= storage_min_rows:
+            storage = self._storage_client()
+        return rows.to_arrow(bqstorage_client=storage, create_bqstorage_client=False)
+
+    # ------------------------------------------------------------------ #
+    #  Preview (tabledata.list – בלי job)
+    # ------------------------------------------------------------------ #
+    def preview_rows(self, table_id, max_rows, selected_fields, order_by=None):
+        """
+        עד max_rows שורות מה-partition(s) החדש(ים) ביותר, דרך list_rows –
+        בלי שאילתה, בלי bytes processed. ה-partitions עוברים מהחדש לישן
+        (עד PREVIEW_MAX_PARTITIONS) עד שיש מספיק שורות.
+        list_rows מחזיר שורות בסדר שרירותי, ולכן עם order_by (רק עמודת
+        ה-partitioning – השורות החדשות ביותר כולן ב-partition החדש ביותר)
+        כל partition נקרא במלואו וממוין יורד, כמו ORDER BY ... DESC LIMIT.
+        מחזיר pyarrow.Table, או None (→ SQL רגיל) אם הטבלה לא partitioned,
+        order_by אינו עמודת ה-partitioning, או partition גדול מ-PREVIEW_MAX_SORT_ROWS.
+        חוסם – להריץ דרך run_blocking.
+        """
+        schema, partition_field, partitions = self._preview_table_metadata(table_id)
+        if not partitions:
+            return None
+        if order_by and order_by != partition_field:
+            return None
+
+        wanted = set(selected_fields) | ({order_by} if order_by else set())
+        fields = [field for field in schema if field.name in wanted]
+        tables = []
+        remaining = max_rows
+        for partition_id in partitions[:PREVIEW_MAX_PARTITIONS]:
+            partition = f"{table_id}${partition_id}"
+            max_results = remaining
+            if order_by:
+                num_rows = self.bq_client.get_table(partition).num_rows or 0
+                if num_rows > PREVIEW_MAX_SORT_ROWS:
+                    logging.info("Preview of %s: %d rows is too many to sort - running the SQL",
+                                 partition, num_rows)
+                    return None
+                max_results = None
+            rows = self.bq_client.list_rows(partition, selected_fields=fields, max_results=max_results)
+            table = rows.to_arrow(create_bqstorage_client=False)
+            tables.append(table)
+            remaining -= table.num_rows
+            if remaining <= 0:
+                break
+
+        result = pa.concat_tables(tables)
+        if order_by:
+            result = result.sort_by([(order_by, "descending")])
+        return result.select(list(selected_fields)).slice(0, max_rows)
+
+    def _preview_table_metadata(self, table_id):
+        """
+        (schema, עמודת ה-partitioning, partition ids מהחדש לישן) –
+        cache ל-PREVIEW_METADATA_TTL_SECONDS.
+        """
+        now = time.monotonic()
+        with self._preview_lock:
+            cached = self._preview_metadata.get(table_id)
+        if cached and now - cached[0] < PREVIEW_METADATA_TTL_SECONDS:
+            return cached[1:]
+
+        table = self.bq_client.get_table(table_id)
+        partition_field = None
+        partitions = []
+        if table.time_partitioning is not None:
+            partition_field = table.time_partitioning.field
+            # רק partitions של תאריך (בלי __NULL__ / __UNPARTITIONED__ של ה-streaming buffer)
+            partitions = sorted(
+                (p for p in self.bq_client.list_partitions(table) if p.isdigit()),
+                reverse=True,
+            )
+        with self._preview_lock:
+            self._preview_metadata[table_id] = (now, table.schema, partition_field, partitions)
+        return table.schema, partition_field, partitions
+
+    def _storage_client(self):
+        if bigquery_storage is None:
+            return None
+        with self._bqstorage_lock:
+            if self._bqstorage is None:
+                self._bqstorage = bigquery_storage.BigQueryReadClient(credentials=self.creds)
+            return self._bqstorage
+
+    async def _wait_for_job(self, job):
+        delay = 0.05
+        while not await run_blocking(job.done):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 1.0)
+
+    def _cancel_submitted_job(self, submit):
+        if submit.cancelled() or submit.exception() is not None:
+            return
+        self._cancel_job(submit.result())
+
+    def _cancel_job(self, job):
+        logging.warning("Cancelling BigQuery job %s", job.job_id)
+        # fire-and-forget – לא מחכים לביטול בתוך task שכבר מבוטל
+        _bq_executor.submit(job.cancel)
+
+    def _permission_error(self, e):
+        return PermissionError(
+            f"BigQuery permission error for service account '{self.sa_email}' "
+            f"on project '{self.project_id}'. "
+            f"Ask an admin to grant at least roles/bigquery.jobUser (and dataViewer) "
+            f"on project {self.project_id}. Original error: {e}"
+        )
 
     def _load_bq_creds(self):
-        with open(self.path_of_bq_data_user, 'r') as f:
-            info = json.load(f)
-        creds = service_account.Credentials.from_service_account_info(info)
-        sa_email = info.get("client_email")
-        sa_project = info.get("project_id")
-        return creds, sa_email, sa_project
+        return _load_service_account(self.path_of_bq_data_user)
+
+
+# ============================================================
+# Registry משותף לכל התהליך
+# ============================================================
+class BQClientRegistry:
+    """
+    מחזיק BQClient אחד לכל (project, location) בתהליך.
+
+    - ה-credentials נטענים מהקובץ פעם אחת בלבד.
+    - כל ה-clients חולקים AuthorizedSession אחד עם connection pool
+      (keep-alive), כך שאין TLS handshake / auth חדש בכל קריאה.
+    - thread-safe: יצירה ראשונה מתבצעת תחת lock.
+    """
+
+    def __init__(self, pool_size: int = BQ_HTTP_POOL_SIZE):
+        self._lock = threading.Lock()
+        self._pool_size = pool_size
+        self._clients = {}
+        self._sa = None
+        self._session = None
+        self._adapter = None
+        self._acquisitions = 0
+        self._clients_created = 0
+
+    def get(self, project: str | None = None, location: str = BQ_LOCATION) -> BQClient:
+        key = (project or PROJECT_ID, location)
+        with self._lock:
+            self._acquisitions += 1
+            client = self._clients.get(key)
+            if client is None:
+                creds, sa_email, sa_project = self._credentials()
+                client = BQClient(
+                    credentials=creds,
+                    sa_email=sa_email,
+                    sa_project=sa_project,
+                    http=self._http_session(creds),
+                    project=key[0],
+                    location=location,
+                )
+                self._clients[key] = client
+                self._clients_created += 1
+            return client
+
+    def stats(self) -> dict:
+        """סטטיסטיקות pool + שימוש חוזר בחיבורי HTTP."""
+        with self._lock:
+            connections_opened = 0
+            requests_sent = 0
+            idle_connections = 0
+            hosts = 0
+            if self._adapter is not None:
+                pools = self._adapter.poolmanager.pools
+                for pool_key in list(pools.keys()):
+                    pool = pools.get(pool_key)
+                    if pool is None:
+                        continue
+                    hosts += 1
+                    connections_opened += pool.num_connections
+                    requests_sent += pool.num_requests
+                    idle_connections += pool.pool.qsize() if pool.pool else 0
+
+            reused = max(requests_sent - connections_opened, 0)
+            return {
+                "clients": len(self._clients),
+                "clients_created": self._clients_created,
+                "acquisitions": self._acquisitions,
+                "client_reuse": self._acquisitions - self._clients_created,
+                "pool_size": self._pool_size,
+                "hosts": hosts,
+                "connections_opened": connections_opened,
+                "idle_connections": idle_connections,
+                "http_requests": requests_sent,
+                "connection_reuse_ratio": (reused / requests_sent) if requests_sent else 0.0,
+            }
+
+    def close(self):
+        with self._lock:
+            for client in self._clients.values():
+                client.bq_client.close()
+            self._clients.clear()
+            if self._session is not None:
+                self._session.close()
+            self._session = None
+            self._adapter = None
+
+    # -------------------------------------------------------
+    def _credentials(self):
+        if self._sa is None:
+            self._sa = _load_service_account(BQ_DATA_FILE_PATH)
+        return self._sa
+
+    def _http_session(self, creds):
+        if self._session is None:
+            adapter = HTTPAdapter(
+                pool_connections=self._pool_size,
+                pool_maxsize=self._pool_size,
+            )
+            session = AuthorizedSession(creds)
+            session.mount("https://", adapter)
+            self._session = session
+            self._adapter = adapter
+        return self._session
+
+
+_registry = BQClientRegistry()
+
+
+def get_bq_client(project: str | None = None, location: str = BQ_LOCATION) -> BQClient:
+    """BQClient המשותף של התהליך (נוצר בקריאה הראשונה)."""
+    return _registry.get(project=project, location=location)
+
+
+def get_bq_pool_stats() -> dict:
+    return _registry.stats()
+
+
+def close_bq_clients():
+    _registry.close()
 
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
 
-    bq_client = BQClient()
+    bq_client = get_bq_client()
     print(bq_client.bq_client)
 
     qu = """
@@ -68,4 +530,5 @@ if __name__ == '__main__':
     LIMIT 10
     """
     df = bq_client.execute_query(qu, 'test_query').to_dataframe()  # add create_bqstorage_client=True later
-    print(df)
\ No newline at end of file
+    print(df)
+    print(get_bq_pool_stats())
@@ -0,0 +1,191 @@
+"""
+היסטוריית הצ'אט ב-BigQuery, בלי לחסום את הבקשה.
+
+add() רק מכניס את ההודעה לתור בזיכרון; thread ברקע כותב batches
+(insert_rows_json – streaming insert) כל CHAT_HISTORY_FLUSH_SECONDS
+או כשמצטבר batch מלא.
+
+- זיכרון חסום: עד CHAT_HISTORY_MAX_QUEUE הודעות; תור מלא → ההודעה הישנה
+  ביותר נזרקת (ונספרת ב-dropped).
+- כישלון → השורות חוזרות לראש התור, והניסיון הבא אחרי backoff מעריכי;
+  שורה שנכשלה CHAT_HISTORY_MAX_ATTEMPTS פעמים נזרקת.
+- message_id משמש כ-insertId, כך ש-retry לא יוצר כפילויות.
+- shutdown() עוצר את ה-thread ועושה flush אחרון.
+"""
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime, timezone
+
+from google.cloud import bigquery
+
+from AppsFlyerAgent.bq import PROJECT_ID, get_bq_client
+
+logger = logging.getLogger(__name__)
+
+CHAT_HISTORY_TABLE = os.getenv("CHAT_HISTORY_TABLE", f"{PROJECT_ID}.chat_history.messages")
+CHAT_HISTORY_MAX_QUEUE = int(os.getenv("CHAT_HISTORY_MAX_QUEUE", "10000"))
+CHAT_HISTORY_BATCH_SIZE = int(os.getenv("CHAT_HISTORY_BATCH_SIZE", "500"))
+CHAT_HISTORY_FLUSH_SECONDS = float(os.getenv("CHAT_HISTORY_FLUSH_SECONDS", "2"))
+CHAT_HISTORY_MAX_ATTEMPTS = int(os.getenv("CHAT_HISTORY_MAX_ATTEMPTS", "5"))
+CHAT_HISTORY_MAX_BACKOFF_SECONDS = float(os.getenv("CHAT_HISTORY_MAX_BACKOFF_SECONDS", "60"))
+
+SCHEMA = [
+    bigquery.SchemaField("message_id", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("session_id", "STRING"),
+    bigquery.SchemaField("user_id", "STRING"),
+    bigquery.SchemaField("role", "STRING"),
+    bigquery.SchemaField("message", "STRING"),
+    bigquery.SchemaField("created_at", "TIMESTAMP", mode="REQUIRED"),
+]
+
+
+class ChatHistoryWriter:
+    def __init__(self, table_id: str = CHAT_HISTORY_TABLE, max_queue: int = CHAT_HISTORY_MAX_QUEUE,
+                 batch_size: int = CHAT_HISTORY_BATCH_SIZE,
+                 interval_seconds: float = CHAT_HISTORY_FLUSH_SECONDS):
+        self.table_id = table_id
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.interval_seconds = interval_seconds
+        # (row, attempts)
+        self._queue: deque[tuple[dict, int]] = deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._retry_at = 0.0
+        self._failures_in_row = 0
+        self.written = 0
+        self.dropped = 0
+        self.flush_errors = 0
+
+    # -------------------------------------------------------
+    # Public API
+    # -------------------------------------------------------
+    def ensure_table(self):
+        """יוצר את הטבלה אם חסרה (partition לפי יום, cluster לפי session)."""
+        table = bigquery.Table(self.table_id, schema=SCHEMA)
+        table.time_partitioning = bigquery.TimePartitioning(field="created_at")
+        table.clustering_fields = ["session_id"]
+        get_bq_client().bq_client.create_table(table, exists_ok=True)
+        logger.info("[CHAT_HISTORY] table %s ready", self.table_id)
+
+    def add(self, session_id: str, user_id: str, role: str, message: str):
+        """לא חוסם ולא נוגע ב-BigQuery."""
+        row = {
+            "message_id": uuid.uuid4().hex,
+            "session_id": session_id,
+            "user_id": user_id,
+            "role": role,
+            "message": message,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+        }
+        with self._lock:
+            if len(self._queue) >= self.max_queue:
+                self._queue.popleft()
+                self.dropped += 1
+            self._queue.append((row, 0))
+            full = len(self._queue) >= self.batch_size
+            self._ensure_thread()
+        if full:
+            self._wakeup.set()
+
+    def flush(self, ignore_backoff: bool = False) -> int:
+        """כותב batch אחד; מחזיר כמה שורות נכתבו."""
+        with self._flush_lock:
+            if not ignore_backoff and time.monotonic() < self._retry_at:
+                return 0
+            with self._lock:
+                batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+            if not batch:
+                return 0
+
+            rows = [row for row, _ in batch]
+            try:
+                errors = get_bq_client().bq_client.insert_rows_json(
+                    self.table_id, rows, row_ids=[row["message_id"] for row in rows]
+                )
+            except Exception:
+                logger.exception("[CHAT_HISTORY] insert of %d rows failed", len(rows))
+                self._retry(batch)
+                return 0
+
+            failed = {error["index"] for error in errors}
+            if failed:
+                logger.error("[CHAT_HISTORY] %d/%d rows rejected: %s", len(failed), len(rows), errors[:3])
+                self._retry([batch[i] for i in sorted(failed)])
+            else:
+                self._failures_in_row = 0
+                self._retry_at = 0.0
+
+            written = len(rows) - len(failed)
+            self.written += written
+            return written
+
+    def shutdown(self):
+        """עוצר את ה-thread ומרוקן את התור (ניסיון אחד לכל batch)."""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=self.interval_seconds)
+        while self.pending() and self.flush(ignore_backoff=True):
+            pass
+        if self.pending():
+            logger.warning("[CHAT_HISTORY] %d messages not written at shutdown", self.pending())
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._queue)
+
+    def stats(self) -> dict:
+        return {
+            "table": self.table_id,
+            "pending": self.pending(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "flush_errors": self.flush_errors,
+        }
+
+    # -------------------------------------------------------
+    def _retry(self, batch: list[tuple[dict, int]]):
+        """מחזיר לראש התור (באותו סדר) ומתזמן backoff מעריכי."""
+        self.flush_errors += 1
+        self._failures_in_row += 1
+        delay = min(self.interval_seconds * 2 ** self._failures_in_row, CHAT_HISTORY_MAX_BACKOFF_SECONDS)
+        self._retry_at = time.monotonic() + delay
+
+        with self._lock:
+            for row, attempts in reversed(batch):
+                if attempts + 1 >= CHAT_HISTORY_MAX_ATTEMPTS:
+                    self.dropped += 1
+                    logger.error("[CHAT_HISTORY] dropping message %s after %d attempts",
+                                 row["message_id"], attempts + 1)
+                    continue
+                if len(self._queue) >= self.max_queue:
+                    self.dropped += 1
+                    continue
+                self._queue.appendleft((row, attempts + 1))
+
+    def _ensure_thread(self):
+        # נקרא תחת self._lock
+        if self._thread is None and not self._stopped.is_set():
+            self._thread = threading.Thread(
+                target=self._loop, name="chat-history-writer", daemon=True
+            )
+            self._thread.start()
+
+    def _loop(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.interval_seconds)
+            self._wakeup.clear()
+            # כמה batches ברצף כשהתור גדול
+            while self.flush() >= self.batch_size:
+                pass
+
+
+chat_history = ChatHistoryWriter()
@@ -0,0 +1,460 @@
+"""
+Execution backends: איפה SQL של ה-pipeline רץ.
+
+- BigQueryBackend – BigQuery (cost guard + maximum_bytes_billed, כמו קודם).
+- DuckDBBackend   – מנוע עמודתי מקומי (duckdb) מעל Parquet: עותק של הימים
+                    האחרונים של partial_encoded_clicks_part ושל ה-rollups.
+                    אותו SQL (דרך dialect shim), בלי overhead של job.
+- HybridBackend   – שאילתות על ימים שכבר סונכרנו → מקומי; כל השאר → BigQuery.
+
+EXECUTION_BACKEND: "bigquery" (ברירת מחדל) / "duckdb" (מקומי בלבד – בדיקות,
+benchmark, offline) / "hybrid". duckdb הוא תלות אופציונלית.
+
+הסנכרון מ-BigQuery רץ ברקע (start_local_sync() ב-startup של main.py) כל
+LOCAL_SYNC_INTERVAL_SECONDS, ומוריד נתונים רק כשחסר יום שלם חדש.
+LOCAL_SYNC_INTERVAL_SECONDS=0 → אין sync בתהליך, וצריך job חיצוני
+(python -m AppsFlyerAgent.execution_backend) – בלעדיו החלון המקומי לא מתקדם
+ו-hybrid שולח יותר ויותר שאילתות ל-BigQuery.
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+import threading
+from abc import ABC, abstractmethod
+from datetime import date, timedelta
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from AppsFlyerAgent.bq import format_bytes, get_bq_client, run_blocking, session_bytes
+from AppsFlyerAgent.flow_manager_agent.utils.dates import today_local
+from AppsFlyerAgent.flow_manager_agent.utils.metrics import record_bigquery
+from AppsFlyerAgent.flow_manager_agent.sub_agents.protected_query_builder_agent.rollups import (
+    DATASET,
+    DAY_COLUMN,
+    RAW_TABLE,
+    rollup_registry,
+)
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+logger = logging.getLogger(__name__)
+
+EXECUTION_BACKEND = os.getenv("EXECUTION_BACKEND", "bigquery").lower()
+
+# איפה נשמרים קבצי ה-Parquet המקומיים, וכמה ימים אחורה מסנכרנים
+LOCAL_DATA_DIR = Path(os.getenv("LOCAL_DATA_DIR", str(Path(__file__).parent / "local_data")))
+LOCAL_SYNC_DAYS = int(os.getenv("LOCAL_SYNC_DAYS", "7"))
+LOCAL_SYNC_INTERVAL_SECONDS = float(os.getenv("LOCAL_SYNC_INTERVAL_SECONDS", "3600"))
+
+RAW_TABLE_ID = RAW_TABLE.strip("`").rsplit(".", 1)[-1]
+
+
+class UnsupportedQuery(Exception):
+    """ה-SQL לא ניתן להרצה מקומית (טבלה שלא סונכרנה / construct שאין לו shim)."""
+
+
+# ============================================================
+# Interface
+# ============================================================
+class ExecutionBackend(ABC):
+    name = "base"
+
+    @abstractmethod
+    async def run(self, sql: str, *, job_config=None, session_id: str | None = None,
+                  intent: str | None = None) -> pa.Table:
+        """מריץ SQL ומחזיר pyarrow.Table."""
+
+    def data_window(self, table_id: str) -> tuple[date, date] | None:
+        """הימים שה-backend מחזיק במלואם לטבלה; None = כל הטבלה (BigQuery)."""
+        return None
+
+    def stats(self) -> dict:
+        return {"backend": self.name}
+
+
+# ============================================================
+# BigQuery
+# ============================================================
+class BigQueryBackend(ExecutionBackend):
+    name = "bigquery"
+
+    def __init__(self, client=None):
+        self._client = client
+
+    @property
+    def client(self):
+        return self._client or get_bq_client()
+
+    async def run(self, sql, *, job_config=None, session_id=None, intent=None) -> pa.Table:
+        bq = self.client
+        estimated, max_bytes = await run_blocking(
+            bq.check_cost, sql, job_config=job_config, session_id=session_id
+        )
+        stats = {}
+        it = await bq.execute_query_async(
+            sql, 'adk_query', job_config=job_config, max_bytes_billed=max_bytes, job_stats=stats,
+            estimated_bytes=estimated,
+        )
+        session_bytes.charge(session_id, stats.get("total_bytes_billed") or estimated)
+        record_bigquery(stats)
+        logger.info(
+            "[COST] intent=%s estimated=%s processed=%s billed=%s cache_hit=%s",
+            intent,
+            format_bytes(estimated),
+            format_bytes(stats.get("total_bytes_processed")),
+            format_bytes(stats.get("total_bytes_billed")),
+            stats.get("cache_hit"),
+        )
+        return await run_blocking(bq.to_arrow, it)
+
+
+# ============================================================
+# Dialect shim: BigQuery → DuckDB
+# ============================================================
+_QUALIFIED_NAME_RE = re.compile(r"`(?:[\w-]+\.)?[\w-]+\.([\w-]+)`")
+_TIMESTAMP_FN_RE = re.compile(r"\bTIMESTAMP\(\s*'([^']*)'\s*\)", re.IGNORECASE)
+_DATE_LITERAL_FN_RE = re.compile(r"\bDATE\(\s*'([^']*)'\s*\)", re.IGNORECASE)
+_DATE_COLUMN_FN_RE = re.compile(r"\bDATE\(\s*([A-Za-z_]\w*)\s*\)", re.IGNORECASE)
+_CURRENT_DATE_RE = re.compile(r"\bCURRENT_DATE\(\)", re.IGNORECASE)
+_PARAM_RE = re.compile(r"@(\w+)")
+_DATE_VALUE_RE = re.compile(r"'(\d{4}-\d{2}-\d{2})")
+# SUM(...) בלי סוגריים פנימיים ושאינו window function
+_SUM_RE = re.compile(r"\bSUM\(([^()]*)\)(?!\s*OVER\b)", re.IGNORECASE)
+
+# constructs של BigQuery שאין להם shim → UnsupportedQuery (ונשארים ב-BigQuery)
+_UNSUPPORTED_RE = re.compile(
+    r"\b(?:GENERATE_DATE_ARRAY|DATE_SUB|DATE_ADD|TIMESTAMP_SUB|TIMESTAMP_ADD|SAFE\.|"
+    r"FORMAT_DATE|PARSE_DATE|QUALIFY|MERGE|INFORMATION_SCHEMA)\b",
+    re.IGNORECASE,
+)
+
+
+def referenced_tables(sql: str) -> set[str]:
+    """שמות הטבלאות (table_id) שמופיעים ב-SQL כ-`project.dataset.table`."""
+    return set(_QUALIFIED_NAME_RE.findall(sql))
+
+
+def to_duckdb(sql: str) -> str:
+    """
+    ה-constructs ש-compiler / builder מייצרים:
+    `project.dataset.table` → "table", TIMESTAMP('...') → TIMESTAMP '...',
+    DATE('...') → DATE '...', DATE(col) → CAST(col AS DATE),
+    CURRENT_DATE() → current_date, @param → $param,
+    SUM(x) → CAST(SUM(x) AS BIGINT): ב-DuckDB SUM של BIGINT הוא HUGEINT
+    (decimal128 ב-Arrow), וב-BigQuery INT64. כל ה-SUM ב-pipeline הם על
+    total_events (INT64), כך שה-cast לא מאבד כלום.
+    """
+    unsupported = _UNSUPPORTED_RE.search(sql)
+    if unsupported:
+        raise UnsupportedQuery(f"no DuckDB shim for {unsupported.group(0)}")
+
+    sql = _QUALIFIED_NAME_RE.sub(lambda m: f'"{m.group(1)}"', sql)
+    sql = _TIMESTAMP_FN_RE.sub(r"TIMESTAMP '\1'", sql)
+    sql = _DATE_LITERAL_FN_RE.sub(r"DATE '\1'", sql)
+    sql = _DATE_COLUMN_FN_RE.sub(r"CAST(\1 AS DATE)", sql)
+    sql = _CURRENT_DATE_RE.sub("current_date", sql)
+    sql = _SUM_RE.sub(r"CAST(SUM(\1) AS BIGINT)", sql)
+    return _PARAM_RE.sub(r"$\1", sql)
+
+
+def _query_params(job_config) -> dict:
+    if job_config is None:
+        return {}
+    return {p.name: p.value for p in job_config.query_parameters}
+
+
+# ============================================================
+# DuckDB (local Parquet)
+# ============================================================
+class DuckDBBackend(ExecutionBackend):
+    """
+    DuckDB בתהליך, מעל קבצי Parquet ב-LOCAL_DATA_DIR (view לכל טבלה).
+    _manifest.json שומר לכל טבלה את חלון התאריכים שסונכרן במלואו,
+    כך שאחרי restart לא צריך לסנכרן מחדש.
+    ה-session של DuckDB ב-UTC (כמו BigQuery) – אחרת DATE(event_time) /
+    EXTRACT(HOUR ...) על TIMESTAMPTZ מחושבים ב-timezone של המכונה.
+    """
+    name = "duckdb"
+
+    def __init__(self, data_dir: Path = LOCAL_DATA_DIR):
+        if duckdb is None:
+            raise RuntimeError("duckdb is not installed (pip install duckdb)")
+        self.data_dir = Path(data_dir)
+        self.data_dir.mkdir(parents=True, exist_ok=True)
+        self._con = duckdb.connect(database=":memory:")
+        self._con.execute("SET TimeZone='UTC'")
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._sync_task: asyncio.Task | None = None
+        self._windows: dict[str, tuple[date, date]] = {}
+        self.queries = 0
+        self._load_manifest()
+
+    # -------------------------------------------------------
+    # Execution
+    # -------------------------------------------------------
+    async def run(self, sql, *, job_config=None, session_id=None, intent=None) -> pa.Table:
+        return await run_blocking(self.run_sync, sql, job_config)
+
+    def run_sync(self, sql: str, job_config=None) -> pa.Table:
+        missing = referenced_tables(sql) - set(self._windows)
+        if missing:
+            raise UnsupportedQuery(f"tables not synced locally: {sorted(missing)}")
+
+        local_sql = to_duckdb(sql)
+        # cursor לכל שאילתה – ה-connection עצמו לא thread-safe
+        with self._lock:
+            cursor = self._con.cursor()
+        try:
+            table = cursor.execute(local_sql, _query_params(job_config)).fetch_arrow_table()
+        finally:
+            cursor.close()
+        self.queries += 1
+        return table
+
+    def data_window(self, table_id: str) -> tuple[date, date]:
+        with self._lock:
+            window = self._windows.get(table_id)
+        if window is None:
+            raise UnsupportedQuery(f"table not synced locally: {table_id}")
+        return window
+
+    def execute(self, sql: str):
+        """הרצת SQL גולמי (DDL וכו') – למשל create_rollups מול המנוע המקומי."""
+        with self._lock:
+            return self._con.execute(to_duckdb(sql))
+
+    def covers(self, sql: str) -> bool:
+        """
+        אפשר להריץ מקומית רק אם כל הטבלאות סונכרנו, יש תנאי תאריך,
+        וכל התאריכים ב-SQL בתוך החלון שסונכרן לכל הטבלאות.
+        """
+        tables = referenced_tables(sql)
+        if not tables or not tables <= set(self._windows):
+            return False
+        if _UNSUPPORTED_RE.search(sql):
+            return False
+
+        dates = _DATE_VALUE_RE.findall(sql)
+        if not dates:
+            return False
+
+        start = max(self._windows[t][0] for t in tables)
+        end = min(self._windows[t][1] for t in tables)
+        return all(start <= date.fromisoformat(d) <= end for d in dates)
+
+    # -------------------------------------------------------
+    # Sync from BigQuery
+    # -------------------------------------------------------
+    def sync_from_bigquery(self, bq=None, days: int = LOCAL_SYNC_DAYS,
+                           table_ids: list[str] | None = None) -> dict:
+        """
+        מוריד מ-BigQuery את הימים השלמים האחרונים (עד אתמול) של raw + rollups
+        ל-Parquet, ורושם אותם כ-views. מחזיר {table_id: rows}.
+        """
+        bq = bq or get_bq_client()
+        end = today_local() - timedelta(days=1)
+        start = end - timedelta(days=days - 1)
+        table_ids = table_ids if table_ids is not None else self._sync_table_ids()
+
+        synced = {}
+        for table_id in table_ids:
+            if table_id == RAW_TABLE_ID:
+                # תנאי על event_time עצמו → partition pruning
+                where = (f"event_time >= TIMESTAMP('{start} 00:00:00')\n"
+                         f"  AND event_time < TIMESTAMP('{end + timedelta(days=1)} 00:00:00')")
+            else:
+                where = f"{DAY_COLUMN} BETWEEN '{start}' AND '{end}'"
+            sql = f"SELECT * FROM `{DATASET}.{table_id}`\nWHERE {where}"
+            table = bq.to_arrow(bq.execute_query(sql, f"local_sync_{table_id}"))
+            self.load_table(table_id, table, start, end)
+            synced[table_id] = table.num_rows
+
+        logger.info("[LOCAL] synced %s (%s..%s)", synced, start, end)
+        return synced
+
+    def sync_due(self) -> bool:
+        """יש טבלה שלא סונכרנה עד אתמול (יום שלם חדש ב-BigQuery)."""
+        yesterday = today_local() - timedelta(days=1)
+        with self._lock:
+            windows = dict(self._windows)
+        return any(
+            table_id not in windows or windows[table_id][1] < yesterday
+            for table_id in self._sync_table_ids()
+        )
+
+    async def _sync_loop(self, interval_seconds: float):
+        while True:
+            if self.sync_due():
+                try:
+                    await run_blocking(self.sync_from_bigquery)
+                except Exception:
+                    logger.exception("[LOCAL] sync from BigQuery failed - keeping the previous window")
+            await asyncio.sleep(interval_seconds)
+
+    def start_sync(self, interval_seconds: float = LOCAL_SYNC_INTERVAL_SECONDS):
+        """מתחיל את לולאת ה-sync על ה-event loop הנוכחי; interval 0 → sync חיצוני."""
+        if interval_seconds <= 0:
+            logger.info("[LOCAL] in-process sync disabled - expecting an external sync job")
+            return
+        with self._sync_lock:
+            if self._sync_task is None or self._sync_task.done():
+                self._sync_task = asyncio.get_running_loop().create_task(
+                    self._sync_loop(interval_seconds)
+                )
+
+    async def stop_sync(self):
+        with self._sync_lock:
+            task, self._sync_task = self._sync_task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    def _sync_table_ids(self) -> list[str]:
+        return [RAW_TABLE_ID] + [
+            r.table_id for r in rollup_registry.rollups if rollup_registry.is_available(r)
+        ]
+
+    def load_table(self, table_id: str, table: pa.Table, start: date, end: date):
+        """שומר Parquet ורושם view; start..end = הימים שהטבלה מכילה במלואם."""
+        path = self.data_dir / f"{table_id}.parquet"
+        pq.write_table(table, path, compression="zstd")
+        with self._lock:
+            self._register(table_id, path)
+            self._windows[table_id] = (start, end)
+            self._save_manifest()
+
+    # -------------------------------------------------------
+    def stats(self) -> dict:
+        with self._lock:
+            windows = {t: [str(s), str(e)] for t, (s, e) in self._windows.items()}
+        return {
+            "backend": self.name,
+            "queries": self.queries,
+            "tables": windows,
+            "sync_running": self._sync_task is not None and not self._sync_task.done(),
+        }
+
+    def _register(self, table_id: str, path: Path):
+        escaped = str(path).replace("'", "''")
+        self._con.execute(
+            f"CREATE OR REPLACE VIEW \"{table_id}\" AS SELECT * FROM read_parquet('{escaped}')"
+        )
+
+    def _manifest_path(self) -> Path:
+        return self.data_dir / "_manifest.json"
+
+    def _load_manifest(self):
+        path = self._manifest_path()
+        if not path.exists():
+            return
+        manifest = json.loads(path.read_text(encoding="utf-8"))
+        for table_id, (start, end) in manifest.items():
+            parquet = self.data_dir / f"{table_id}.parquet"
+            if parquet.exists():
+                self._register(table_id, parquet)
+                self._windows[table_id] = (date.fromisoformat(start), date.fromisoformat(end))
+
+    def _save_manifest(self):
+        manifest = {t: [str(s), str(e)] for t, (s, e) in self._windows.items()}
+        self._manifest_path().write_text(json.dumps(manifest, indent=2), encoding="utf-8")
+
+
+# ============================================================
+# Hybrid: ימים חמים מקומית, השאר ב-BigQuery
+# ============================================================
+class HybridBackend(ExecutionBackend):
+    name = "hybrid"
+
+    def __init__(self, remote: ExecutionBackend, local: DuckDBBackend):
+        self.remote = remote
+        self.local = local
+        self.local_queries = 0
+        self.remote_queries = 0
+        self.local_failures = 0
+
+    async def run(self, sql, *, job_config=None, session_id=None, intent=None) -> pa.Table:
+        if self.local.covers(sql):
+            try:
+                table = await self.local.run(sql, job_config=job_config)
+                self.local_queries += 1
+                logger.info("[LOCAL] intent=%s served locally (%d rows)", intent, table.num_rows)
+                return table
+            except Exception:
+                self.local_failures += 1
+                logger.exception("[LOCAL] local execution failed - falling back to BigQuery")
+
+        self.remote_queries += 1
+        return await self.remote.run(sql, job_config=job_config, session_id=session_id, intent=intent)
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.name,
+            "local_queries": self.local_queries,
+            "remote_queries": self.remote_queries,
+            "local_failures": self.local_failures,
+            "local": self.local.stats(),
+        }
+
+
+# ============================================================
+# Selector
+# ============================================================
+_backend: ExecutionBackend | None = None
+_backend_lock = threading.Lock()
+
+
+def get_execution_backend() -> ExecutionBackend:
+    """ה-backend של התהליך לפי EXECUTION_BACKEND (נוצר בקריאה הראשונה)."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = _create_backend(EXECUTION_BACKEND)
+        return _backend
+
+
+def _create_backend(kind: str) -> ExecutionBackend:
+    if kind in ("duckdb", "hybrid"):
+        try:
+            local = DuckDBBackend()
+        except RuntimeError as e:
+            logger.warning(f"[LOCAL] {e} - using BigQuery only")
+            return BigQueryBackend()
+        return local if kind == "duckdb" else HybridBackend(BigQueryBackend(), local)
+    return BigQueryBackend()
+
+
+def _local_backend(backend: ExecutionBackend | None) -> DuckDBBackend | None:
+    if isinstance(backend, HybridBackend):
+        return backend.local
+    return backend if isinstance(backend, DuckDBBackend) else None
+
+
+def start_local_sync():
+    """startup: sync תקופתי של ה-backend המקומי (duckdb / hybrid); ב-bigquery – no-op."""
+    local = _local_backend(get_execution_backend())
+    if local is not None:
+        local.start_sync()
+
+
+async def stop_local_sync():
+    with _backend_lock:
+        backend = _backend
+    local = _local_backend(backend)
+    if local is not None:
+        await local.stop_sync()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    print(DuckDBBackend().sync_from_bigquery())
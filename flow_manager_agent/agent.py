@@ -1,25 +1,43 @@
 from typing import AsyncGenerator
 from google.adk.agents import BaseAgent
-from google.adk.events import Event
+from google.adk.events import Event, EventActions
 from google.genai import types
 
 from .utils.json_utils import clean_json as _clean_json
+from .utils.dates import today_local
+from .utils.metrics import record, record_usage, start_trace
 
 # --- Sub Agents ---
-from .sub_agents.intent_analyzer_agent import intent_analyzer_agent, BASE_NLU_SPEC
+from .sub_agents.intent_analyzer_agent import (
+    intent_analyzer_agent,
+    try_fast_path,
+    get_memoized,
+    memoize,
+)
 from .sub_agents.anomaly_agent import anomaly_agent   # ✅ NEW IMPORT
 from .sub_agents.react_visual_agent import react_visual_agent
 from .sub_agents.clarifier_orchestrator_agent import clarifier_agent
-from .sub_agents.protected_query_builder_agent import protected_query_builder_agent
-from .sub_agents.query_executor_agent import query_executor_agent
+from .sub_agents.protected_query_builder_agent import protected_query_builder_agent, compile_intent
+from .sub_agents.query_executor_agent import query_executor_agent, execute_query, SESSION_ID_STATE_KEY
 from .sub_agents.response_insights_agent import response_insights_agent
 from .sub_agents.human_response_agent import human_response_agent
+from .sub_agents.insights_response_agent import insights_response_agent
 
+import asyncio
 import json
+import os
 import re
 import logging
-from datetime import datetime, timedelta
-import pytz
+
+# קומפיילר דטרמיניסטי ל-SQL (ה-LLM builder נשאר כ-fallback); "0" מכבה
+USE_SQL_COMPILER = os.getenv("USE_SQL_COMPILER", "1") != "0"
+
+# ה-LLM query_executor_agent (tool call + echo) במקום קריאה ישירה ל-run_bigquery; "1" מדליק
+USE_LLM_QUERY_EXECUTOR = os.getenv("USE_LLM_QUERY_EXECUTOR", "0") == "1"
+
+# "fused" = insights + תשובה בעברית בקריאת מודל אחת (מוזרמת);
+# "two_step" = response_insights_agent ואז human_response_agent
+RESPONSE_MODE = os.getenv("RESPONSE_MODE", "fused")
 
 
 def _text_event(message: str) -> Event:
@@ -29,49 +47,87 @@ def _text_event(message: str) -> Event:
     )
 
 
-class RootAgent(BaseAgent):
-
-    def __init__(self):
-        super().__init__(name="root_agent")
-
-    async def _run_async_impl(self, context) -> AsyncGenerator[Event, None]:
+def _state_event(author: str, key: str, value) -> Event:
+    """Event בשם sub-agent שכותב value ל-state[key] (כמו output_key של LlmAgent)."""
+    return Event(
+        author=author,
+        content=types.Content(
+            role="model",
+            parts=[types.Part(text=json.dumps(value, ensure_ascii=False))],
+        ),
+        actions=EventActions(state_delta={key: value}),
+    )
 
-        session_state = context.session.state
 
-        # ============================================================
-        # STEP 0 — Inject current date into NLU instruction
-        # ============================================================
-        tz = pytz.timezone("Asia/Jerusalem")
-        today = datetime.now(tz).date()
-        yesterday = today - timedelta(days=1)
-        day_before = today - timedelta(days=2)
+async def _observed(agent, context) -> AsyncGenerator[Event, None]:
+    """מריץ LLM sub-agent ורושם את ה-tokens (usage_metadata) ל-span הנוכחי."""
+    async for event in agent.run_async(context):
+        record_usage(event)
+        yield event
 
-        dynamic_date_block = f"""
-            # SYSTEM DATE DIRECTIVE — DO NOT IGNORE
-            Current real date: {today.strftime("%Y-%m-%d")}
 
-            Natural-language date mapping:
-            - "today" / "היום" → {today}
-            - "yesterday" / "אתמול" → {yesterday}
-            - "שלשום" → {day_before}
+class RootAgent(BaseAgent):
 
-            Dates without year (24.10, 25/10, 25.10):
-            → ALWAYS use year {today.year}.
+    def __init__(self):
+        super().__init__(name="root_agent")
 
-            If interpreted date is in the future → return future-date error.
+    async def _run_async_impl(self, context) -> AsyncGenerator[Event, None]:
+        # trace לכל תור: span לכל שלב → /metrics + שורת [TRACE] בסוף
+        trace = start_trace()
+        try:
+            async for event in self._run_pipeline(context, trace):
+                yield event
+        except (GeneratorExit, asyncio.CancelledError):
+            trace.outcome = "cancelled"
+            raise
+        except Exception:
+            trace.outcome = "error"
+            raise
+        finally:
+            trace.finish()
 
-            # END OF DATE DIRECTIVE
-        """
+    async def _run_pipeline(self, context, trace) -> AsyncGenerator[Event, None]:
 
-        intent_analyzer_agent.instruction = dynamic_date_block + BASE_NLU_SPEC
+        session_state = context.session.state
+        # ל-run_bigquery (tool_context.state) – תקציב ה-bytes לפי session
+        session_state[SESSION_ID_STATE_KEY] = context.session.id
 
         # ============================================================
-        # STEP 1 — Intent Analyzer
+        # STEP 1 — Intent Analyzer (fast path דטרמיניסטי, אחרת Gemini)
         # ============================================================
-        async for event in intent_analyzer_agent.run_async(context):
-            yield event
+        # תשובה לשאלת הבהרה תלויה בהקשר השיחה → תמיד דרך ה-LLM (בלי fast path / memo)
+        previous_analysis = _clean_json(session_state.get("intent_analysis"))
+        context_free = previous_analysis.get("status") != "clarification_needed"
+
+        user_message = self._user_message(context)
+        today = today_local()
+        clarification_answers = session_state.get("clarification_answers")
+
+        with trace.stage("nlu"):
+            known_analysis = None
+            if context_free:
+                known_analysis = try_fast_path(user_message, today)
+                if known_analysis is not None:
+                    logging.info("[RootAgent] NLU fast path hit")
+                    record(nlu_source="fast_path")
+                else:
+                    known_analysis = get_memoized(user_message, today, clarification_answers)
+                    if known_analysis is not None:
+                        logging.info("[RootAgent] NLU memo hit")
+                        record(nlu_source="memo")
+
+            if known_analysis is not None:
+                session_state["intent_analysis"] = known_analysis
+                yield _state_event("intent_analyzer_agent", "intent_analysis", known_analysis)
+            else:
+                record(nlu_source="llm")
+                async for event in _observed(intent_analyzer_agent, context):
+                    yield event
 
         intent_analysis = _clean_json(session_state.get("intent_analysis"))
+
+        if known_analysis is None and context_free:
+            memoize(user_message, today, intent_analysis, clarification_answers)
         status = intent_analysis.get("status")
 
         if status == "not relevant":
@@ -82,9 +138,11 @@ class RootAgent(BaseAgent):
         # ============================================================
         if status == "clarification_needed":
             session_state["missing_fields"] = intent_analysis.get("missing_fields", [])
+            trace.outcome = "clarification"
 
-            async for event in clarifier_agent.run_async(context):
-                yield event
+            with trace.stage("clarifier"):
+                async for event in _observed(clarifier_agent, context):
+                    yield event
 
             return
 
@@ -92,6 +150,7 @@ class RootAgent(BaseAgent):
         # STEP 3 — Hard stop (error / not relevant)
         # ============================================================
         if status in ("not_relevant", "error"):
+            trace.outcome = status
             yield _text_event(intent_analysis.get("message", "Request not supported."))
             return
 
@@ -108,11 +167,13 @@ class RootAgent(BaseAgent):
             if intent_type == "anomaly":
                 # מריץ BigQuery + מזהה אנומליות
                 logging.info("[RootAgent] === ANOMALY FLOW START ===")
-                async for event in anomaly_agent.run_async(context):
-                    yield event
+                with trace.stage("anomaly"):
+                    async for event in anomaly_agent.run_async(context):
+                        yield event
                 # מריץ ויזואליזציה (קורא anomaly_result מה-state)
-                async for event in react_visual_agent.run_async(context):
-                    yield event
+                with trace.stage("visual"):
+                    async for event in react_visual_agent.run_async(context):
+                        yield event
                 logging.info("[RootAgent] === ANOMALY FLOW END ===")
                 return  # ✅ stop here, dont continue to SQL builder
 
@@ -120,31 +181,82 @@ class RootAgent(BaseAgent):
             # Normal analytics / retrieval flow
             # ---------------------------
 
-            # SQL Builder
-            async for event in protected_query_builder_agent.run_async(context):
-                yield event
+            # SQL Builder – קודם הקומפיילר הדטרמיניסטי, LLM רק אם הוא לא יודע
+            with trace.stage("builder"):
+                built_query = compile_intent(parsed_intent) if USE_SQL_COMPILER else None
+
+                if built_query is not None:
+                    logging.info("[RootAgent] SQL built by compiler")
+                    record(builder="compiler")
+                    session_state["built_query"] = built_query
+                    yield _state_event("protected_query_builder_agent", "built_query", built_query)
+                else:
+                    record(builder="llm")
+                    async for event in _observed(protected_query_builder_agent, context):
+                        yield event
 
-            built_query_raw = session_state.get("built_query")
-            built_query = self._parse_built_query(built_query_raw)
+                    built_query_raw = session_state.get("built_query")
+                    built_query = self._parse_built_query(built_query_raw)
 
             if built_query.get("status") != "ok":
                 yield _text_event(built_query.get("message", "SQL Builder error"))
                 return
 
-            # Query Executor
-            async for event in query_executor_agent.run_async(context):
-                yield event
+            # Query Executor – שלב דטרמיניסטי, מריצים את ה-SQL ישירות
+            with trace.stage("executor"):
+                if USE_LLM_QUERY_EXECUTOR:
+                    async for event in _observed(query_executor_agent, context):
+                        yield event
+                else:
+                    execution_result = await execute_query(
+                        built_query.get("sql"),
+                        session_id=context.session.id,
+                        intent=intent_type,
+                        plan=built_query.get("plan"),
+                    )
+                    session_state["execution_result"] = execution_result
+                    yield _state_event("query_executor_agent", "execution_result", execution_result)
 
             sql_result = _clean_json(session_state.get("execution_result", {}))
+            if sql_result.get("status") == "error":
+                trace.outcome = "query_error"
+
+            # השאילתה סורבה בגלל עלות (dry run) → שאלת הבהרה במקום הרצה
+            if sql_result.get("status") == "refused":
+                clarification = {
+                    "status": "clarification_needed",
+                    "missing_fields": ["wide_query_resolution"],
+                    "message": sql_result.get("message"),
+                    "partial_intent": parsed_intent,
+                }
+                session_state["intent_analysis"] = clarification
+                session_state["missing_fields"] = clarification["missing_fields"]
+                yield _state_event("intent_analyzer_agent", "intent_analysis", clarification)
+                trace.outcome = "refused"
+
+                with trace.stage("clarifier"):
+                    async for event in _observed(clarifier_agent, context):
+                        yield event
+                return
 
-            # Insights Agent
             session_state["insights_payload"] = {"execution_result": sql_result}
-            async for event in response_insights_agent.run_async(context):
-                yield event
+
+            if RESPONSE_MODE == "fused":
+                # Insights + Human Response בקריאה אחת (ממלא insights_result)
+                with trace.stage("insights"):
+                    async for event in insights_response_agent.run_async(context):
+                        yield event
+                return
+
+            # Insights Agent
+            with trace.stage("insights"):
+                async for event in _observed(response_insights_agent, context):
+                    yield event
 
             # Human Response Agent
-            async for event in human_response_agent.run_async(context):
-                yield event
+            with trace.stage("human_response"):
+                async for event in _observed(human_response_agent, context):
+                    yield event
 
             return
 
@@ -153,6 +265,14 @@ class RootAgent(BaseAgent):
         return
 
 
+    # ===== User message Helper =====
+    @staticmethod
+    def _user_message(context) -> str:
+        content = getattr(context, "user_content", None)
+        if not content or not content.parts:
+            return ""
+        return "".join(part.text or "" for part in content.parts)
+
     # ===== JSON Parse Helper =====
     def _parse_built_query(self, raw):
         if isinstance(raw, dict):
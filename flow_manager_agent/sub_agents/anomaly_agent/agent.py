@@ -1,14 +1,21 @@
 from typing import AsyncGenerator
+from datetime import date, timedelta
 from pathlib import Path
 import logging
 import json
 
+import numpy as np
+import pandas as pd
 from pydantic import PrivateAttr
 from google.adk.agents import BaseAgent
 from google.adk.events import Event
+from google.cloud import bigquery
 from google.genai import types
 
-from AppsFlyerAgent.bq import BQClient
+from AppsFlyerAgent.bq import BQClient, get_bq_client, run_blocking
+from AppsFlyerAgent.flow_manager_agent.utils.dates import today_local
+from AppsFlyerAgent.flow_manager_agent.utils.json_utils import clean_json
+from AppsFlyerAgent.flow_manager_agent.utils.metrics import record_bigquery
 
 logger = logging.getLogger(__name__)
 
@@ -24,20 +31,163 @@ def _text_event(msg: str) -> Event:
 # --- SQL loading ---
 BASE_DIR = Path(__file__).parent
 
-SPIKE_SQL = (BASE_DIR / "queries" / "spike_clicks.sql").read_text(
-    encoding="utf-8"
-)
-DROP_SQL = (BASE_DIR / "queries" / "drop_clicks.sql").read_text(
+# שאילתה אחת: baseline פעם אחת, כל שורה מסומנת click_spike / click_drop
+ANOMALIES_SQL = (BASE_DIR / "queries" / "anomalies.sql").read_text(
     encoding="utf-8"
 )
 
+ANOMALY_TYPES = ("click_spike", "click_drop")
+
+# כמה ימים לפני תחילת החלון משמשים כ-baseline
+BASELINE_DAYS = 7
+
+
+def resolve_date_range(date_range: dict | None) -> tuple[date, date]:
+    """
+    date_range מה-NLU ({"start_date": "YYYY-MM-DD", "end_date": ...}) → (start, end).
+    בלי date_range → אתמול (כמו ברירת המחדל של ה-NLU לאנומליות).
+    """
+    if date_range:
+        start = date_range.get("start_date") or date_range.get("end_date")
+        end = date_range.get("end_date") or start
+        if start:
+            start_d, end_d = date.fromisoformat(str(start)), date.fromisoformat(str(end))
+            return min(start_d, end_d), max(start_d, end_d)
+
+    yesterday = today_local() - timedelta(days=1)
+    return yesterday, yesterday
+
+
+# ------------------------------------------------------------------ #
+#  Columnar conversion (report / chart data / stats)
+# ------------------------------------------------------------------ #
+
+# עמודת פלט → השמות האפשריים ב-DataFrame (החדש קודם, אח"כ השמות הישנים)
+_COLUMN_ALIASES = {
+    "event_hour": ("event_hour", "hr"),
+    "clicks": ("clicks", "current_clicks"),
+    "avg_clicks": ("avg_clicks", "baseline_mean"),
+}
+
+
+def _numeric_column(df: pd.DataFrame, key: str, integer: bool) -> pd.Series:
+    """העמודה הראשונה שקיימת מתוך _COLUMN_ALIASES[key], כ-Int64 / float64 (חסר → NA)."""
+    for col in _COLUMN_ALIASES[key]:
+        if col in df.columns:
+            values = pd.to_numeric(df[col], errors="coerce").astype("float64")
+            return np.trunc(values).astype("Int64") if integer else values
+    return pd.Series(pd.NA if integer else np.nan, index=df.index,
+                     dtype="Int64" if integer else "float64")
+
+
+def _date_column(df: pd.DataFrame) -> pd.Series:
+    """event_date כ-"YYYY-MM-DD" (חסר → None) – החלון יכול לכלול כמה ימים."""
+    if "event_date" not in df.columns:
+        return pd.Series(None, index=df.index, dtype=object)
+    values = pd.to_datetime(df["event_date"], errors="coerce").dt.strftime("%Y-%m-%d")
+    return values.astype(object).where(values.notna(), None)
+
+
+def anomaly_frame(anomalies: dict) -> pd.DataFrame:
+    """
+    {"click_spike": df, "click_drop": df} → DataFrame אחד בעמודות של report():
+    name, anomaly_type, event_date, event_hour, clicks, avg_clicks.
+    מיפוי העמודות נפתר פעם אחת לכל DataFrame, וההמרות הן על עמודות שלמות.
+    """
+    frames = []
+    for anomaly_type, df in anomalies.items():
+        if df is None or df.empty:
+            continue
+        names = df["media_source"].astype(str) if "media_source" in df.columns else ""
+        frames.append(pd.DataFrame({
+            "name": names,
+            "anomaly_type": anomaly_type,
+            "event_date": _date_column(df),
+            "event_hour": _numeric_column(df, "event_hour", integer=True),
+            "clicks": _numeric_column(df, "clicks", integer=True),
+            "avg_clicks": _numeric_column(df, "avg_clicks", integer=False),
+        }, index=df.index))
+
+    if not frames:
+        return pd.DataFrame(columns=["name", "anomaly_type", "event_date", "event_hour", "clicks", "avg_clicks"])
+    return pd.concat(frames, ignore_index=True)
+
+
+def _pylist(values: pd.Series, missing=None) -> list:
+    """עמודה → list של ערכי Python (NA → missing), בלי מעבר שורה-שורה."""
+    return values.astype(object).where(values.notna(), missing).tolist()
+
+
+def frame_records(frame: pd.DataFrame) -> list:
+    """רשומות ה-JSON של report()."""
+    columns = {col: _pylist(frame[col]) for col in frame.columns}
+    return [dict(zip(columns, row)) for row in zip(*columns.values())]
+
+
+def chart_label(event_date, event_hour) -> str:
+    """ציר ה-x של הגרף: "2025-10-14 10:00" (בלי תאריך – רק השעה, כמו פעם)."""
+    if event_hour is None or event_hour == "":
+        return ""
+    if not event_date:
+        return str(event_hour)
+    return f"{event_date} {int(event_hour):02d}:00"
+
+
+def frame_chart_data(frame: pd.DataFrame) -> list:
+    """
+    הנתונים לגרף (כמו ReactVisualizationAgent._build_chart_data):
+    [{"hour": "2025-10-14 10:00", "clicks": 100, "baseline": 50.0, "source": "...", "type": "..."}, ...]
+    ממוין לפי (תאריך, שעה) – בחלון של כמה ימים אותה שעה חוזרת בכל יום.
+    """
+    ordered = frame.sort_values(["event_date", "event_hour"], kind="stable", na_position="last")
+    labels = [
+        chart_label(event_date, hour)
+        for event_date, hour in zip(_pylist(ordered["event_date"]), _pylist(ordered["event_hour"]))
+    ]
+    return [
+        {"hour": label, "clicks": clicks, "baseline": baseline, "source": source, "type": kind}
+        for label, clicks, baseline, source, kind in zip(
+            labels,
+            _pylist(ordered["clicks"]),
+            _pylist(ordered["avg_clicks"], missing=0),
+            ordered["name"].tolist(),
+            ordered["anomaly_type"].tolist(),
+        )
+    ]
+
+
+def frame_stats(frame: pd.DataFrame) -> dict:
+    """סטטיסטיקה לגרף (כמו ReactVisualizationAgent._calculate_stats)."""
+    deviation = (frame["clicks"].astype("float64") - frame["avg_clicks"]).abs().max()
+    return {
+        "total": int(len(frame)),
+        "spike_count": int((frame["anomaly_type"] == "click_spike").sum()),
+        "drop_count": int((frame["anomaly_type"] == "click_drop").sum()),
+        "max_deviation": float(deviation) if pd.notna(deviation) else 0,
+    }
+
+
+def anomaly_job_config(date_range: dict | None = None,
+                       baseline_days: int = BASELINE_DAYS) -> bigquery.QueryJobConfig:
+    """הפרמטרים של שאילתת האנומליות (@start_date, @end_date, @baseline_days, @today)."""
+    start, end = resolve_date_range(date_range)
+    return bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ScalarQueryParameter("start_date", "DATE", start),
+            bigquery.ScalarQueryParameter("end_date", "DATE", end),
+            bigquery.ScalarQueryParameter("baseline_days", "INT64", baseline_days),
+            # "היום" של האפליקציה – שעות שעוד לא קרו היום לא נחשבות ירידה
+            bigquery.ScalarQueryParameter("today", "DATE", today_local()),
+        ]
+    )
+
 
 class AnomalyAgent(BaseAgent):
     """
     ADK anomaly agent.
 
-    - מריץ 2 שאילתות (spike + drop) ב-BigQuery
-    - מזהה אנומליות (לפי השאילתות)
+    - מריץ שאילתה אחת ב-BigQuery (spike + drop בסריקה אחת של ה-rollup)
+    - מפצל את האנומליות לפי anomaly_type
     - מחזיר JSON מסוכם ל-ADK Web
     """
 
@@ -45,39 +195,49 @@ class AnomalyAgent(BaseAgent):
 
     def __init__(self):
         super().__init__(name="anomaly_agent")
-        self._client = BQClient()
+        self._client = get_bq_client()
 
     # ------------------------------------------------------------------ #
     #  BigQuery helpers
     # ------------------------------------------------------------------ #
 
-    def pull_data(self):
+    def pull_data(self, date_range: dict | None = None):
         """
-        מריץ את שאילתות ה-Spike וה-Drop ומחזיר DataFrames.
+        מריץ את שאילתת האנומליות ומחזיר DataFrame אחד (עמודת anomaly_type).
+        date_range – החלון המבוקש (מה-parsed_intent); ברירת מחדל אתמול.
         """
         logger.info("[AnomalyAgent] Pulling anomaly data from BQ")
 
-        spike_df = self._client.execute_query(
-            SPIKE_SQL, "anomaly_spike"
+        df = self._client.execute_query(
+            ANOMALIES_SQL, "anomalies", job_config=anomaly_job_config(date_range)
         ).to_dataframe()
 
-        # drop_df = self._client.execute_query(
-        #     DROP_SQL, "anomaly_drop"
-        # ).to_dataframe()
+        return {"anomalies": df}
+
+    async def pull_data_async(self, date_range: dict | None = None):
+        """
+        כמו pull_data, בלי לחסום את ה-event loop
+        (ה-job נבדק ברקע, to_dataframe רץ על ה-executor של BigQuery).
+        """
+        logger.info("[AnomalyAgent] Pulling anomaly data from BQ (async)")
+
+        stats = {}
+        rows = await self._client.execute_query_async(
+            ANOMALIES_SQL, "anomalies", job_config=anomaly_job_config(date_range), job_stats=stats
+        )
+        record_bigquery(stats)
+        df = await run_blocking(rows.to_dataframe)
 
-        return {"spike": spike_df}
+        return {"anomalies": df}
 
-    def get_spike_anomalies(self):
+    def get_spike_anomalies(self, date_range: dict | None = None):
         """
-        מחזיר DataFrame עם תוצאות השאילתה spike_clicks.sql.
+        מחזיר DataFrame עם ה-spikes בלבד מתוך anomalies.sql.
         זה מיועד לשימוש חיצוני (למשל סקריפט גרפים), לא ל-ADK Web.
         """
         logger.info("[AnomalyAgent] Fetching spike anomalies (direct)")
-        df = self._client.execute_query(
-            SPIKE_SQL,
-            "spike_anomalies_direct",
-        ).to_dataframe()
-        return df
+        df = self.pull_data(date_range)["anomalies"]
+        return df[df["anomaly_type"] == "click_spike"].reset_index(drop=True)
 
     # ------------------------------------------------------------------ #
     #  Logic
@@ -86,18 +246,18 @@ class AnomalyAgent(BaseAgent):
     def detect_anomalies(self, results):
         """
         Keep dataframes here; convert to JSON in report().
-        results["spike"] / results["drop"] הם DataFrames.
+        results["anomalies"] הוא DataFrame אחד – מפוצל ל-{"click_spike": df, "click_drop": df}.
         """
         anomalies = {}
 
-        spike_df = results.get("spike")
-        # drop_df = results.get("drop")
-
-        if spike_df is not None and not spike_df.empty:
-            anomalies["click_spike"] = spike_df
+        df = results.get("anomalies")
+        if df is None or df.empty:
+            return anomalies
 
-        # if drop_df is not None and not drop_df.empty:
-        #     anomalies["click_drop"] = drop_df
+        for anomaly_type in ANOMALY_TYPES:
+            part = df[df["anomaly_type"] == anomaly_type]
+            if not part.empty:
+                anomalies[anomaly_type] = part.drop(columns="anomaly_type")
 
         return anomalies
 
@@ -109,6 +269,7 @@ class AnomalyAgent(BaseAgent):
           {
             "name": "media_source_123",
             "anomaly_type": "click_spike" / "click_drop",
+            "event_date": "2025-10-14",
             "event_hour": 10,
             "clicks": 123,
             "avg_clicks": 50.5
@@ -116,68 +277,44 @@ class AnomalyAgent(BaseAgent):
           ...
         ]
 
-        תומך גם ב-spike_clicks.sql (עם hr + baseline_mean)
-        וגם ב-drop_clicks.sql (עם event_hour + avg_clicks).
+        בנוסף מחזיר chart_data ו-stats לגרף.
+
+        תומך גם בעמודות של anomalies.sql (event_hour + avg_clicks)
+        וגם בשמות הישנים (hr + baseline_mean / current_clicks).
         """
-        if not anomalies:
+        frame = anomaly_frame(anomalies)
+
+        if frame.empty:
             return {
                 "status": "ok",
                 "message": "לא נמצאו אנומליות.",
                 "anomalies": []
             }
 
-        json_anomalies = []
-
-        for name, df in anomalies.items():
-            if df is None or df.empty:
-                continue
-
-            for _, row in df.iterrows():
-                # ----- שעה -----
-                if "event_hour" in df.columns:
-                    event_hour = int(row["event_hour"])
-                elif "hr" in df.columns:
-                    event_hour = int(row["hr"])
-                else:
-                    event_hour = None
-
-                # ----- קליקים -----
-                if "clicks" in df.columns:
-                    clicks = int(row["clicks"])
-                elif "current_clicks" in df.columns:
-                    clicks = int(row["current_clicks"])
-                else:
-                    clicks = None
-
-                # ----- ממוצע (baseline / avg) -----
-                if "avg_clicks" in df.columns:
-                    avg_clicks = float(row["avg_clicks"])
-                elif "baseline_mean" in df.columns:
-                    avg_clicks = float(row["baseline_mean"])
-                else:
-                    avg_clicks = None
-
-                json_anomalies.append({
-                    "name": str(row.get("media_source", "")),
-                    "anomaly_type": name,
-                    "event_hour": event_hour,
-                    "clicks": clicks,
-                    "avg_clicks": avg_clicks,
-                })
+        json_anomalies = frame_records(frame)
 
         summary = f"נמצאו {len(json_anomalies)} אנומליות."
         return {
             "status": "ok",
             "message": summary,
-            "anomalies": json_anomalies
+            "anomalies": json_anomalies,
+            # מאותו מעבר עמודתי – react_visual_agent לא צריך לעבור שוב על הרשימה
+            "chart_data": frame_chart_data(frame),
+            "stats": frame_stats(frame),
         }
 
-    def run_daily(self):
+    def run_daily(self, date_range: dict | None = None):
         """
         פונקציה סינכרונית – מריץ BQ + זיהוי + יצירת JSON.
-        (משמשת גם ב-ADK web בתוך _run_async_impl)
+        (ב-ADK web משתמשים ב-run_daily_async)
         """
-        data = self.pull_data()
+        data = self.pull_data(date_range)
+        anomalies = self.detect_anomalies(data)
+        return self.report(anomalies)
+
+    async def run_daily_async(self, date_range: dict | None = None):
+        """אותו דבר כמו run_daily – לשימוש מתוך ADK / FastAPI."""
+        data = await self.pull_data_async(date_range)
         anomalies = self.detect_anomalies(data)
         return self.report(anomalies)
 
@@ -191,7 +328,11 @@ class AnomalyAgent(BaseAgent):
         """
         state = context.session.state
 
-        res = self.run_daily()
+        # החלון שה-NLU פירש (parsed_intent.date_range)
+        intent_analysis = clean_json(state.get("intent_analysis"))
+        date_range = (intent_analysis.get("parsed_intent") or {}).get("date_range")
+
+        res = await self.run_daily_async(date_range)
 
         # לשמירה ב-state – כדי שתוכלי לראות ב-debug / להשתמש אח"כ
         state["anomaly_result"] = res
@@ -0,0 +1,85 @@
+-- זיהוי חריגות (Spike + Drop) לכל media_source בסריקה אחת של ה-rollup השעתי.
+-- ה-baseline לכל (media_source, שעה) מחושב פעם אחת מ-@baseline_days הימים
+-- שלפני החלון, וכל שעה בחלון מסומנת click_spike / click_drop מולו.
+--
+-- פרמטרים (BigQuery query parameters):
+--   @start_date    DATE
+--   @end_date      DATE
+--   @baseline_days INT64
+--   @today         DATE   – היום לפי Asia/Jerusalem (today_local), לא CURRENT_DATE() של UTC
+
+WITH hourly AS (
+  -- סריקה יחידה: baseline + חלון
+  SELECT
+    event_date,
+    hr AS event_hour,
+    media_source,
+    SUM(total_events) AS clicks
+  FROM `practicode-2025.clicks_data_prac.hourly_clicks_by_media_source`
+  WHERE event_date BETWEEN DATE_SUB(@start_date, INTERVAL @baseline_days DAY) AND @end_date
+    AND media_source IS NOT NULL
+  GROUP BY
+    event_date,
+    event_hour,
+    media_source
+),
+
+baseline AS (
+  SELECT
+    media_source,
+    event_hour,
+    AVG(clicks)        AS avg_clicks,
+    STDDEV_POP(clicks) AS std_clicks
+  FROM hourly
+  WHERE event_date < @start_date
+  GROUP BY
+    media_source,
+    event_hour
+  -- צריך לפחות 2 נקודות כדי שסטיית התקן תהיה משמעותית
+  HAVING COUNT(*) >= 2
+),
+
+window_days AS (
+  SELECT d AS event_date
+  FROM UNNEST(GENERATE_DATE_ARRAY(@start_date, @end_date)) AS d
+),
+
+scored AS (
+  -- LEFT JOIN: שעה בלי שורה ב-rollup = 0 קליקים (ירידה חדה עד אפס)
+  SELECT
+    w.event_date,
+    b.event_hour,
+    b.media_source,
+    COALESCE(h.clicks, 0)           AS clicks,
+    b.avg_clicks,
+    b.std_clicks,
+    b.avg_clicks + 3 * b.std_clicks AS upper_threshold,
+    b.avg_clicks - 3 * b.std_clicks AS lower_threshold,
+    h.clicks IS NOT NULL            AS has_data
+  FROM baseline b
+  CROSS JOIN window_days w
+  LEFT JOIN hourly h
+    ON h.media_source = b.media_source
+   AND h.event_hour   = b.event_hour
+   AND h.event_date   = w.event_date
+)
+
+SELECT
+  event_date,
+  event_hour,
+  media_source,
+  clicks,
+  avg_clicks,
+  std_clicks,
+  upper_threshold,
+  lower_threshold,
+  IF(clicks > upper_threshold, 'click_spike', 'click_drop') AS anomaly_type
+FROM scored
+WHERE clicks > upper_threshold
+   -- שעות חסרות של היום עוד לא קרו – לא ירידה
+   OR (clicks < lower_threshold AND (has_data OR event_date < @today))
+ORDER BY
+  anomaly_type DESC,
+  media_source,
+  event_date,
+  event_hour;
@@ -0,0 +1 @@
+from .agent import insights_response_agent
\ No newline at end of file
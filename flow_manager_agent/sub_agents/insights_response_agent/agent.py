@@ -0,0 +1,164 @@
+from typing import AsyncGenerator
+import logging
+
+from pydantic import PrivateAttr
+from google.adk.agents import BaseAgent, LlmAgent
+from google.adk.events import Event, EventActions
+from google.genai import types
+
+from AppsFlyerAgent.flow_manager_agent.utils.json_utils import clean_json
+from AppsFlyerAgent.flow_manager_agent.utils.metrics import record_usage
+
+logger = logging.getLogger(__name__)
+
+# מפריד בין הטקסט למשתמש לבין ה-JSON של התובנות
+INSIGHTS_MARKER = "<<<INSIGHTS_JSON>>>"
+
+
+_fused_llm = LlmAgent(
+    name="insights_response_llm",
+    model="gemini-2.0-flash",
+    description="Turns BigQuery results into Hebrew user text and structured insights in one call.",
+    instruction=f"""
+You receive the execution_result of the previous step:
+{{
+    "status": "...",
+    "summary": {{
+        "row_count": ...,
+        "metrics": {{"<metric>": {{"total", "min", "max", "mean", "nulls"}}}},
+        "breakdowns": {{"<dimension>": {{"distinct", "top": [...], "bottom": [...]}}}},
+        "hour_trend": {{"by_hour": [[hour, value], ...], "peak_hour", "low_hour", ...}}
+    }},
+    "result": "... (markdown table – a SAMPLE of the first sample_rows rows)",
+    "sample_rows": ...,
+    "result_truncated": true/false,
+    "message": "...",
+    "row_count": ...,
+    "executed_sql": "..."
+}}
+
+The numbers in "summary" were computed over ALL rows and are exact – use them as-is
+and never recompute totals, shares or averages from the sample.
+
+Your job, in ONE answer:
+1. Analyze the result: basic statistics (summary.metrics), trends (summary.hour_trend),
+   anomalies (extreme values / dominant shares in summary.breakdowns),
+   drilldowns (media_source, hr, partner), suitable graphs.
+2. Write the final answer for the end user in Hebrew.
+
+Output format (MANDATORY, in this order):
+
+PART 1 – the user-facing answer:
+Clean Hebrew text only. No JSON. No Markdown tables.
+No English unless part of a field name.
+Short, structured, readable. Include:
+   • Summary
+   • Key findings
+   • If relevant: What the user can check next (drilldowns)
+
+Then a line containing exactly:
+{INSIGHTS_MARKER}
+
+PART 2 – ONLY JSON:
+{{
+  "summary": "...",
+  "insights": {{
+      "basic_stats": {{...}},
+      "trends": {{...}},
+      "anomalies": {{...}}
+  }},
+  "suggested_drilldowns": [...],
+  "suggested_graphs": [...]
+}}
+
+Rules:
+Never output the raw dataframe.
+Never write anything after the JSON.
+""",
+    output_key=None,
+    generate_content_config={"temperature": 0},
+)
+
+
+def _text_event(author: str, text: str, partial: bool = False, state_delta: dict | None = None) -> Event:
+    return Event(
+        author=author,
+        partial=partial,
+        content=types.Content(role="model", parts=[types.Part(text=text)]),
+        actions=EventActions(state_delta=state_delta or {}),
+    )
+
+
+def _event_text(event: Event) -> str:
+    if not event.content or not event.content.parts:
+        return ""
+    return "".join(part.text or "" for part in event.content.parts)
+
+
+def split_fused_output(text: str) -> tuple[str, dict]:
+    """מפצל את תשובת המודל ל-(טקסט בעברית, insights JSON)."""
+    if INSIGHTS_MARKER in text:
+        user_text, _, json_part = text.partition(INSIGHTS_MARKER)
+        return user_text.strip(), clean_json(json_part)
+    return text.strip(), {}
+
+
+class InsightsResponseAgent(BaseAgent):
+    """
+    מצב תגובה משולב: קריאת מודל אחת במקום response_insights_agent + human_response_agent.
+
+    - הטקסט בעברית מוזרם ללקוח כ-partial events (כשה-run נעשה ב-streaming).
+    - ה-JSON שאחרי INSIGHTS_MARKER לא מוצג – הוא נשמר ב-state["insights_result"]
+      באותו מבנה של response_insights_agent (כולל final_text).
+    """
+
+    _llm: LlmAgent = PrivateAttr()
+
+    def __init__(self):
+        super().__init__(name="insights_response_agent")
+        self._llm = _fused_llm
+
+    async def _run_async_impl(self, context) -> AsyncGenerator[Event, None]:
+        streamed = ""      # כל הטקסט שהגיע ב-partial events
+        visible_sent = 0   # כמה תווים מהטקסט הגלוי כבר נשלחו
+        final_text = None
+
+        async for event in self._llm.run_async(context):
+            # ה-events של ה-LLM לא יוצאים החוצה – ה-tokens נרשמים כאן
+            record_usage(event)
+            text = _event_text(event)
+            if not text:
+                continue
+
+            if event.partial:
+                streamed += text
+                visible = self._visible_prefix(streamed)
+                if len(visible) > visible_sent:
+                    yield _text_event(self.name, visible[visible_sent:], partial=True)
+                    visible_sent = len(visible)
+            else:
+                final_text = text
+
+        if final_text is None:
+            final_text = streamed
+
+        user_text, insights = split_fused_output(final_text)
+        insights["final_text"] = user_text
+
+        context.session.state["insights_result"] = insights
+        yield _text_event(self.name, user_text, state_delta={"insights_result": insights})
+
+    @staticmethod
+    def _visible_prefix(text: str) -> str:
+        """החלק שאפשר להציג: עד ה-marker, בלי זנב שעלול להיות תחילת marker."""
+        if INSIGHTS_MARKER in text:
+            return text.split(INSIGHTS_MARKER, 1)[0].rstrip()
+
+        for keep in range(len(INSIGHTS_MARKER) - 1, 0, -1):
+            if text.endswith(INSIGHTS_MARKER[:keep]):
+                return text[:-keep]
+        return text
+
+
+# Instance for easy import in RootAgent
+insights_response_agent = InsightsResponseAgent()
@@ -1 +1,3 @@
-from .agent import intent_analyzer_agent, BASE_NLU_SPEC
\ No newline at end of file
+from .agent import intent_analyzer_agent, BASE_NLU_SPEC
+from .fast_path import try_fast_path, fast_path_stats
+from .memo import get_memoized, memoize, memo_stats
\ No newline at end of file
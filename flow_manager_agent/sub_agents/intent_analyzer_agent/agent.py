@@ -1,4 +1,7 @@
 from google.adk.agents.llm_agent import LlmAgent
+from google.adk.agents.readonly_context import ReadonlyContext
+
+from AppsFlyerAgent.flow_manager_agent.utils.dates import current_date_directive
 
 GEMINI_MODEL = "gemini-2.0-flash"
 
@@ -201,7 +204,7 @@ BASE_NLU_SPEC = r"""
     DATE RULES (NATURAL LANGUAGE + EXPLICIT)
     ════════════════════════════════════════════
 
-    The RootAgent prepends a SYSTEM DATE DIRECTIVE with the real current date
+    A SYSTEM DATE DIRECTIVE follows this spec with the real current date
     and explicit mappings, e.g.:
       - "today"/"היום"
       - "yesterday"/"אתמול"
@@ -419,9 +422,18 @@ BASE_NLU_SPEC = r"""
     ════════════════════════════════════════════
  """
 
+def nlu_instruction(context: ReadonlyContext) -> str:
+    """
+    ה-spec הקבוע קודם (prefix יציב → context caching בצד המודל),
+    ואחריו ה-date directive של היום (מחושב פעם ביום).
+    לא משנים את ה-agent המשותף בזמן ריצה, כך שאין race בין בקשות.
+    """
+    return BASE_NLU_SPEC + current_date_directive()
+
+
 intent_analyzer_agent = LlmAgent(
     name="intent_analyzer_agent",
     model=GEMINI_MODEL,
-    instruction=BASE_NLU_SPEC,
+    instruction=nlu_instruction,
     output_key="intent_analysis",
 )
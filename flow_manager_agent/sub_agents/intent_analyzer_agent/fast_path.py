@@ -0,0 +1,214 @@
+"""
+Fast path דטרמיניסטי לפני ה-NLU של Gemini.
+
+מזהה צורות הודעה שה-BASE_NLU_SPEC עצמו מגדיר בדפוסים מילוליים
+(ברכות, "show first 10 rows", מילות אנומליה, "app_id 3" בלבד)
+ומחזיר את אותו intent_analysis JSON. כל השאר → None → ה-LLM.
+"""
+import os
+import re
+import threading
+from datetime import date, timedelta
+
+# מתחת לסף הזה לא משתמשים בתוצאה (נופלים ל-LLM)
+FAST_PATH_MIN_CONFIDENCE = float(os.getenv("NLU_FAST_PATH_MIN_CONFIDENCE", "0.9"))
+
+_PUNCT_RE = re.compile(r"[!?.,;:\"'״׳()\-–]+")
+
+_GREETING_RE = re.compile(
+    r"^(?:(?:hi|hello|hey|good morning|שלום|היי|הי|מה נשמע|מה קורה|בוקר טוב|ערב טוב)\s*)+$"
+)
+
+_RETRIEVAL_RES = (
+    re.compile(r"^(?:please\s+)?(?:show|give|get|list|display)(?:\s+me)?(?:\s+the)?(?:\s+first)?\s+(\d+)(?:\s+raw)?\s+rows$"),
+    re.compile(r"^(?:תן לי|תני לי|תראה לי|תראי לי|הצג|הצג לי|רשום לי|הראה לי)\s+(\d+)\s+שורות(?:\s+ראשונות)?$"),
+)
+
+_VALUE_ONLY_RE = re.compile(r"^(app[ _]?id|media[ _]?source|partner|site[ _]?id)\s*[:=]?\s*(\d+)$")
+
+_ANOMALY_WORDS = {
+    "חריגות", "החריגות", "חריגה", "אנומליות", "האנומליות", "אנומליה",
+    "anomaly", "anomalies",
+}
+_ANOMALY_FILLER = {
+    "תן", "תני", "לי", "את", "של", "הצג", "תראה", "תראי", "האם", "היו", "הייתה", "היה",
+    "איזה", "אילו", "יש", "show", "me", "the", "any", "were", "there", "detect",
+    "detection", "find", "list", "for", "of", "from", "please",
+}
+_DATE_WORDS = {
+    "היום": 0, "today": 0,
+    "אתמול": 1, "מאתמול": 1, "yesterday": 1,
+    "שלשום": 2,
+}
+
+
+class FastPathStats:
+    """מונים ל-hit rate של ה-fast path."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.attempts = 0
+        self.hits = 0
+        self.below_threshold = 0
+        self.by_rule: dict[str, int] = {}
+
+    def record(self, rule: str | None, accepted: bool):
+        with self._lock:
+            self.attempts += 1
+            if rule and accepted:
+                self.hits += 1
+                self.by_rule[rule] = self.by_rule.get(rule, 0) + 1
+            elif rule:
+                self.below_threshold += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "attempts": self.attempts,
+                "hits": self.hits,
+                "below_threshold": self.below_threshold,
+                "hit_rate": (self.hits / self.attempts) if self.attempts else 0.0,
+                "by_rule": dict(self.by_rule),
+            }
+
+
+fast_path_stats = FastPathStats()
+
+
+# ============================================================
+# Public API
+# ============================================================
+def try_fast_path(message: str | None, today: date, min_confidence: float = FAST_PATH_MIN_CONFIDENCE) -> dict | None:
+    """מחזיר intent_analysis אם ההודעה זוהתה בביטחון מספיק, אחרת None."""
+    match = classify(message, today)
+    if match is None:
+        fast_path_stats.record(None, False)
+        return None
+
+    intent_analysis, confidence, rule = match
+    accepted = confidence >= min_confidence
+    fast_path_stats.record(rule, accepted)
+    return intent_analysis if accepted else None
+
+
+def classify(message: str | None, today: date):
+    """מחזיר (intent_analysis, confidence, rule) או None."""
+    text = _normalize(message)
+    if not text:
+        return None
+
+    for rule in (_greeting, _retrieval, _value_only, _anomaly):
+        match = rule(text, today)
+        if match is not None:
+            return match
+    return None
+
+
+# ============================================================
+# Rules
+# ============================================================
+def _normalize(message: str | None) -> str:
+    if not message:
+        return ""
+    text = _PUNCT_RE.sub(" ", message.lower())
+    return " ".join(text.split())
+
+
+def _parsed_intent(**overrides) -> dict:
+    parsed = {
+        "intent": None,
+        "metric": None,
+        "dimensions": [],
+        "filters": {},
+        "invalid_fields": [],
+        "date_range": None,
+        "number_of_rows": None,
+        "row_selection": None,
+    }
+    parsed.update(overrides)
+    return parsed
+
+
+def _greeting(text: str, today: date):
+    if not _GREETING_RE.match(text):
+        return None
+    return (
+        {"status": "not_relevant", "message": "Hi! How can I help you today?"},
+        0.99,
+        "greeting",
+    )
+
+
+def _retrieval(text: str, today: date):
+    for pattern in _RETRIEVAL_RES:
+        m = pattern.match(text)
+        if m:
+            n = int(m.group(1))
+            if n <= 0:
+                return None
+            return (
+                {
+                    "status": "ok",
+                    "parsed_intent": _parsed_intent(
+                        intent="retrieval", number_of_rows=n, row_selection="first"
+                    ),
+                },
+                0.95,
+                "retrieval",
+            )
+    return None
+
+
+def _value_only(text: str, today: date):
+    m = _VALUE_ONLY_RE.match(text)
+    if not m:
+        return None
+
+    dimension = m.group(1).replace(" ", "_")
+    if "_" not in dimension and dimension != "partner":
+        # appid / mediasource / siteid
+        dimension = dimension.replace("id", "_id").replace("source", "_source")
+    value = f"{dimension}_{m.group(2)}"
+
+    return (
+        {
+            "status": "clarification_needed",
+            "missing_fields": ["metric"],
+            "message": f"What would you like to analyze regarding {dimension}={value}?",
+            "partial_intent": _parsed_intent(filters={dimension: value}),
+        },
+        0.95,
+        "value_only",
+    )
+
+
+def _anomaly(text: str, today: date):
+    tokens = text.split()
+    if not any(token in _ANOMALY_WORDS for token in tokens):
+        return None
+
+    days_back = None
+    for token in tokens:
+        if token in _ANOMALY_WORDS or token in _ANOMALY_FILLER:
+            continue
+        if token in _DATE_WORDS and days_back is None:
+            days_back = _DATE_WORDS[token]
+            continue
+        # מילה שלא מכירים (שעה, media_source, "השבוע"...) → ל-LLM
+        return None
+
+    # בלי תאריך → ברירת מחדל אתמול (לפי ה-spec)
+    day = today - timedelta(days=1 if days_back is None else days_back)
+    confidence = 0.9 if days_back is None else 0.93
+
+    return (
+        {
+            "status": "ok",
+            "parsed_intent": _parsed_intent(
+                intent="anomaly",
+                date_range={"start_date": day.isoformat(), "end_date": day.isoformat()},
+            ),
+        },
+        confidence,
+        "anomaly",
+    )
@@ -0,0 +1,60 @@
+"""
+Memo ל-intent_analysis של ה-NLU.
+
+מפתח: הודעה מנורמלת + התאריך הנוכחי (כמו ב-date directive, כדי ש"אתמול"
+יישאר נכון) + clarification_answers אם יש.
+כל רשומה פגה בחצות לפי Asia/Jerusalem.
+"""
+import copy
+import json
+import os
+from datetime import date, datetime, time, timedelta
+
+from AppsFlyerAgent.flow_manager_agent.utils.cache import LRUTTLCache
+from AppsFlyerAgent.flow_manager_agent.utils.dates import TZ
+
+NLU_MEMO_MAX_ENTRIES = int(os.getenv("NLU_MEMO_MAX_ENTRIES", "1024"))
+
+# סטטוסים תקינים של ה-NLU – רק אותם שומרים
+_MEMOIZABLE_STATUSES = {"ok", "clarification_needed", "not_relevant", "not relevant", "error"}
+
+_memo = LRUTTLCache(max_entries=NLU_MEMO_MAX_ENTRIES, default_ttl=timedelta(days=1))
+
+
+def memo_key(message: str, today: date, clarification_answers=None) -> str:
+    normalized = " ".join((message or "").lower().split())
+    answers = (
+        json.dumps(clarification_answers, sort_keys=True, ensure_ascii=False, default=str)
+        if clarification_answers else ""
+    )
+    return f"{today.isoformat()}|{answers}|{normalized}"
+
+
+def get_memoized(message: str, today: date, clarification_answers=None) -> dict | None:
+    if not message or not message.strip():
+        return None
+    cached = _memo.get(memo_key(message, today, clarification_answers))
+    return copy.deepcopy(cached) if cached is not None else None
+
+
+def memoize(message: str, today: date, intent_analysis: dict, clarification_answers=None):
+    if not message or not message.strip():
+        return
+    if not isinstance(intent_analysis, dict) or intent_analysis.get("status") not in _MEMOIZABLE_STATUSES:
+        return
+
+    _memo.set(
+        memo_key(message, today, clarification_answers),
+        copy.deepcopy(intent_analysis),
+        ttl=_until_midnight(),
+    )
+
+
+def memo_stats() -> dict:
+    return _memo.stats()
+
+
+def _until_midnight() -> timedelta:
+    now = datetime.now(TZ)
+    midnight = TZ.localize(datetime.combine(now.date() + timedelta(days=1), time.min))
+    return midnight - now
@@ -1 +1,3 @@
-from .agent import protected_query_builder_agent
\ No newline at end of file
+from .agent import protected_query_builder_agent
+from .compiler import compile_intent
+from .rollups import rollup_registry, rollup_refresher, create_rollups, refresh_rollups
@@ -0,0 +1,327 @@
+"""
+קומפיילר דטרמיניסטי: parsed_intent → built_query.
+
+מממש את אותם כללים שמופיעים בפרומפט של protected_query_builder_agent
+(בדיקת תאימות filters, סגנון תנאי תאריך,
+ותבניות retrieval / find top / find bottom / analytics) ומחזיר את אותו JSON:
+
+    {"status": ..., "sql": ..., "clarification_questions": [], "invalid_fields": [], "message": ""}
+
+ל-analytics / find top / find bottom מצורף גם "plan" – האינטנט המנורמל
+(intent, dimensions, filters, date_range), כדי שה-OLAP cube יוכל לענות
+בלי SQL (olap_cube.py). ל-retrieval ה-plan הוא preview: list_rows על
+ה-partition החדש ביותר במקום ORDER BY על כל הטבלה (ה-SQL נשאר כ-fallback).
+
+ה-routing לטבלאות ה-agg הוא לפי כיסוי, דרך rollup_registry (rollups.py).
+מחזיר None כשהאינטנט לא נתמך כאן – ואז ה-RootAgent נופל ל-LLM builder.
+"""
+import re
+from datetime import date
+
+from .rollups import METRIC, RAW_TABLE, rollup_registry
+
+COLUMN_TYPES = {
+    "event_time": "TIMESTAMP",
+    "hr": "INTEGER",
+    "is_engaged_view": "BOOLEAN",
+    "is_retargeting": "BOOLEAN",
+    "media_source": "STRING",
+    "partner": "STRING",
+    "app_id": "STRING",
+    "site_id": "STRING",
+    "engagement_type": "STRING",
+    "total_events": "INTEGER",
+}
+
+RETRIEVAL_COLUMNS = (
+    "event_time, hr, is_engaged_view, is_retargeting,\n"
+    "       media_source, partner, app_id, site_id,\n"
+    "       engagement_type, total_events"
+)
+RETRIEVAL_FIELDS = [column.strip() for column in RETRIEVAL_COLUMNS.split(",")]
+
+ANALYTICS_LIMIT = 100
+
+_DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+
+class _Unsupported(Exception):
+    """האינטנט לא נתמך בקומפיילר → fallback ל-LLM."""
+
+
+def _built(status: str, sql=None, message: str = "", invalid_fields=None, clarification_questions=None,
+           plan=None) -> dict:
+    built = {
+        "status": status,
+        "sql": sql,
+        "clarification_questions": clarification_questions or [],
+        "invalid_fields": invalid_fields or [],
+        "message": message,
+    }
+    if plan is not None:
+        built["plan"] = plan
+    return built
+
+
+# ============================================================
+# Public API
+# ============================================================
+def compile_intent(parsed_intent: dict | None) -> dict | None:
+    """
+    מחזיר built_query (dict) או None אם צריך את ה-LLM builder.
+    """
+    if not isinstance(parsed_intent, dict) or not parsed_intent:
+        return None
+
+    try:
+        return _compile(parsed_intent)
+    except _Unsupported:
+        return None
+
+
+def route_source_table(intent: str, dims: list, filters: dict, date_range=None) -> tuple[str, bool]:
+    """
+    SOURCE TABLE ROUTING: ה-rollup הזול ביותר שמכסה את ה-dimensions וה-filters
+    ועדכני עד סוף date_range (rollup_registry), אחרת raw. retrieval תמיד raw.
+    מחזיר (source_table, uses_event_date).
+    """
+    if intent == "retrieval":
+        return RAW_TABLE, False
+
+    rollup = rollup_registry.route(dims, filters, date_range)
+    if rollup is None:
+        return RAW_TABLE, False
+    return rollup.table, True
+
+
+# ============================================================
+# Internals
+# ============================================================
+def _compile(parsed: dict) -> dict:
+    if parsed.get("needs_clarification"):
+        return _built(
+            "needs_clarification",
+            clarification_questions=parsed.get("clarification_questions") or [],
+            message="Clarification is required before generating SQL.",
+        )
+
+    invalid_fields = parsed.get("invalid_fields") or []
+    if invalid_fields:
+        return _built(
+            "invalid_fields",
+            invalid_fields=list(invalid_fields),
+            message="The user referenced fields that do not exist in the schema.",
+        )
+
+    intent = parsed.get("intent")
+    dims = _dimensions(parsed.get("dimensions"))
+    filters = _filters(parsed.get("filters"))
+    date_range = _date_range(parsed.get("date_range"))
+
+    if intent == "retrieval":
+        return _compile_retrieval(parsed, filters, date_range)
+
+    if intent not in ("analytics", "find top", "find bottom"):
+        raise _Unsupported(intent)
+
+    if not parsed.get("metric"):
+        return _built("error", message="No metrics provided.")
+
+    source_table, uses_event_date = route_source_table(intent, dims, filters, date_range)
+    where = _where_clause(filters, date_range, uses_event_date)
+    plan = {
+        "intent": intent,
+        "dimensions": dims,
+        "filters": filters,
+        "date_range": list(date_range) if date_range else None,
+    }
+
+    if intent in ("find top", "find bottom"):
+        if not dims:
+            return _built("error", message="Ranking requires at least one dimension.")
+        agg_fn = "MAX" if intent == "find top" else "MIN"
+        dim_list = ", ".join(dims)
+        sql = (
+            "WITH agg AS (\n"
+            "    SELECT\n"
+            f"      {dim_list},\n"
+            f"      SUM({METRIC}) AS {METRIC}\n"
+            f"    FROM {source_table}\n"
+            f"{_indent(where, 4)}"
+            f"    GROUP BY {dim_list}\n"
+            ")\n"
+            "SELECT *\n"
+            "FROM agg\n"
+            f"WHERE {METRIC} = (\n"
+            f"    SELECT {agg_fn}({METRIC}) FROM agg\n"
+            ")\n"
+            f"ORDER BY {METRIC} DESC"
+        )
+        return _built("ok", sql=sql, plan=plan)
+
+    if dims:
+        dim_list = ", ".join(dims)
+        sql = (
+            "SELECT\n"
+            f"    {dim_list},\n"
+            f"    SUM({METRIC}) AS {METRIC}\n"
+            f"FROM {source_table}\n"
+            f"{where}"
+            f"GROUP BY {dim_list}\n"
+            f"ORDER BY {METRIC} DESC\n"
+            f"LIMIT {ANALYTICS_LIMIT}"
+        )
+    else:
+        sql = (
+            "SELECT\n"
+            f"    SUM({METRIC}) AS {METRIC}\n"
+            f"FROM {source_table}\n"
+            f"{where}"
+        ).rstrip("\n")
+
+    return _built("ok", sql=sql, plan=plan)
+
+
+def _compile_retrieval(parsed: dict, filters: dict, date_range) -> dict:
+    n = parsed.get("number_of_rows")
+    if isinstance(n, str) and n.strip().isdigit():
+        n = int(n.strip())
+    if not isinstance(n, int) or isinstance(n, bool) or n <= 0:
+        raise _Unsupported("retrieval without number_of_rows")
+
+    # תבנית ה-retrieval בפרומפט לא כוללת WHERE – מקרים כאלה נשארים ל-LLM
+    if filters or date_range:
+        raise _Unsupported("retrieval with predicates")
+
+    source_table, _ = route_source_table("retrieval", [], {})
+    sql = (
+        f"SELECT {RETRIEVAL_COLUMNS}\n"
+        f"FROM {source_table}\n"
+        "ORDER BY event_time DESC\n"
+        f"LIMIT {n}"
+    )
+    plan = {
+        "intent": "retrieval",
+        "preview": {
+            "table": source_table.strip("`"),
+            "number_of_rows": n,
+            "fields": RETRIEVAL_FIELDS,
+            "order_by": "event_time",
+        },
+    }
+    return _built("ok", sql=sql, plan=plan)
+
+
+def _dimensions(raw) -> list:
+    if raw in (None, ""):
+        return []
+    if isinstance(raw, str):
+        raw = [raw]
+    if not isinstance(raw, list):
+        raise _Unsupported("dimensions")
+
+    dims = []
+    for dim in raw:
+        if dim not in COLUMN_TYPES or dim in ("event_time", METRIC):
+            raise _Unsupported(f"dimension {dim!r}")
+        if dim not in dims:
+            dims.append(dim)
+    return dims
+
+
+def _filters(raw) -> dict:
+    if not raw:
+        return {}
+    if not isinstance(raw, dict):
+        raise _Unsupported("filters")
+
+    for key in raw:
+        if key not in COLUMN_TYPES or key == "event_time":
+            raise _Unsupported(f"filter {key!r}")
+    return raw
+
+
+def _date_range(raw):
+    if not raw:
+        return None
+    if not isinstance(raw, dict):
+        raise _Unsupported("date_range")
+
+    start = raw.get("start_date") or raw.get("end_date")
+    end = raw.get("end_date") or start
+    if not start:
+        return None
+    if not (_DATE_RE.match(str(start)) and _DATE_RE.match(str(end))):
+        raise _Unsupported("date_range format")
+    # "2025-13-45" עובר את ה-regex; rollup_registry.route / olap_cube מפרסרים את התאריכים
+    try:
+        date.fromisoformat(str(start))
+        date.fromisoformat(str(end))
+    except ValueError:
+        raise _Unsupported("date_range value")
+    return str(start), str(end)
+
+
+def _where_clause(filters: dict, date_range, uses_event_date: bool) -> str:
+    """WHERE רק אם יש תנאים (NO FORCED WHERE). מחזיר שורות שמסתיימות ב-newline."""
+    predicates = []
+
+    if date_range:
+        start, end = date_range
+        if uses_event_date:
+            predicates.append(f"event_date BETWEEN '{start}' AND '{end}'")
+        else:
+            predicates.append(f"event_time >= TIMESTAMP('{start} 00:00:00')")
+            predicates.append(f"event_time <= TIMESTAMP('{end} 23:59:59')")
+
+    # סדר קבוע → SQL זהה לאותו אינטנט (יציב לקאש)
+    for key in sorted(filters):
+        predicates.append(_predicate(key, filters[key]))
+
+    if not predicates:
+        return ""
+    return "WHERE " + "\n  AND ".join(predicates) + "\n"
+
+
+def _predicate(column: str, value) -> str:
+    if isinstance(value, (list, tuple)):
+        if not value:
+            raise _Unsupported(f"empty filter {column!r}")
+        if len(value) == 1:
+            return f"{column} = {_literal(column, value[0])}"
+        values = ", ".join(_literal(column, v) for v in value)
+        return f"{column} IN ({values})"
+    return f"{column} = {_literal(column, value)}"
+
+
+def _literal(column: str, value) -> str:
+    """STRICT TYPE AND LITERAL RULES."""
+    col_type = COLUMN_TYPES[column]
+
+    if col_type == "INTEGER":
+        if isinstance(value, bool):
+            raise _Unsupported(f"{column} literal")
+        if isinstance(value, int):
+            return str(value)
+        if isinstance(value, str) and value.strip().lstrip("-").isdigit():
+            return str(int(value.strip()))
+        raise _Unsupported(f"{column} literal")
+
+    if col_type == "BOOLEAN":
+        if isinstance(value, bool):
+            return "TRUE" if value else "FALSE"
+        if isinstance(value, str) and value.strip().lower() in ("true", "false"):
+            return value.strip().upper()
+        raise _Unsupported(f"{column} literal")
+
+    if isinstance(value, (dict, list)) or value is None:
+        raise _Unsupported(f"{column} literal")
+    escaped = str(value).replace("\\", "\\\\").replace("'", "\\'")
+    return f"'{escaped}'"
+
+
+def _indent(text: str, spaces: int) -> str:
+    if not text:
+        return ""
+    pad = " " * spaces
+    return "".join(pad + line + "\n" for line in text.splitlines())
@@ -0,0 +1,378 @@
+"""
+Registry דקלרטיבי של טבלאות ה-rollup (agg) מעל טבלת ה-raw.
+
+לכל rollup: grain (hour / day), ה-dimensions שהוא שומר (ולכן גם ה-filters
+שהוא תומך בהם), עלות יחסית משוערת, וה-SQL שיוצר אותו.
+route() בוחר את ה-rollup הזול ביותר שמכסה את ה-dimensions + filters
+של השאילתה; None → raw.
+
+rollups "managed" (שנוצרים כאן ע"י create_rollups) משמשים רק אחרי שהם
+זמינים – נוצרו בתהליך הזה או נמצאו ב-dataset (refresh / refresh_from_bigquery) –
+ורק לטווחי תאריכים עד ה-watermark שלהם (fresh_through: היום האחרון שחושב
+מחדש מה-raw). RollupRefresher מריץ ברקע את refresh_sql על הימים האחרונים,
+מקדם את ה-watermark ושומר אותו כ-label על הטבלה (נקרא ב-refresh_from_bigquery).
+"""
+import asyncio
+import logging
+import os
+import threading
+from dataclasses import dataclass, field
+from datetime import date, timedelta
+from typing import Callable, Iterable
+
+from AppsFlyerAgent.bq import get_bq_client, run_blocking
+from AppsFlyerAgent.flow_manager_agent.utils.dates import today_local
+
+logger = logging.getLogger(__name__)
+
+DATASET = "practicode-2025.clicks_data_prac"
+RAW_TABLE = f"`{DATASET}.partial_encoded_clicks_part`"
+
+METRIC = "total_events"
+
+# עמודות הזמן של rollup (לא נחשבות dimension)
+DAY_COLUMN = "event_date"
+HOUR_COLUMN = "hr"
+
+# label על טבלת ה-rollup: היום האחרון שחושב מחדש מה-raw (YYYY-MM-DD)
+FRESHNESS_LABEL = "fresh_through"
+# כמה ימים אחרונים מחושבים מחדש בכל refresh (נתונים שמגיעים באיחור)
+ROLLUP_REFRESH_DAYS = int(os.getenv("ROLLUP_REFRESH_DAYS", "3"))
+ROLLUP_REFRESH_SECONDS = float(os.getenv("ROLLUP_REFRESH_SECONDS", "3600"))
+
+
+@dataclass(frozen=True)
+class Rollup:
+    name: str
+    table_id: str                      # שם הטבלה בתוך DATASET
+    grain: str                         # "hour" / "day"
+    dimensions: frozenset = field(default_factory=frozenset)
+    relative_cost: float = 1.0         # bytes משוערים ביחס ל-raw (raw = 1.0)
+    managed: bool = False              # נוצר ע"י create_rollups (ולא קיים מראש)
+    # כולל את כל שורות ה-raw (גם NULL ב-dimensions) → אפשר לסכם ממנו גם
+    # שאילתה שלא מפרקת / מסננת לפי ה-dimension שלו
+    complete: bool = False
+
+    @property
+    def table(self) -> str:
+        return f"`{DATASET}.{self.table_id}`"
+
+    @property
+    def group_columns(self) -> list[str]:
+        time_columns = [DAY_COLUMN] + ([HOUR_COLUMN] if self.grain == "hour" else [])
+        return time_columns + sorted(self.dimensions)
+
+    @property
+    def columns(self) -> set[str]:
+        return set(self.group_columns) | {METRIC}
+
+    def covers(self, dims: Iterable[str], filters: Iterable[str]) -> bool:
+        """כל ה-dimensions וה-filters הם עמודות של ה-rollup."""
+        needed = set(dims) | set(filters)
+        if not self.complete and not self.dimensions <= needed:
+            return False
+        return needed <= self.columns - {METRIC, DAY_COLUMN}
+
+    def creation_sql(self, source_table: str = RAW_TABLE, partitioned: bool = True) -> str:
+        select_columns = [f"DATE(event_time) AS {DAY_COLUMN}"] + self.group_columns[1:]
+        group_by = ", ".join(self.group_columns)
+        partition = f"PARTITION BY {DAY_COLUMN}\n" if partitioned else ""
+        return (
+            f"CREATE TABLE IF NOT EXISTS {self.table}\n"
+            f"{partition}"
+            "AS\n"
+            "SELECT\n"
+            + "".join(f"    {column},\n" for column in select_columns)
+            + f"    SUM({METRIC}) AS {METRIC}\n"
+            f"FROM {source_table}\n"
+            f"GROUP BY {group_by}"
+        )
+
+    def refresh_sql(self, start_date: str, end_date: str, source_table: str = RAW_TABLE) -> list[str]:
+        """בנייה מחדש של טווח תאריכים (DELETE + INSERT) – לעדכון יומי של rollup קיים."""
+        select_columns = [f"DATE(event_time) AS {DAY_COLUMN}"] + self.group_columns[1:]
+        # תנאי על event_time עצמו → partition pruning על ה-raw
+        end_exclusive = date.fromisoformat(str(end_date)) + timedelta(days=1)
+        return [
+            f"DELETE FROM {self.table}\n"
+            f"WHERE {DAY_COLUMN} BETWEEN '{start_date}' AND '{end_date}'",
+            f"INSERT INTO {self.table} ({', '.join(self.group_columns)}, {METRIC})\n"
+            "SELECT\n"
+            + "".join(f"    {column},\n" for column in select_columns)
+            + f"    SUM({METRIC}) AS {METRIC}\n"
+            f"FROM {source_table}\n"
+            f"WHERE event_time >= TIMESTAMP('{start_date} 00:00:00')\n"
+            f"  AND event_time < TIMESTAMP('{end_exclusive} 00:00:00')\n"
+            f"GROUP BY {', '.join(self.group_columns)}",
+        ]
+
+
+# ============================================================
+# ה-rollups של הפרויקט
+# ============================================================
+ROLLUPS = (
+    # קיימים מראש
+    Rollup("by_app", "hourly_clicks_by_app", "hour", frozenset({"app_id"}), 0.05),
+    Rollup("by_media_source", "hourly_clicks_by_media_source", "hour", frozenset({"media_source"}), 0.03),
+    Rollup("by_site", "hourly_clicks_by_site", "hour", frozenset({"site_id"}), 0.08),
+    # managed – נוצרים ע"י create_rollups
+    Rollup("daily_clicks_total", "daily_clicks_total", "day", frozenset(), 0.0001,
+           managed=True, complete=True),
+    Rollup("hourly_clicks_total", "hourly_clicks_total", "hour", frozenset(), 0.001,
+           managed=True, complete=True),
+    Rollup("by_partner", "hourly_clicks_by_partner", "hour", frozenset({"partner"}), 0.02,
+           managed=True, complete=True),
+    Rollup("by_engagement_type", "hourly_clicks_by_engagement_type", "hour",
+           frozenset({"engagement_type"}), 0.005, managed=True, complete=True),
+)
+
+
+class RollupRegistry:
+    """בחירת rollup לפי כיסוי + עלות, ומעקב אחרי זמינות ו-watermark של ה-managed rollups."""
+
+    def __init__(self, rollups: Iterable[Rollup] = ROLLUPS):
+        self.rollups = tuple(rollups)
+        self._available: set[str] = set()
+        self._fresh_through: dict[str, date] = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str) -> Rollup:
+        for rollup in self.rollups:
+            if rollup.name == name:
+                return rollup
+        raise KeyError(name)
+
+    def is_available(self, rollup: Rollup) -> bool:
+        if not rollup.managed:
+            return True
+        with self._lock:
+            return rollup.name in self._available
+
+    def mark_available(self, *names: str, fresh_through: date | None = None):
+        with self._lock:
+            self._available.update(names)
+            if fresh_through is not None:
+                for name in names:
+                    self._fresh_through[name] = fresh_through
+
+    def fresh_through(self, rollup: Rollup) -> date | None:
+        """ה-watermark של managed rollup (None = לא ידוע)."""
+        with self._lock:
+            return self._fresh_through.get(rollup.name)
+
+    def set_fresh_through(self, name: str, day: date | None):
+        with self._lock:
+            if day is None:
+                self._fresh_through.pop(name, None)
+            else:
+                self._fresh_through[name] = day
+
+    def is_fresh(self, rollup: Rollup, end_date: date | None) -> bool:
+        """
+        rollup שאינו managed מתוחזק מחוץ לתהליך → תמיד. managed רק אם ה-watermark
+        ידוע ומגיע עד end_date; בלי end_date (כל הזמנים) – אף פעם, כי היום הנוכחי
+        תמיד אחרי ה-watermark.
+        """
+        if not rollup.managed:
+            return True
+        watermark = self.fresh_through(rollup)
+        return watermark is not None and end_date is not None and end_date <= watermark
+
+    def refresh(self, table_ids: Iterable[str], fresh_through: dict[str, date] | None = None):
+        """הזמינות (וה-watermark, אם ידוע) לפי הטבלאות שקיימות ב-DATASET."""
+        existing = set(table_ids)
+        fresh_through = fresh_through or {}
+        with self._lock:
+            self._available = {r.name for r in self.rollups if r.managed and r.table_id in existing}
+            self._fresh_through = {
+                r.name: fresh_through[r.table_id]
+                for r in self.rollups
+                if r.name in self._available and r.table_id in fresh_through
+            }
+
+    def refresh_from_bigquery(self, client):
+        """client: google.cloud.bigquery.Client (list_tables + labels – בלי שאילתה)."""
+        table_ids, fresh_through = [], {}
+        for table in client.list_tables(DATASET):
+            table_ids.append(table.table_id)
+            label = (table.labels or {}).get(FRESHNESS_LABEL)
+            if label:
+                try:
+                    fresh_through[table.table_id] = date.fromisoformat(label)
+                except ValueError:
+                    logger.warning("[ROLLUPS] bad %s label on %s: %r", FRESHNESS_LABEL, table.table_id, label)
+        self.refresh(table_ids, fresh_through)
+        logger.info("[ROLLUPS] available managed rollups: %s (fresh through %s)",
+                    sorted(self._available), {k: str(v) for k, v in self._fresh_through.items()})
+
+    def refresh_due(self, through: date) -> bool:
+        """יש managed rollup זמין שה-watermark שלו לא ידוע או לפני through."""
+        return any(
+            (self.fresh_through(rollup) or date.min) < through
+            for rollup in self.rollups
+            if rollup.managed and self.is_available(rollup)
+        )
+
+    def route(self, dims: Iterable[str], filters: Iterable[str],
+              date_range: tuple[str, str] | None = None) -> Rollup | None:
+        """
+        ה-rollup הזמין הזול ביותר שמכסה את השאילתה, או None (→ raw).
+        date_range = (start, end) – managed rollup רק אם end לא אחרי ה-watermark.
+        """
+        dims, filters = list(dims), list(filters)
+        end_date = date.fromisoformat(date_range[1]) if date_range else None
+        candidates = [
+            rollup for rollup in self.rollups
+            if rollup.covers(dims, filters) and self.is_available(rollup)
+            and self.is_fresh(rollup, end_date)
+        ]
+        return min(candidates, key=lambda rollup: rollup.relative_cost, default=None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            available = set(self._available)
+            fresh_through = dict(self._fresh_through)
+        return {
+            rollup.name: {
+                "table": rollup.table_id,
+                "grain": rollup.grain,
+                "dimensions": sorted(rollup.dimensions),
+                "managed": rollup.managed,
+                "available": not rollup.managed or rollup.name in available,
+                "fresh_through": str(fresh_through[rollup.name]) if rollup.name in fresh_through else None,
+            }
+            for rollup in self.rollups
+        }
+
+
+rollup_registry = RollupRegistry()
+
+
+def create_rollups(execute: Callable[[str], object], registry: RollupRegistry = rollup_registry,
+                   names: Iterable[str] | None = None, source_table: str = RAW_TABLE,
+                   partitioned: bool = True, fresh_through: date | None = None) -> list[str]:
+    """
+    יוצר את ה-managed rollups (CREATE TABLE IF NOT EXISTS ... AS SELECT).
+    execute: פונקציה שמריצה SQL – BigQuery, או מנוע SQL מקומי לבדיקות
+    (אז בד"כ partitioned=False ו-source_table מקומי).
+    fresh_through: ה-watermark אחרי היצירה (ברירת מחדל אתמול – היום עדיין חלקי).
+    """
+    fresh_through = fresh_through or today_local() - timedelta(days=1)
+    wanted = set(names) if names is not None else None
+    created = []
+    for rollup in registry.rollups:
+        if not rollup.managed or (wanted is not None and rollup.name not in wanted):
+            continue
+        logger.info("[ROLLUPS] creating %s", rollup.table_id)
+        execute(rollup.creation_sql(source_table=source_table, partitioned=partitioned))
+        registry.mark_available(rollup.name, fresh_through=fresh_through)
+        created.append(rollup.name)
+    return created
+
+
+def refresh_rollups(execute: Callable[[str], object], registry: RollupRegistry = rollup_registry,
+                    through: date | None = None, days: int = ROLLUP_REFRESH_DAYS,
+                    source_table: str = RAW_TABLE) -> dict[str, date]:
+    """
+    מחשב מחדש (refresh_sql) את הימים האחרונים עד through (ברירת מחדל אתמול) של כל
+    managed rollup זמין, ומקדם את ה-watermark. rollup שה-watermark שלו ישן יותר
+    מהחלון מחושב מהיום שאחרי ה-watermark. מחזיר {name: fresh_through}.
+    """
+    through = through or today_local() - timedelta(days=1)
+    refreshed = {}
+    for rollup in registry.rollups:
+        if not rollup.managed or not registry.is_available(rollup):
+            continue
+        watermark = registry.fresh_through(rollup)
+        start = through - timedelta(days=days - 1)
+        if watermark is not None:
+            start = min(start, watermark + timedelta(days=1))
+
+        # בזמן ה-DELETE + INSERT הימים האלה חסרים ב-rollup → route שולח ל-raw
+        registry.set_fresh_through(rollup.name, start - timedelta(days=1) if watermark else None)
+        try:
+            for sql in rollup.refresh_sql(str(start), str(through), source_table=source_table):
+                execute(sql)
+        except Exception:
+            # הטווח אולי נמחק חלקית – ה-watermark נשאר לפני start
+            logger.exception("[ROLLUPS] refresh of %s (%s..%s) failed", rollup.name, start, through)
+            continue
+
+        registry.set_fresh_through(rollup.name, max(through, watermark or through))
+        refreshed[rollup.name] = registry.fresh_through(rollup)
+        logger.info("[ROLLUPS] refreshed %s %s..%s", rollup.name, start, through)
+    return refreshed
+
+
+# ============================================================
+# Refresh ברקע (BigQuery)
+# ============================================================
+class RollupRefresher:
+    """
+    כל ROLLUP_REFRESH_SECONDS: אם נכנס יום שלם חדש – refresh_rollups מול
+    BigQuery, וה-watermark נשמר כ-label על הטבלה (שרד restart).
+    """
+
+    def __init__(self, registry: RollupRegistry = rollup_registry,
+                 interval_seconds: float = ROLLUP_REFRESH_SECONDS):
+        self.registry = registry
+        self.interval_seconds = interval_seconds
+        self.refreshes = 0
+        self._lock = threading.Lock()
+        self._task: asyncio.Task | None = None
+
+    async def refresh(self):
+        through = today_local() - timedelta(days=1)
+        if not self.registry.refresh_due(through):
+            return
+        bq = get_bq_client()
+        refreshed = await run_blocking(
+            refresh_rollups, lambda sql: bq.execute_query(sql, "rollup_refresh"), self.registry, through
+        )
+        for name, fresh_through in refreshed.items():
+            try:
+                await run_blocking(self._save_watermark, bq.bq_client, self.registry.get(name), fresh_through)
+            except Exception:
+                logger.exception("[ROLLUPS] failed to save the watermark of %s", name)
+        self.refreshes += 1
+
+    @staticmethod
+    def _save_watermark(client, rollup: Rollup, fresh_through: date):
+        table = client.get_table(f"{DATASET}.{rollup.table_id}")
+        table.labels = {**(table.labels or {}), FRESHNESS_LABEL: str(fresh_through)}
+        client.update_table(table, ["labels"])
+
+    async def _refresh_loop(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception:
+                logger.exception("[ROLLUPS] scheduled refresh failed")
+            await asyncio.sleep(self.interval_seconds)
+
+    def start(self):
+        """מתחיל את לולאת ה-refresh על ה-event loop הנוכחי (startup של FastAPI)."""
+        if self.interval_seconds <= 0:
+            return
+        with self._lock:
+            if self._task is None or self._task.done():
+                self._task = asyncio.get_running_loop().create_task(self._refresh_loop())
+
+    async def stop(self):
+        with self._lock:
+            task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+
+rollup_refresher = RollupRefresher()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    bq = get_bq_client()
+    print(create_rollups(lambda sql: bq.execute_query(sql, "create_rollup")))
@@ -1 +1 @@
-from .agent import query_executor_agent
+from .agent import query_executor_agent, run_bigquery, execute_query, SESSION_ID_STATE_KEY
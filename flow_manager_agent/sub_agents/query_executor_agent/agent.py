@@ -1,39 +1,70 @@
 from google.adk.agents import Agent
 from google.adk.agents import LlmAgent
-from AppsFlyerAgent.bq import BQClient
+from google.adk.tools import ToolContext
+from AppsFlyerAgent.bq import QueryCostRefused, get_bq_client, run_blocking
+from AppsFlyerAgent.execution_backend import get_execution_backend
+from AppsFlyerAgent.olap_cube import cube_service
 from AppsFlyerAgent.flow_manager_agent.utils.cache import CacheService, normalize_intent_key
-import pandas as pd
+from AppsFlyerAgent.flow_manager_agent.utils.metrics import record_result
+from AppsFlyerAgent.flow_manager_agent.utils.result_summary import summarize_for_llm
 import logging
 logger = logging.getLogger(__name__) 
 
+# RootAgent writes the session id here so tools can read it via tool_context.state
+SESSION_ID_STATE_KEY = "session_id"
 
-def run_bigquery(query: str):
-    logger.info("run_bigquery called")
+
+async def run_bigquery(query: str, tool_context: ToolContext = None):
+    """Tool wrapper: the session (for the byte budget) comes from the session state."""
+    session_id = tool_context.state.get(SESSION_ID_STATE_KEY) if tool_context is not None else None
+    return await execute_query(query, session_id=session_id)
+
+
+async def execute_query(query: str, session_id: str | None = None, intent: str | None = None,
+                        plan: dict | None = None):
+    logger.info("execute_query called (intent=%s)", intent)
     logger.info("SQL to execute:\n%s", query)
     try:
-        bq = BQClient()
+        # Compiled rollup questions inside the cube window: answered in memory, no SQL
+        table = cube_service.answer(plan)
+        if table is not None:
+            record_result("cube", from_cache=False)
+            payload = summarize_for_llm(table)
+            return _ok_result(query, table, payload, from_cache=False, from_cube=True)
 
-        # Runner that returns list[dict] rows
-        def _runner(sql: str):
-            it = bq.execute_query(sql, 'adk_query')
-            df = it.to_dataframe()
-            return df.to_dict(orient='records')
+        # "show me N rows": list_rows on the newest partition instead of a full ORDER BY scan
+        table = await _preview(plan)
+        if table is not None:
+            record_result("preview", from_cache=False)
+            payload = summarize_for_llm(table)
+            return _ok_result(query, table, payload, from_cache=False)
+
+        backend = get_execution_backend()
+
+        # Runner that returns a pyarrow.Table from the configured backend
+        # (BigQuery: dry-run cost guard + async job; local DuckDB for hot days).
+        # Only runs on a cache miss, so cache hits skip the dry run too.
+        async def _runner(sql: str):
+            return await backend.run(sql, session_id=session_id, intent=intent)
 
         cs = CacheService()
         intent_key = normalize_intent_key(sql=query)
-        rows, from_cache = cs.run_query_with_cache(sql=query, intent_key=intent_key, run_bigquery_fn=_runner)
-
-        # Build markdown result for downstream agents
-        df_out = pd.DataFrame(rows)
-        markdown = df_out.to_markdown(index=False) if not df_out.empty else ""
+        table, from_cache = await cs.run_query_with_cache_async(
+            sql=query, intent_key=intent_key, run_bigquery_fn=_runner
+        )
+        record_result("cache" if from_cache else backend.name, from_cache=from_cache)
 
+        # Precomputed stats + a token-budgeted markdown sample for downstream agents
+        payload = await run_blocking(summarize_for_llm, table)
+        return _ok_result(query, table, payload, from_cache=from_cache)
+    except QueryCostRefused as e:
+        logger.warning("[COST] intent=%s refused: %s", intent, e)
         return {
-            "status": "ok",
-            "result": markdown,
-            "message": None,
-            "row_count": len(rows),
+            "status": "refused",
+            "result": None,
+            "message": str(e),
+            "cost": e.to_dict(),
             "executed_sql": query,
-            "from_cache": from_cache,
         }
     except Exception as e:
         logger.exception("BigQuery execution failed")
@@ -45,6 +76,37 @@ def run_bigquery(query: str):
         }
 
 
+async def _preview(plan: dict | None):
+    preview = (plan or {}).get("preview")
+    if not preview:
+        return None
+    try:
+        return await run_blocking(
+            get_bq_client().preview_rows,
+            preview["table"],
+            preview["number_of_rows"],
+            preview["fields"],
+            order_by=preview.get("order_by"),
+        )
+    except Exception:
+        logger.exception("Preview via list_rows failed - running the SQL instead")
+        return None
+
+
+def _ok_result(query: str, table, payload: dict, from_cache: bool, from_cube: bool = False) -> dict:
+    return {
+        "status": "ok",
+        "result": payload["result"],
+        "summary": payload["summary"],
+        "sample_rows": payload["sample_rows"],
+        "result_truncated": payload["result_truncated"],
+        "message": None,
+        "row_count": table.num_rows,
+        "executed_sql": query,
+        "from_cache": from_cache,
+        "from_cube": from_cube,
+    }
+
 
 query_executor_agent = LlmAgent(
     name="query_executor_agent",
@@ -67,8 +67,9 @@ class ReactVisualizationAgent(BaseAgent):
         # ============================================================
         # STEP 3 — בניית הנתונים עבור הגרף
         # ============================================================
-        chart_data = self._build_chart_data(anomalies)
-        stats = self._calculate_stats(anomalies)
+        # anomaly_agent כבר מחשב אותם עמודתית; חישוב כאן רק לתוצאות ישנות
+        chart_data = anomaly_data.get("chart_data") or self._build_chart_data(anomalies)
+        stats = anomaly_data.get("stats") or self._calculate_stats(anomalies)
         
         # ============================================================
         # STEP 4 — בניית קומפוננט React
@@ -98,21 +99,23 @@ class ReactVisualizationAgent(BaseAgent):
         
         Input:
         [
-            {"name": "media_source_123", "event_hour": 10, "clicks": 100, "avg_clicks": 50},
+            {"name": "media_source_123", "event_date": "2025-10-14", "event_hour": 10, "clicks": 100, "avg_clicks": 50},
             ...
         ]
         
         Output:
         [
-            {"hour": 10, "clicks": 100, "baseline": 50, "source": "media_source_123"},
+            {"hour": "2025-10-14 10:00", "clicks": 100, "baseline": 50, "source": "media_source_123"},
             ...
         ]
         """
         data = []
+        # חלון של כמה ימים: מיון לפי (תאריך, שעה) והתאריך בתווית (כמו anomaly_agent.chart_label)
+        anomalies = sorted(anomalies, key=lambda a: (a.get("event_date") or "", int(a.get("event_hour") or 0)))
         for anomaly in anomalies:
             data.append({
                 # "hour": anomaly.get("event_hour", 0),
-                "hour": str(anomaly.get("event_hour", "")), # כדאי להפוך תמיד לסטרינג
+                "hour": self._chart_label(anomaly), # כדאי להפוך תמיד לסטרינג
                 "clicks": anomaly.get("clicks", 0),
                 # "baseline": anomaly.get("avg_clicks", 0),
                 "baseline": float(anomaly["avg_clicks"]) if anomaly.get("avg_clicks") is not None else 0, # אנומליות עם נתונים חסרים
@@ -120,11 +123,18 @@ class ReactVisualizationAgent(BaseAgent):
                 "type": anomaly.get("anomaly_type", "unknown")
             })
         
-        # מיון לפי שעה
-        # data.sort(key=lambda x: x["hour"])
-        data.sort(key=lambda x: int(x["hour"])) # אחרי שהפכנו לסטרינג צריך למיין בהתאם
         return data
 
+    @staticmethod
+    def _chart_label(anomaly: dict) -> str:
+        """"2025-10-14 10:00" כשיש event_date, אחרת רק השעה."""
+        hour = anomaly.get("event_hour", "")
+        if hour in (None, ""):
+            return ""
+        if not anomaly.get("event_date"):
+            return str(hour)
+        return f"{anomaly['event_date']} {int(hour):02d}:00"
+
     def _calculate_stats(self, anomalies: list) -> dict:
         """
         חישוב סטטיסטיקה בסיסית על האנומליות.
@@ -173,8 +183,7 @@ class ReactVisualizationAgent(BaseAgent):
                 
                 # תצורה בסיסית
                 "title": "📊 זיהוי אנומליות בקליקים",
-                # "description": f"נמצאו {stats['total']} אנומליות: {stats['spike_count']} ספיקים, {stats['drop_count']} ירידות",
-                "description": f"נמצאו {stats['total']} אנומליות (Spike בלבד)",
+                "description": f"נמצאו {stats['total']} אנומליות: {stats['spike_count']} ספיקים, {stats['drop_count']} ירידות",
                 
                 # צבעים לשימוש בגרף
                 "colors": {
@@ -9,19 +9,31 @@ You receive input in this format:
 {
     "execution_result": {
         "status": "...",
-        "result": "... (markdown table)",
+        "summary": {
+            "row_count": ...,
+            "columns": {...},
+            "metrics": {"<metric>": {"total", "min", "max", "mean", "nulls"}},
+            "breakdowns": {"<dimension>": {"distinct", "top": [{..., "value", "share"}], "bottom": [...]}},
+            "hour_trend": {"by_hour": [[hour, value], ...], "peak_hour", "low_hour", ...}
+        },
+        "result": "... (markdown table – a SAMPLE of the first sample_rows rows)",
+        "sample_rows": ...,
+        "result_truncated": true/false,
         "message": "...",
         "row_count": ...,
         "executed_sql": "..."
     }
 }
 
-Your job: Convert the executed SQL + the result table into analytical insights.
+The numbers in "summary" were computed locally over ALL rows and are exact.
+"result" is only a sample when result_truncated is true.
+
+Your job: Convert the executed SQL + the precomputed summary into analytical insights.
 
 Process:
-1. Basic statistics (row count, missing values if visible in patterns)
-2. Detect trends (if timestamps exist)
-3. Detect anomalies (extreme values)
+1. Basic statistics – take them from summary (row_count, metrics). Do NOT recompute them from the sample.
+2. Detect trends – use summary.hour_trend (if present)
+3. Detect anomalies – extreme values and dominant shares in summary.breakdowns
 4. Create a human-readable summary in Hebrew (but do NOT output it directly)
 5. Suggest drilldowns (media_source, hr, partner)
 6. Recommend suitable graphs
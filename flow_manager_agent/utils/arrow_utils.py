@@ -0,0 +1,99 @@
+"""
+עזרים לתוצאות BigQuery כ-pyarrow.Table.
+
+התוצאה נשארת עמודתית מה-fetch ועד ה-cache; רק בקצה נבנה הפורמט
+שהסוכן הבא צריך (markdown), או ה-JSON של L2.
+"""
+import json
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+
+# ============================================================
+# JSON (L2 cache / תאימות לתוצאות ישנות)
+# ============================================================
+def _json_safe_column(column: pa.ChunkedArray) -> pa.ChunkedArray:
+    """תאריכים / שעות → מחרוזת, NUMERIC → float. השאר כמו שהוא."""
+    kind = column.type
+    if pa.types.is_timestamp(kind) or pa.types.is_date(kind) or pa.types.is_time(kind):
+        return pc.cast(column, pa.string())
+    if pa.types.is_decimal(kind):
+        return pc.cast(column, pa.float64())
+    return column
+
+
+def json_safe_table(table: pa.Table) -> pa.Table:
+    """המרה עמודתית לטיפוסים ש-json.dumps יודע לכתוב."""
+    return pa.Table.from_arrays(
+        [_json_safe_column(column) for column in table.columns],
+        names=table.column_names,
+    )
+
+
+def table_to_rows(table: pa.Table) -> list[dict]:
+    return json_safe_table(table).to_pylist()
+
+
+def table_to_json(table: pa.Table) -> str:
+    """ה-JSON שנשמר ב-result של L2 (list של rows, כמו קודם)."""
+    return json.dumps(table_to_rows(table), ensure_ascii=False)
+
+
+def rows_to_table(rows: list[dict]) -> pa.Table:
+    """list[dict] (L2 ישן / runner שמחזיר rows) → pyarrow.Table."""
+    return pa.Table.from_pylist(rows) if rows else pa.table({})
+
+
+def as_table(result) -> pa.Table:
+    return result if isinstance(result, pa.Table) else rows_to_table(list(result or []))
+
+
+# ============================================================
+# Markdown (ל-LLM)
+# ============================================================
+def _is_numeric(kind: pa.DataType) -> bool:
+    return pa.types.is_integer(kind) or pa.types.is_floating(kind) or pa.types.is_decimal(kind)
+
+
+def _column_strings(column: pa.ChunkedArray) -> list[str]:
+    try:
+        strings = pc.cast(_json_safe_column(column), pa.string())
+    except (pa.ArrowNotImplementedError, pa.ArrowInvalid):
+        # struct / list וכו' – אין cast ל-string ב-Arrow
+        return ["" if value is None else str(value) for value in column.to_pylist()]
+    return pc.fill_null(strings, "").to_pylist()
+
+
+def table_to_markdown(table: pa.Table, max_rows: int | None = None) -> str:
+    """
+    טבלת markdown (pipe) ישירות מעמודות ה-Arrow, בלי DataFrame.
+    מספרים מיושרים לימין, השאר לשמאל (כמו to_markdown של pandas).
+    """
+    if table.num_rows == 0 or table.num_columns == 0:
+        return ""
+    if max_rows is not None:
+        table = table.slice(0, max_rows)
+
+    names = table.column_names
+    columns = [_column_strings(column) for column in table.columns]
+    right = [_is_numeric(column.type) for column in table.columns]
+    widths = [
+        max(len(name), max((len(value) for value in values), default=0), 3)
+        for name, values in zip(names, columns)
+    ]
+
+    def _line(cells):
+        return "| " + " | ".join(
+            cell.rjust(width) if align_right else cell.ljust(width)
+            for cell, width, align_right in zip(cells, widths, right)
+        ) + " |"
+
+    separator = "|" + "|".join(
+        ("-" * (width + 1) + ":") if align_right else (":" + "-" * (width + 1))
+        for width, align_right in zip(widths, right)
+    ) + "|"
+
+    lines = [_line(names), separator]
+    lines.extend(_line(row) for row in zip(*columns))
+    return "\n".join(lines)
@@ -1,8 +1,26 @@
+import asyncio
+import atexit
+import inspect
 import json
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timezone, timedelta
 from google.cloud import bigquery
 import logging
 
+from AppsFlyerAgent.bq import get_bq_client, run_blocking
+from AppsFlyerAgent.flow_manager_agent.utils.arrow_utils import (
+    as_table,
+    table_to_json,
+    table_to_rows,
+)
+from AppsFlyerAgent.flow_manager_agent.utils.result_codec import (
+    decode_entry,
+    encode_result,
+    entry_has_result,
+)
+
 logger = logging.getLogger(__name__)
 
 
@@ -79,18 +97,198 @@ def normalize_intent_key(
     return ""
 
 
+# ============================================================
+# L1 – cache בזיכרון התהליך (LRU + TTL)
+# ============================================================
+class LRUTTLCache:
+    """
+    Cache מקומי בזיכרון, חסום בגודל, עם TTL לכל רשומה.
+
+    - get/set הם thread-safe.
+    - כשעוברים את max_entries – הרשומה שהכי פחות בשימוש נזרקת (LRU).
+    - לכל רשומה יש expiry משלה (ttl ברירת מחדל או ttl שמועבר ב-set).
+    """
+
+    def __init__(self, max_entries: int = 256, default_ttl: timedelta = timedelta(seconds=30)):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+
+            expires_at, value = item
+            if expires_at <= now:
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value, ttl: timedelta | None = None):
+        seconds = (ttl if ttl is not None else self.default_ttl).total_seconds()
+        if seconds <= 0:
+            return
+
+        with self._lock:
+            self._data[key] = (time.monotonic() + seconds, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+            }
+
+
+# ============================================================
+# use_count – צבירה בזיכרון + flush תקופתי ברקע
+# ============================================================
+class UseCountBuffer:
+    """
+    צובר הגדלות use_count בזיכרון ומבצע flush תקופתי (thread ברקע)
+    כ-MERGE יחיד, כדי שבקשת הצ'אט לא תחכה ל-DML של BigQuery.
+
+    - add() לא חוסם ולא נוגע ב-BigQuery.
+    - flush נכשל → ההגדלות חוזרות ל-buffer וינסו שוב ב-flush הבא.
+    - shutdown() עוצר את ה-thread ועושה flush אחרון.
+    """
+
+    def __init__(self, flush_fn, interval_seconds: float = 10.0, max_pending_keys: int = 500):
+        self._flush_fn = flush_fn
+        self.interval_seconds = interval_seconds
+        self.max_pending_keys = max_pending_keys
+        self._pending: dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: threading.Thread | None = None
+        self.flushes = 0
+        self.flush_errors = 0
+
+    def add(self, intent_key: str, n: int = 1):
+        with self._lock:
+            self._pending[intent_key] = self._pending.get(intent_key, 0) + n
+            full = len(self._pending) >= self.max_pending_keys
+            self._ensure_thread()
+        if full:
+            self._wakeup.set()
+
+    def pending(self, intent_key: str) -> int:
+        with self._lock:
+            return self._pending.get(intent_key, 0)
+
+    def take(self, intent_key: str) -> int:
+        """מוציא (ומחזיר) את ההגדלות הממתינות של מפתח אחד."""
+        with self._lock:
+            return self._pending.pop(intent_key, 0)
+
+    def flush(self) -> int:
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return 0
+
+            try:
+                self._flush_fn(batch)
+                self.flushes += 1
+                return len(batch)
+            except Exception:
+                self.flush_errors += 1
+                logger.exception(f"[CACHE] use_count flush failed ({len(batch)} keys) - will retry")
+                with self._lock:
+                    for key, n in batch.items():
+                        self._pending[key] = self._pending.get(key, 0) + n
+                return 0
+
+    def shutdown(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=self.interval_seconds)
+        self.flush()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "pending_keys": len(self._pending),
+                "pending_increments": sum(self._pending.values()),
+                "flushes": self.flushes,
+                "flush_errors": self.flush_errors,
+            }
+
+    # -------------------------------------------------------
+    def _ensure_thread(self):
+        # נקרא תחת self._lock
+        if self._thread is None and not self._stopped.is_set():
+            self._thread = threading.Thread(
+                target=self._loop, name="cache-use-count-flusher", daemon=True
+            )
+            self._thread.start()
+
+    def _loop(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.interval_seconds)
+            self._wakeup.clear()
+            self.flush()
+
+
 # ============================================================
 # Cache Service עם use_count + TTL
 # ============================================================
 class CacheService:
     """
-    Cache מבוסס BigQuery.
-    טבלה: practicode-2025.cache.cached_queries
+    Cache דו-שכבתי:
+      L1 – LRUTTLCache בזיכרון התהליך (משותף לכל המופעים של CacheService).
+           hit ב-L1 לא נוגע ב-BigQuery בכלל.
+      L2 – טבלת BigQuery משותפת: practicode-2025.cache.cached_queries
+
+    use_count לא מתעדכן בבקשה עצמה: ההגדלות נצברות ב-UseCountBuffer
+    ונכתבות ברקע כ-MERGE אחד (ראו flush_use_counts / shutdown).
+
+    התוצאות הן pyarrow.Table לאורך כל הדרך (L1 מחזיק את ה-Table עצמו).
+    ב-L2 התוצאה נשמרת כ-Arrow IPC דחוס (result_codec) ב-result_blob;
+    רשומות ישנות עם JSON ב-result עדיין נקראות.
 
     שדות חובה בטבלה:
       intent_key   (STRING)
       sql          (STRING)
-      result       (STRING, nullable)
+      result       (STRING, nullable)   – פורמט ישן (JSON), לקריאה בלבד
+      result_blob  (BYTES, nullable)    – נוסף ב-ensure_schema
+      result_format (STRING, nullable)  – גרסת הקידוד של result_blob
       last_updated (TIMESTAMP)
       use_count    (INT64)
     """
@@ -98,11 +296,22 @@ class CacheService:
     # כמה זמן התוצאה שנשמרה בקאש נחשבת תקפה
     TTL = timedelta(seconds=30)
 
+    # L1: מקסימום רשומות ו-TTL (לא יותר מה-TTL של L2)
+    L1_MAX_ENTRIES = 256
+    L1_TTL = TTL
+
+    _l1 = LRUTTLCache(max_entries=L1_MAX_ENTRIES, default_ttl=L1_TTL)
+
+    # האם העמודות result_blob / result_format קיימות (None = עוד לא נבדק)
+    _blob_columns: bool | None = None
+    _schema_lock = threading.Lock()
+
     def __init__(self):
         self.project = "practicode-2025"
         self.dataset = "cache"
         self.table = "cached_queries"
-        self.client = bigquery.Client(project=self.project, location="EU")
+        # client משותף מה-registry (אותם credentials ואותו HTTP pool)
+        self.client = get_bq_client(project=self.project, location="EU").bq_client
 
     # -------------------------------------------------------
     # קריאה ישירה מה-Cache לפי intent_key (לשימוש כללי)
@@ -128,14 +337,21 @@ class CacheService:
           - אין רשומה
           - אין result
           - TTL פג
-          - ה-JSON ב-result שבור
+          - ה-result השמור שבור / בפורמט לא מוכר
         """
+        table = self._l1.get(intent_key)
+        if table is not None:
+            return {
+                "rows": table_to_rows(table),
+                "executed_sql": intent_key,
+                "row_count": table.num_rows,
+            }
+
         entry = self._load_entry(intent_key)
         if not entry:
             return None
 
-        result_json = entry.get("result")
-        if not result_json:
+        if not entry_has_result(entry):
             # עדיין לא הגענו לשימוש השלישי → אין תוצאה שמורה
             return None
 
@@ -152,16 +368,16 @@ class CacheService:
             return None
 
         try:
-            rows = json.loads(result_json)
+            table = decode_entry(entry)
         except Exception:
             return None
 
         executed_sql = entry.get("sql") or ""
 
         return {
-            "rows": rows,
+            "rows": table_to_rows(table),
             "executed_sql": executed_sql,
-            "row_count": len(rows),
+            "row_count": table.num_rows,
         }
 
     # -------------------------------------------------------
@@ -169,8 +385,27 @@ class CacheService:
     # -------------------------------------------------------
     def run_query_with_cache(self, *, sql: str, intent_key: str, run_bigquery_fn):
         """
+        גרסה סינכרונית של run_query_with_cache_async (לסקריפטים / קוד סינכרוני).
+        אסור לקרוא לה מתוך event loop שרץ – שם משתמשים בגרסה האסינכרונית.
+        """
+        return asyncio.run(
+            self.run_query_with_cache_async(
+                sql=sql, intent_key=intent_key, run_bigquery_fn=run_bigquery_fn
+            )
+        )
+
+    async def run_query_with_cache_async(self, *, sql: str, intent_key: str, run_bigquery_fn):
+        """
+        כל הקריאות ל-BigQuery רצות על ה-executor החסום (run_blocking),
+        כך שה-event loop לא נחסם. run_bigquery_fn יכולה להיות async או רגילה,
+        ולהחזיר pyarrow.Table (או list[dict] – מומר ל-Table).
+        מחזירה (pyarrow.Table, from_cache).
+
         לוגיקה משולבת use_count + TTL:
 
+        ✔ L1 hit (בזיכרון, TTL בתוקף):
+           - מחזירים מיד (from_cache=True) בלי שום קריאה ל-BigQuery
+
         ✔ שימוש 1–2:
            - תמיד מריצים BigQuery
            - מעדכנים use_count בלבד
@@ -186,7 +421,16 @@ class CacheService:
            - אם TTL פג / אין result / JSON שבור → מריצים BigQuery ומעדכנים result
         """
 
-        entry = self._load_entry(intent_key)
+        # -------------------------
+        # 0) L1 – בזיכרון, בלי BigQuery
+        # -------------------------
+        cached_table = self._l1.get(intent_key)
+        if cached_table is not None:
+            logger.info(f"[CACHE] L1 HIT for key: {intent_key[:50]}...")
+            _use_counts.add(intent_key)
+            return cached_table, True
+
+        entry = await run_blocking(self._load_entry, intent_key)
         now = datetime.now(timezone.utc)
 
         # -------------------------
@@ -197,22 +441,21 @@ class CacheService:
             #   use_count = 1
             #   result = NULL
             logger.info(f"[CACHE] New entry - creating with use_count=1 for key: {intent_key[:50]}...")
-            self._insert_new_entry(intent_key, sql, now)
+            await run_blocking(self._insert_new_entry, intent_key, sql, now)
 
             # מריצים BigQuery אבל לא שומרים result בקאש
-            result = run_bigquery_fn(sql)
-            safe = self._make_json_safe(result)
-            return safe, False
+            table = as_table(await self._run(run_bigquery_fn, sql))
+            return table, False
 
         # -------------------------
         # 2) רשומה קיימת
         # -------------------------
-        current_count = int(entry.get("use_count") or 0)
+        # מה שכבר בטבלה + הגדלות שעדיין מחכות ל-flush
+        current_count = int(entry.get("use_count") or 0) + _use_counts.pending(intent_key)
         use_count = current_count + 1
         logger.info(f"[CACHE] Existing entry - use_count: {current_count} -> {use_count} for key: {intent_key[:50]}...")
 
-        result_json = entry.get("result")
-        has_result = bool(result_json)
+        has_result = entry_has_result(entry)
 
         last_updated = entry.get("last_updated")
         if last_updated is not None and last_updated.tzinfo is None:
@@ -232,30 +475,29 @@ class CacheService:
         if use_count < 3:
             logger.info(f"[CACHE] Warming up - updating use_count to {use_count} (no result saved yet)")
             # מעדכנים רק use_count, לא נוגעים ב-last_updated ולא ב-result
-            self._update_use_count(intent_key, use_count)
+            _use_counts.add(intent_key)
 
-            result = run_bigquery_fn(sql)
-            safe = self._make_json_safe(result)
-            return safe, False
+            table = as_table(await self._run(run_bigquery_fn, sql))
+            return table, False
 
         # -------------------------
         # 2.ב) שימוש 3 → מחשבים ושומרים לקאש
         # -------------------------
         if use_count == 3:
             logger.info(f"[CACHE] 3rd use! Running BQ and saving result to cache")
-            result = run_bigquery_fn(sql)
-            safe = self._make_json_safe(result)
+            table = as_table(await self._run(run_bigquery_fn, sql))
 
             # כאן בפעם הראשונה נשמר result + last_updated + use_count=3
-            self._update_result(
+            await run_blocking(
+                self._update_result,
                 intent_key=intent_key,
-                result=safe,
+                result=table,
                 sql=sql,
                 now=now,
-                use_count=use_count,
             )
+            self._l1.set(intent_key, table)
 
-            return safe, False
+            return table, False
 
         # -------------------------
         # 2.ג) שימוש 4+ → כבר אמור להיות result בקאש
@@ -263,40 +505,92 @@ class CacheService:
         if has_result and not is_expired:
             logger.info(f"[CACHE] Cache HIT! Returning from cache (use_count: {use_count}, TTL valid)")
             # TTL בתוקף → מחזירים מהקאש בלבד
-            self._update_use_count(intent_key, use_count)
+            _use_counts.add(intent_key)
             try:
-                rows = json.loads(result_json)
-                return rows, True
+                table = await run_blocking(decode_entry, entry)
+                # ב-L1 רק לזמן שנשאר עד שה-TTL של L2 פג
+                self._l1.set(intent_key, table, ttl=min(self.L1_TTL, self.TTL - (now - last_updated)))
+                return table, True
             except Exception:
-                logger.warning(f"[CACHE] JSON parse error, recomputing")
-                # JSON שבור → נופלים ל-recompute
+                logger.warning(f"[CACHE] Cached result decode error, recomputing")
+                # blob / JSON שבור או פורמט לא מוכר → נופלים ל-recompute
                 pass
 
         # אם הגענו לכאן:
         #   - או שאין result (לא אמור לקרות אחרי שימוש 3)
         #   - או שה-TTL פג
-        #   - או ש-JSON שבור
+        #   - או שה-result השמור שבור
         logger.info(f"[CACHE] Cache MISS or TTL expired - running BQ and refreshing cache")
-        result = run_bigquery_fn(sql)
-        safe = self._make_json_safe(result)
+        table = as_table(await self._run(run_bigquery_fn, sql))
 
-        self._update_result(
+        await run_blocking(
+            self._update_result,
             intent_key=intent_key,
-            result=safe,
+            result=table,
             sql=sql,
             now=now,
-            use_count=use_count,
         )
+        self._l1.set(intent_key, table)
+
+        return table, False
+
+    # -------------------------------------------------------
+    # סטטיסטיקות L1 (hit/miss/evictions)
+    # -------------------------------------------------------
+    @classmethod
+    def l1_stats(cls) -> dict:
+        return cls._l1.stats()
+
+    # -------------------------------------------------------
+    # use_count ברקע
+    # -------------------------------------------------------
+    @staticmethod
+    def use_count_stats() -> dict:
+        return _use_counts.stats()
 
-        return safe, False
+    @staticmethod
+    def flush_use_counts() -> int:
+        return _use_counts.flush()
+
+    @staticmethod
+    def shutdown():
+        """עוצר את ה-flusher ועושה flush אחרון (לקרוא ב-shutdown של השרת)."""
+        _use_counts.shutdown()
 
     # -------------------------------------------------------
     # INTERNAL HELPERS
     # -------------------------------------------------------
+    @staticmethod
+    async def _run(run_bigquery_fn, sql: str):
+        if inspect.iscoroutinefunction(run_bigquery_fn):
+            return await run_bigquery_fn(sql)
+        return await run_blocking(run_bigquery_fn, sql)
+
+    def ensure_schema(self) -> bool:
+        """
+        מוסיף (פעם אחת בתהליך) את העמודות result_blob / result_format לטבלה.
+        נכשל (למשל בלי הרשאת ALTER) → ממשיכים בפורמט ה-JSON הישן.
+        """
+        with self._schema_lock:
+            if CacheService._blob_columns is None:
+                ddl = f"""
+                    ALTER TABLE `{self.project}.{self.dataset}.{self.table}`
+                    ADD COLUMN IF NOT EXISTS result_blob BYTES,
+                    ADD COLUMN IF NOT EXISTS result_format STRING
+                """
+                try:
+                    self.client.query(ddl).result()
+                    CacheService._blob_columns = True
+                except Exception:
+                    logger.exception("[CACHE] ensure_schema failed - falling back to JSON results")
+                    CacheService._blob_columns = False
+            return CacheService._blob_columns
+
     def _load_entry(self, intent_key: str):
         """טוען רשומה מלאה לפי intent_key."""
+        blob_columns = "result_blob, result_format," if self.ensure_schema() else ""
         query = f"""
-            SELECT intent_key, sql, result, last_updated, use_count
+            SELECT intent_key, sql, result, {blob_columns} last_updated, use_count
             FROM `{self.project}.{self.dataset}.{self.table}`
             WHERE intent_key = @key
             ORDER BY last_updated DESC
@@ -338,63 +632,92 @@ class CacheService:
 
         self.client.query(merge_sql, job_config=job_config).result()
 
-    def _update_use_count(self, intent_key: str, new_count: int):
+    def _flush_use_counts(self, increments: dict[str, int]):
         """
-        מעדכן רק use_count באופן אטומי.
+        כותב את כל ההגדלות הממתינות ב-MERGE אחד.
         בכוונה *לא* נוגע ב-last_updated, כדי ש-TTL יהיה לפי זמן חישוב ה-result,
         ולא לפי כמות הפעמים ששאלו.
         """
-        logger.info(f"[CACHE] Atomically incrementing use_count to {new_count} for key: {intent_key[:50]}...")
-        
-        # Use atomic increment to avoid race conditions
-        update_sql = f"""
-            UPDATE `{self.project}.{self.dataset}.{self.table}`
-            SET use_count = use_count + 1
-            WHERE intent_key = @key
+        logger.info(f"[CACHE] Flushing use_count increments for {len(increments)} keys")
+
+        merge_sql = f"""
+            MERGE `{self.project}.{self.dataset}.{self.table}` T
+            USING (SELECT intent_key, inc FROM UNNEST(@increments)) S
+            ON T.intent_key = S.intent_key
+            WHEN MATCHED THEN
+              UPDATE SET use_count = T.use_count + S.inc
         """
 
         job_config = bigquery.QueryJobConfig(
             query_parameters=[
-                bigquery.ScalarQueryParameter("key", "STRING", intent_key),
+                bigquery.ArrayQueryParameter(
+                    "increments",
+                    "STRUCT",
+                    [
+                        bigquery.StructQueryParameter(
+                            None,
+                            bigquery.ScalarQueryParameter("intent_key", "STRING", key),
+                            bigquery.ScalarQueryParameter("inc", "INT64", n),
+                        )
+                        for key, n in increments.items()
+                    ],
+                ),
             ]
         )
 
-        job = self.client.query(update_sql, job_config=job_config)
-        job.result()  # Wait for completion
-        
-        logger.info(f"[CACHE] Successfully incremented use_count")
+        self.client.query(merge_sql, job_config=job_config).result()
 
-    def _update_result(self, intent_key: str, result, sql: str, now: datetime, use_count: int):
-        """שומר את התוצאה בקאש (וגם מעדכן sql, last_updated, use_count)."""
-        json_string = json.dumps(result, ensure_ascii=False)
+    def _update_result(self, intent_key: str, result, sql: str, now: datetime):
+        """
+        שומר את התוצאה בקאש (וגם מעדכן sql, last_updated, use_count).
+        ההגדלות הממתינות של המפתח נכנסות לאותו UPDATE (+1 על השימוש הנוכחי),
+        כך שה-flusher לא יספור אותן פעם נוספת. UPDATE נכשל → הן חוזרות ל-buffer.
+        """
+        table = as_table(result)
+        increment = _use_counts.take(intent_key) + 1
+        try:
+            self._run_update_result(intent_key, table, sql, now, increment)
+        except Exception:
+            _use_counts.add(intent_key, increment)
+            raise
+
+    def _run_update_result(self, intent_key: str, table, sql: str, now: datetime, increment: int):
+        if self.ensure_schema():
+            # Arrow IPC דחוס ב-result_blob; result (JSON) מתאפס
+            blob, result_format = encode_result(table)
+            result_set = "result = NULL, result_blob = @blob, result_format = @fmt,"
+            result_params = [
+                bigquery.ScalarQueryParameter("blob", "BYTES", blob),
+                bigquery.ScalarQueryParameter("fmt", "STRING", result_format),
+            ]
+        else:
+            result_set = "result = @res,"
+            result_params = [
+                bigquery.ScalarQueryParameter("res", "STRING", table_to_json(table)),
+            ]
 
         update_sql = f"""
             UPDATE `{self.project}.{self.dataset}.{self.table}`
             SET
-                result = @res,
+                {result_set}
                 last_updated = @ts,
                 sql = @sql,
-                use_count = @cnt
+                use_count = use_count + @inc
             WHERE intent_key = @key
         """
 
         job_config = bigquery.QueryJobConfig(
             query_parameters=[
-                bigquery.ScalarQueryParameter("res", "STRING", json_string),
+                *result_params,
                 bigquery.ScalarQueryParameter("ts", "TIMESTAMP", now.isoformat()),
                 bigquery.ScalarQueryParameter("sql", "STRING", sql),
-                bigquery.ScalarQueryParameter("cnt", "INT64", use_count),
+                bigquery.ScalarQueryParameter("inc", "INT64", increment),
                 bigquery.ScalarQueryParameter("key", "STRING", intent_key),
             ]
         )
 
         self.client.query(update_sql, job_config=job_config).result()
 
-    # -------------------------------------------------------
-    def _make_json_safe(self, result_list):
-        from datetime import datetime as _dt
-
-        def fix(v):
-            return v.isoformat() if isinstance(v, _dt) else v
 
-        return [{k: fix(v) for k, v in row.items()} for row in result_list]
+_use_counts = UseCountBuffer(lambda increments: CacheService()._flush_use_counts(increments))
+atexit.register(_use_counts.shutdown)
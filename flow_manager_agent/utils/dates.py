@@ -0,0 +1,42 @@
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+
+import pytz
+
+TZ = pytz.timezone("Asia/Jerusalem")
+
+
+def today_local() -> date:
+    """התאריך הנוכחי לפי שעון ישראל."""
+    return datetime.now(TZ).date()
+
+
+@lru_cache(maxsize=4)
+def date_directive(today: date) -> str:
+    """
+    ה-SYSTEM DATE DIRECTIVE ל-NLU.
+    נבנה פעם אחת ליום (cache לפי התאריך), לא בכל בקשה.
+    """
+    yesterday = today - timedelta(days=1)
+    day_before = today - timedelta(days=2)
+
+    return f"""
+            # SYSTEM DATE DIRECTIVE — DO NOT IGNORE
+            Current real date: {today.strftime("%Y-%m-%d")}
+
+            Natural-language date mapping:
+            - "today" / "היום" → {today}
+            - "yesterday" / "אתמול" → {yesterday}
+            - "שלשום" → {day_before}
+
+            Dates without year (24.10, 25/10, 25.10):
+            → ALWAYS use year {today.year}.
+
+            If interpreted date is in the future → return future-date error.
+
+            # END OF DATE DIRECTIVE
+        """
+
+
+def current_date_directive() -> str:
+    return date_directive(today_local())
@@ -0,0 +1,283 @@
+"""
+Metrics של התהליך (בלי prometheus_client) + span לכל שלב של RootAgent.
+
+- start_trace() פותח trace לבקשה (contextvar), trace.stage("executor") פותח
+  span של שלב: משך + attributes שנרשמים בתוכו דרך record() / record_usage() /
+  record_bigquery() – model tokens, BigQuery bytes processed / billed,
+  slot_ms, cache_hit (של BigQuery) ו-from_cache (שלנו).
+- בסיום span: histograms / counters לפי stage; בסיום trace: שורת log אחת
+  ([TRACE]) עם כל ה-spans של הבקשה.
+- render_prometheus() → text exposition format (ל-/metrics ב-main.py).
+"""
+import contextvars
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+BYTES_BUCKETS = (0, 1024 ** 2, 10 * 1024 ** 2, 100 * 1024 ** 2, 1024 ** 3, 10 * 1024 ** 3, 100 * 1024 ** 3)
+SLOT_MS_BUCKETS = (10, 100, 1000, 10_000, 100_000, 1_000_000)
+TOKEN_BUCKETS = (100, 500, 1000, 2000, 5000, 10_000, 50_000)
+
+_INF = 'le="+Inf"'
+
+
+# ============================================================
+# Counter / Histogram
+# ============================================================
+def _label_key(labelnames: tuple, labels: dict) -> tuple:
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+
+def _format_labels(labelnames: tuple, key: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, key)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = dict(self._values)
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in sorted(values.items())
+        ]
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = DURATION_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        # key -> [counts per bucket..., sum, count]
+        self._values: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            state = self._values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = {key: list(state) for key, state in self._values.items()}
+        lines = []
+        for key, state in sorted(values.items()):
+            for bound, count in zip(self.buckets, state):
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, _INF)} {state[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(state[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {state[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: list = []
+
+    def counter(self, name: str, help_text: str, labelnames: tuple = ()) -> Counter:
+        metric = Counter(name, help_text, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, labelnames: tuple = (),
+                  buckets: tuple = DURATION_BUCKETS) -> Histogram:
+        metric = Histogram(name, help_text, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+REQUEST_DURATION = registry.histogram(
+    "appsflyer_request_duration_seconds", "RootAgent turn duration.", ("outcome",))
+STAGE_DURATION = registry.histogram(
+    "appsflyer_stage_duration_seconds", "Duration of a RootAgent stage.", ("stage",))
+MODEL_CALLS = registry.counter(
+    "appsflyer_model_calls_total", "Model responses with usage metadata.", ("stage",))
+MODEL_TOKENS = registry.counter(
+    "appsflyer_model_tokens_total", "Model tokens by stage and kind.", ("stage", "kind"))
+STAGE_MODEL_TOKENS = registry.histogram(
+    "appsflyer_stage_model_tokens", "Model tokens (prompt + output) per stage run.", ("stage",),
+    TOKEN_BUCKETS)
+BQ_QUERIES = registry.counter(
+    "appsflyer_bq_queries_total", "BigQuery jobs by stage and BigQuery cache_hit.", ("stage", "cache_hit"))
+BQ_BYTES_PROCESSED = registry.histogram(
+    "appsflyer_bq_bytes_processed", "Bytes processed per BigQuery job.", ("stage",), BYTES_BUCKETS)
+BQ_BYTES_BILLED = registry.histogram(
+    "appsflyer_bq_bytes_billed", "Bytes billed per BigQuery job.", ("stage",), BYTES_BUCKETS)
+BQ_SLOT_MS = registry.histogram(
+    "appsflyer_bq_slot_ms", "Slot milliseconds per BigQuery job.", ("stage",), SLOT_MS_BUCKETS)
+QUERY_RESULTS = registry.counter(
+    "appsflyer_query_results_total", "Executor results by source and from_cache.",
+    ("stage", "source", "from_cache"))
+
+
+def render_prometheus() -> str:
+    return registry.render()
+
+
+# ============================================================
+# Trace / spans
+# ============================================================
+class Span:
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.started = time.perf_counter()
+        self.duration = None
+        self.attributes: dict = {}
+
+    def add(self, key: str, value):
+        """מספרים מצטברים (כמה קריאות מודל / jobs באותו שלב); השאר נדרס."""
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            self.attributes[key] = self.attributes.get(key, 0) + value
+        else:
+            self.attributes[key] = value
+
+    def to_dict(self) -> dict:
+        return {"stage": self.stage, "ms": round((self.duration or 0) * 1000, 1), **self.attributes}
+
+
+class Trace:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans: list[Span] = []
+        self._stack: list[Span] = []
+        self.outcome = "ok"
+
+    @contextmanager
+    def stage(self, name: str):
+        span = Span(name)
+        self.spans.append(span)
+        self._stack.append(span)
+        try:
+            yield span
+        finally:
+            span.duration = time.perf_counter() - span.started
+            if self._stack and self._stack[-1] is span:
+                self._stack.pop()
+            STAGE_DURATION.observe(span.duration, stage=name)
+            tokens = span.attributes.get("prompt_tokens", 0) + span.attributes.get("output_tokens", 0)
+            if tokens:
+                STAGE_MODEL_TOKENS.observe(tokens, stage=name)
+
+    @property
+    def current(self) -> Span | None:
+        return self._stack[-1] if self._stack else None
+
+    def finish(self, outcome: str | None = None):
+        self.outcome = outcome or self.outcome
+        duration = time.perf_counter() - self.started
+        REQUEST_DURATION.observe(duration, outcome=self.outcome)
+        logger.info("[TRACE] %s", json.dumps({
+            "ms": round(duration * 1000, 1),
+            "outcome": self.outcome,
+            "spans": [span.to_dict() for span in self.spans],
+        }, default=str))
+
+
+_current_trace: contextvars.ContextVar[Trace | None] = contextvars.ContextVar("metrics_trace", default=None)
+
+
+def start_trace() -> Trace:
+    """trace חדש לתור הנוכחי (tasks שנוצרים ממנו רואים את אותו אובייקט)."""
+    trace = Trace()
+    _current_trace.set(trace)
+    return trace
+
+
+def current_stage() -> str:
+    trace = _current_trace.get()
+    span = trace.current if trace else None
+    return span.stage if span else "none"
+
+
+def record(**attributes):
+    """attributes ל-span הנוכחי (בלי trace פעיל – no-op)."""
+    trace = _current_trace.get()
+    span = trace.current if trace else None
+    if span is None:
+        return
+    for key, value in attributes.items():
+        span.add(key, value)
+
+
+def record_usage(event):
+    """usage_metadata של תשובת מודל (Event / LlmResponse) → tokens לפי stage."""
+    usage = getattr(event, "usage_metadata", None)
+    if usage is None or getattr(event, "partial", False):
+        return
+    prompt = usage.prompt_token_count or 0
+    output = usage.candidates_token_count or 0
+    stage = current_stage()
+    MODEL_CALLS.inc(stage=stage)
+    MODEL_TOKENS.inc(prompt, stage=stage, kind="prompt")
+    MODEL_TOKENS.inc(output, stage=stage, kind="output")
+    record(model_calls=1, prompt_tokens=prompt, output_tokens=output)
+
+
+def record_bigquery(job_stats: dict):
+    """BQClient.job_stats(job) → histograms + ה-span הנוכחי."""
+    stage = current_stage()
+    processed = job_stats.get("total_bytes_processed") or 0
+    billed = job_stats.get("total_bytes_billed") or 0
+    slot_ms = job_stats.get("slot_ms") or 0
+    cache_hit = bool(job_stats.get("cache_hit"))
+
+    BQ_QUERIES.inc(stage=stage, cache_hit=str(cache_hit).lower())
+    BQ_BYTES_PROCESSED.observe(processed, stage=stage)
+    BQ_BYTES_BILLED.observe(billed, stage=stage)
+    BQ_SLOT_MS.observe(slot_ms, stage=stage)
+    record(bq_jobs=1, bytes_processed=processed, bytes_billed=billed, slot_ms=slot_ms,
+           bq_cache_hit=cache_hit)
+
+
+def record_result(source: str, from_cache: bool):
+    """מאיפה הגיעה תוצאת ה-executor: backend / cache / cube / preview."""
+    QUERY_RESULTS.inc(stage=current_stage(), source=source, from_cache=str(from_cache).lower())
+    record(result_source=source, from_cache=from_cache)
@@ -0,0 +1,59 @@
+"""
+קידוד התוצאות שנשמרות ב-L2 (practicode-2025.cache.cached_queries).
+
+פורמט נוכחי: Arrow IPC stream דחוס (zstd) בעמודת result_blob (BYTES),
+והגרסה בעמודת result_format. רשומות ישנות (JSON בעמודת result)
+עדיין נקראות – כך שאין צורך במיגרציה של הטבלה הקיימת.
+"""
+import json
+import os
+
+import pyarrow as pa
+
+from AppsFlyerAgent.flow_manager_agent.utils.arrow_utils import rows_to_table
+
+RESULT_FORMAT_ARROW_IPC = "arrow_ipc_v1"
+
+# codec של ה-IPC (zstd / lz4 / none); codec שלא זמין ב-pyarrow → בלי דחיסה
+CACHE_RESULT_COMPRESSION = os.getenv("CACHE_RESULT_COMPRESSION", "zstd")
+
+
+def _write_options() -> pa.ipc.IpcWriteOptions:
+    codec = CACHE_RESULT_COMPRESSION
+    if not codec or codec == "none" or not pa.Codec.is_available(codec):
+        codec = None
+    return pa.ipc.IpcWriteOptions(compression=codec)
+
+
+def encode_result(table: pa.Table) -> tuple[bytes, str]:
+    """pyarrow.Table → (bytes ל-result_blob, result_format)."""
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema, options=_write_options()) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes(), RESULT_FORMAT_ARROW_IPC
+
+
+def decode_result(blob: bytes | None, result_format: str | None,
+                  result_json: str | None = None) -> pa.Table | None:
+    """
+    (result_blob, result_format, result) → pyarrow.Table, או None אם אין תוצאה.
+    פורמט לא מוכר → ValueError (הקורא מחשב מחדש).
+    """
+    if blob:
+        if result_format != RESULT_FORMAT_ARROW_IPC:
+            raise ValueError(f"Unknown cached result format: {result_format!r}")
+        return pa.ipc.open_stream(pa.py_buffer(blob)).read_all()
+
+    if result_json:
+        return rows_to_table(json.loads(result_json))
+
+    return None
+
+
+def entry_has_result(entry: dict) -> bool:
+    return bool(entry.get("result_blob") or entry.get("result"))
+
+
+def decode_entry(entry: dict) -> pa.Table | None:
+    """רשומה מ-_load_entry → pyarrow.Table (blob קודם, אחרת JSON ישן)."""
+    return decode_result(entry.get("result_blob"), entry.get("result_format"), entry.get("result"))
@@ -0,0 +1,179 @@
+"""
+סיכום מקומי של תוצאת שאילתה לפני ה-LLM.
+
+במקום לשלוח את כל טבלת ה-markdown ולבקש מהמודל לחשב סטטיסטיקות,
+מחשבים כאן (pyarrow.compute, על כל השורות) את המספרים עצמם:
+row count, total/min/max/mean לכל metric, top-k / bottom-k עם share of total
+לכל dimension, ומגמה לפי שעה. לצד זה נשלחת דגימת שורות שנכנסת
+בתקציב ה-tokens (RESULT_TOKEN_BUDGET).
+"""
+import json
+import os
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from AppsFlyerAgent.flow_manager_agent.utils.arrow_utils import table_to_markdown
+
+# תקציב ה-tokens של summary + דגימה (הערכה גסה: ~4 תווים ל-token)
+RESULT_TOKEN_BUDGET = int(os.getenv("RESULT_TOKEN_BUDGET", "1500"))
+RESULT_TOP_K = int(os.getenv("RESULT_TOP_K", "5"))
+RESULT_SAMPLE_MAX_ROWS = int(os.getenv("RESULT_SAMPLE_MAX_ROWS", "50"))
+
+CHARS_PER_TOKEN = 4
+
+# עמודות מספריות שהן שעה ולא metric
+HOUR_COLUMNS = ("hr", "event_hour", "hour")
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+# ============================================================
+# Public API
+# ============================================================
+def summarize_for_llm(table: pa.Table, token_budget: int = RESULT_TOKEN_BUDGET) -> dict:
+    """
+    מחזיר את השדות ל-execution_result:
+        {"summary": {...}, "result": "<markdown של הדגימה>",
+         "sample_rows": N, "result_truncated": bool}
+    """
+    summary = summarize_table(table)
+    summary_chars = len(json.dumps(summary, ensure_ascii=False, default=str))
+    sample_chars = token_budget * CHARS_PER_TOKEN - summary_chars
+
+    markdown, sample_rows = _sample_markdown(table, sample_chars)
+    return {
+        "summary": summary,
+        "result": markdown,
+        "sample_rows": sample_rows,
+        "result_truncated": sample_rows < table.num_rows,
+    }
+
+
+def summarize_table(table: pa.Table, top_k: int = RESULT_TOP_K) -> dict:
+    metrics, dimensions, hour_column = _classify_columns(table)
+
+    summary = {
+        "row_count": table.num_rows,
+        "columns": {name: str(table.schema.field(name).type) for name in table.column_names},
+    }
+    if table.num_rows == 0:
+        return summary
+
+    summary["metrics"] = {name: _metric_stats(table[name]) for name in metrics}
+
+    if metrics:
+        # ה-breakdowns וה-trend לפי ה-metric הראשון (total_events אצלנו)
+        main = metrics[0]
+        total = summary["metrics"][main]["total"]
+        summary["breakdowns"] = {
+            name: _breakdown(table, name, main, total, top_k) for name in dimensions
+        }
+        if hour_column:
+            summary["hour_trend"] = _hour_trend(table, hour_column, main)
+
+    return summary
+
+
+# ============================================================
+# Helpers
+# ============================================================
+def _classify_columns(table: pa.Table):
+    metrics, dimensions, hour_column = [], [], None
+    for field in table.schema:
+        kind = field.type
+        if field.name in HOUR_COLUMNS and pa.types.is_integer(kind):
+            hour_column = hour_column or field.name
+        elif pa.types.is_integer(kind) or pa.types.is_floating(kind) or pa.types.is_decimal(kind):
+            metrics.append(field.name)
+        elif pa.types.is_string(kind) or pa.types.is_large_string(kind) or pa.types.is_boolean(kind):
+            dimensions.append(field.name)
+    return metrics, dimensions, hour_column
+
+
+def _numeric(column: pa.ChunkedArray) -> pa.ChunkedArray:
+    return pc.cast(column, pa.float64()) if pa.types.is_decimal(column.type) else column
+
+
+def _round(value):
+    return round(value, 2) if isinstance(value, float) else value
+
+
+def _metric_stats(column: pa.ChunkedArray) -> dict:
+    column = _numeric(column)
+    min_max = pc.min_max(column)
+    return {
+        "total": _round(pc.sum(column).as_py()),
+        "min": _round(min_max["min"].as_py()),
+        "max": _round(min_max["max"].as_py()),
+        "mean": _round(pc.mean(column).as_py()),
+        "nulls": column.null_count,
+    }
+
+
+def _grouped(table: pa.Table, key: str, metric: str) -> pa.Table:
+    """סכום ה-metric לכל ערך של key (עמודות: key, f"{metric}_sum")."""
+    return table.select([key, metric]).group_by(key).aggregate([(metric, "sum")])
+
+
+def _entries(grouped: pa.Table, key: str, value: str, total) -> list[dict]:
+    keys = grouped[key].to_pylist()
+    values = _numeric(grouped[value]).to_pylist()
+    return [
+        {
+            key: k,
+            "value": _round(v),
+            "share": round(v / total, 4) if total and v is not None else None,
+        }
+        for k, v in zip(keys, values)
+    ]
+
+
+def _breakdown(table: pa.Table, dimension: str, metric: str, total, top_k: int) -> dict:
+    value = f"{metric}_sum"
+    grouped = _grouped(table, dimension, metric)
+    ordered = grouped.sort_by([(value, "descending")])
+
+    breakdown = {
+        "distinct": grouped.num_rows,
+        "top": _entries(ordered.slice(0, top_k), dimension, value, total),
+    }
+    if grouped.num_rows > top_k:
+        bottom = grouped.sort_by([(value, "ascending")]).slice(0, top_k)
+        breakdown["bottom"] = _entries(bottom, dimension, value, total)
+    return breakdown
+
+
+def _hour_trend(table: pa.Table, hour_column: str, metric: str) -> dict:
+    value = f"{metric}_sum"
+    grouped = _grouped(table, hour_column, metric).sort_by([(hour_column, "ascending")])
+
+    hours = grouped[hour_column].to_pylist()
+    values = [_round(v) for v in _numeric(grouped[value]).to_pylist()]
+    by_hour = [[h, v] for h, v in zip(hours, values) if h is not None and v is not None]
+    if not by_hour:
+        return {}
+
+    peak = max(by_hour, key=lambda item: item[1])
+    low = min(by_hour, key=lambda item: item[1])
+    return {
+        "by_hour": by_hour,
+        "peak_hour": peak[0],
+        "peak_value": peak[1],
+        "low_hour": low[0],
+        "low_value": low[1],
+    }
+
+
+def _sample_markdown(table: pa.Table, max_chars: int) -> tuple[str, int]:
+    """markdown של השורות הראשונות – כמה שנכנס ב-max_chars (עד RESULT_SAMPLE_MAX_ROWS)."""
+    rows = min(table.num_rows, RESULT_SAMPLE_MAX_ROWS)
+    while rows > 0:
+        markdown = table_to_markdown(table, max_rows=rows)
+        if len(markdown) <= max_chars:
+            return markdown, rows
+        # אורך ה-markdown בערך לינארי במספר השורות
+        rows = min(rows - 1, int(rows * max_chars / len(markdown)))
+    return "", 0
@@ -26,6 +26,13 @@ const formatHour = (v: any) => {
   return s;
 };
 
+// אותה תווית כמו chart_data["hour"] של anomaly_agent: "2025-10-14 10:00" / "10"
+const anomalyLabel = (a: Anomaly) => {
+  if (a.event_hour === null || a.event_hour === undefined || a.event_hour === "") return "";
+  if (!a.event_date) return String(a.event_hour);
+  return `${a.event_date} ${String(a.event_hour).padStart(2, "0")}:00`;
+};
+
 // Custom Tooltip מעוצב
 const CustomTooltip = ({ active, payload, label }: any) => {
   if (!active || !payload || !payload.length) return null;
@@ -138,7 +145,7 @@ const AnomalyChart: React.FC<Props> = ({ data = [], anomalies = [], config = {}
           {anomalies.map((a, i) => (
             <ReferenceDot
               key={i}
-              x={String(a.event_hour ?? "")}
+              x={anomalyLabel(a)}
               y={a.clicks ?? 0}
               r={8}
               stroke={a.anomaly_type === "click_spike" ? "#fc8181" : "#4fd1c5"}
@@ -4,6 +4,7 @@ import AnomalyChart from "./AnomalyChart";
 export type Anomaly = {
   name: string;
   anomaly_type: string;
+  event_date?: string | null;
   event_hour?: string | number | null;
   clicks?: number | null;
   avg_clicks?: number | null;
@@ -6,6 +6,27 @@ import "../styles/chat.css";
 type Message = {
     role: "user" | "assistant";
     content: any;
+    streaming?: boolean;
+};
+
+type StreamEvent =
+    | { type: "stage"; stage: string }
+    | { type: "delta"; text: string }
+    | { type: "message"; text: string }
+    | { type: "component"; payload: any }
+    | { type: "error"; message: string }
+    | { type: "done" };
+
+/* ===== תוויות לשלבי ה-pipeline (stage markers מה-stream) ===== */
+const STAGE_LABELS: Record<string, string> = {
+    intent_analyzer_agent: "מנתח את השאלה...",
+    protected_query_builder_agent: "בונה שאילתה...",
+    query_executor_agent: "מריץ שאילתה...",
+    anomaly_agent: "מחפש חריגות...",
+    react_visual_agent: "מכין גרף...",
+    response_insights_agent: "מנתח תוצאות...",
+    insights_response_agent: "מכין תשובה...",
+    human_response_agent: "מכין תשובה...",
 };
 
 /* ===== Input אחיד לרוחב ההודעות ===== */
@@ -43,7 +64,10 @@ export const Chat = () => {
     const [messages, setMessages] = useState<Message[]>([]);
     const [input, setInput] = useState("");
     const [isLoading, setIsLoading] = useState(false);
+    const [stage, setStage] = useState<string | null>(null);
     const messagesEndRef = useRef<HTMLDivElement>(null);
+    // session_id שהשרת מחזיר ב-X-Session-Id – נשלח בכל הודעה בהמשך
+    const sessionIdRef = useRef<string | null>(null);
 
     const isEmpty = messages.length === 0;
 
@@ -62,26 +86,83 @@ export const Chat = () => {
         setIsLoading(true);
 
         try {
-            const res = await fetch("http://localhost:8000/chat", {
+            const res = await fetch("http://localhost:8000/chat/stream", {
                 method: "POST",
                 headers: { "Content-Type": "application/json" },
-                body: JSON.stringify({ message: userMsg.content })
+                body: JSON.stringify({
+                    message: userMsg.content,
+                    session_id: sessionIdRef.current
+                })
             });
 
-            const data = await res.json();
+            sessionIdRef.current = res.headers.get("X-Session-Id") ?? sessionIdRef.current;
 
-            let content = data;
-            if (typeof data === "string" && data.startsWith("__REACT_COMPONENT__")) {
-                try {
-                    content = JSON.parse(
-                        data.substring("__REACT_COMPONENT__".length)
-                    );
-                } catch { }
-            }
+            if (!res.body) return;
+
+            // קריאת ה-SSE: כל אירוע הוא "data: {...}" ואחריו שורה ריקה
+            const reader = res.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = "";
+
+            while (true) {
+                const { done, value } = await reader.read();
+                if (done) break;
 
-            setMessages(prev => [...prev, { role: "assistant", content }]);
+                buffer += decoder.decode(value, { stream: true });
+                const chunks = buffer.split("\n\n");
+                buffer = chunks.pop() ?? "";
+
+                for (const chunk of chunks) {
+                    const line = chunk.split("\n").find(l => l.startsWith("data: "));
+                    if (!line) continue;
+                    try {
+                        handleStreamEvent(JSON.parse(line.substring("data: ".length)));
+                    } catch { }
+                }
+            }
         } finally {
+            setStage(null);
             setIsLoading(false);
+            // ההודעה האחרונה כבר לא ב-streaming
+            setMessages(prev => prev.map(m => (m.streaming ? { ...m, streaming: false } : m)));
+        }
+    }
+
+    function handleStreamEvent(event: StreamEvent) {
+        switch (event.type) {
+            case "stage":
+                setStage(STAGE_LABELS[event.stage] ?? null);
+                break;
+
+            case "delta":
+                // טקסט חלקי – מצטרף לבועה שבהזרמה (או פותח אחת חדשה)
+                setMessages(prev => {
+                    const last = prev[prev.length - 1];
+                    if (last?.streaming) {
+                        return [...prev.slice(0, -1), { ...last, content: last.content + event.text }];
+                    }
+                    return [...prev, { role: "assistant", content: event.text, streaming: true }];
+                });
+                break;
+
+            case "message":
+                // טקסט סופי – מחליף את הבועה שבהזרמה
+                setMessages(prev => {
+                    const last = prev[prev.length - 1];
+                    if (last?.streaming) {
+                        return [...prev.slice(0, -1), { role: "assistant", content: event.text }];
+                    }
+                    return [...prev, { role: "assistant", content: event.text }];
+                });
+                break;
+
+            case "component":
+                setMessages(prev => [...prev, { role: "assistant", content: event.payload }]);
+                break;
+
+            case "error":
+                setMessages(prev => [...prev, { role: "assistant", content: event.message }]);
+                break;
         }
     }
 
@@ -136,10 +217,11 @@ export const Chat = () => {
                                     </div>
                                 ))}
 
-                                {isLoading && (
+                                {isLoading && !messages[messages.length - 1]?.streaming && (
                                     <div className="chat-message assistant">
                                         <div className="bubble">
                                             <TypingLoader />
+                                            {stage && <div className="stage-label">{stage}</div>}
                                         </div>
                                     </div>
                                 )}
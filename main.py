@@ -1,16 +1,26 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
 from AppsFlyerAgent.flow_manager_agent.agent import root_agent
-from AppsFlyerAgent.bq import BQClient
+from AppsFlyerAgent.bq import get_bq_client, get_bq_pool_stats, close_bq_clients
+from AppsFlyerAgent.chat_history import chat_history
+from AppsFlyerAgent.execution_backend import get_execution_backend, start_local_sync, stop_local_sync
+from AppsFlyerAgent.olap_cube import cube_service
+from AppsFlyerAgent.flow_manager_agent.utils.cache import CacheService
+from AppsFlyerAgent.flow_manager_agent.utils.metrics import render_prometheus
+from AppsFlyerAgent.flow_manager_agent.sub_agents.intent_analyzer_agent import fast_path_stats, memo_stats
+from AppsFlyerAgent.flow_manager_agent.sub_agents.protected_query_builder_agent import rollup_refresher, rollup_registry
+from AppsFlyerAgent.session_manager import BoundedInMemorySessionService, SessionManager
+from google.adk.agents.run_config import RunConfig, StreamingMode
 from google.adk.apps import App
 from google.adk.runners import Runner
-from google.adk.sessions.in_memory_session_service import InMemorySessionService
 from google.genai import types
 from google.adk.utils.context_utils import Aclosing
-import uuid
-import logging
+import asyncio
+import json
+import os
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -25,70 +35,161 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Session-Id"],
 )
 
 # ---- יצירת ADK App ו-Runner ----
 adk_app = App(name="appsflyer_agent", root_agent=root_agent)
-session_service = InMemorySessionService()
+session_service = BoundedInMemorySessionService()
 runner = Runner(
     app=adk_app,
     session_service=session_service,
 )
 
-# קבועים למזהים
-USER_ID = "default_user"
-SESSION_ID = "default_session"
+# session נפרד לכל לקוח (היסטוריה חסומה, פינוי sessions לא פעילים)
+session_manager = SessionManager(session_service, app_name=adk_app.name)
+
+# ברירת מחדל כשהלקוח לא שולח user_id
+DEFAULT_USER_ID = "default_user"
+
+# timeout לבקשת צ'אט אחת (כולל כל ה-pipeline); בחריגה ה-task מבוטל
+# ואיתו גם ה-job של BigQuery שרץ באותו רגע
+CHAT_REQUEST_TIMEOUT_SECONDS = float(os.getenv("CHAT_REQUEST_TIMEOUT_SECONDS", "180"))
 
-# ---- אתחול BigQuery ----
+# streaming: agents שהפלט שלהם פנימי (JSON) – ללקוח נשלח רק stage marker
+INTERNAL_AUTHORS = {
+    "intent_analyzer_agent",
+    "protected_query_builder_agent",
+    "query_executor_agent",
+    "response_insights_agent",
+    "insights_response_llm",
+}
+REACT_COMPONENT_PREFIX = "__REACT_COMPONENT__"
+
+# ---- טבלת היסטוריית הצ'אט (הכתיבה עצמה ב-batches ברקע) ----
 try:
-    bq_client = BQClient()
-    bq_client.ensure_chat_history_table()
-    logger.info("BigQuery chat history table ready")
+    chat_history.ensure_table()
 except Exception as e:
-    logger.warning(f"Failed to initialize BigQuery: {e}")
-    bq_client = None
+    logger.warning(f"Failed to prepare chat history table: {e}")
+
+# ---- סכמת טבלת ה-cache (result_blob / result_format) ----
+try:
+    CacheService().ensure_schema()
+except Exception as e:
+    logger.warning(f"Failed to prepare query cache schema: {e}")
+
+# ---- זמינות ה-rollups המנוהלים (טבלאות שכבר נוצרו ב-dataset) ----
+try:
+    rollup_registry.refresh_from_bigquery(get_bq_client().bq_client)
+except Exception as e:
+    logger.warning(f"Failed to load rollup availability: {e}")
 
 # ---- בדיקת חיים ----
 @app.get("/health")
 def health():
     return {"ok": True}
 
+
+# ---- Prometheus: latency / tokens / BigQuery bytes לפי שלב ----
+@app.get("/metrics")
+def metrics():
+    return Response(content=render_prometheus(), media_type="text/plain; version=0.0.4")
+
+
+# ---- סטטיסטיקות BigQuery client pool ----
+@app.get("/bq/pool")
+def bq_pool():
+    return get_bq_pool_stats()
+
+
+# ---- סטטיסטיקות L1 query cache ----
+@app.get("/cache/stats")
+def cache_stats():
+    return {"l1": CacheService.l1_stats(), "use_count": CacheService.use_count_stats()}
+
+
+# ---- סטטיסטיקות NLU fast path ----
+@app.get("/nlu/stats")
+def nlu_stats():
+    return {"fast_path": fast_path_stats.stats(), "memo": memo_stats()}
+
+
+# ---- execution backend (bigquery / duckdb / hybrid) ----
+@app.get("/backend/stats")
+def backend_stats():
+    return get_execution_backend().stats()
+
+
+# ---- chat history writer: תור / נכתבו / נזרקו ----
+@app.get("/chat_history/stats")
+def chat_history_stats():
+    return chat_history.stats()
+
+
+# ---- OLAP cube (hourly rollups בזיכרון) ----
+@app.get("/cube/stats")
+def cube_stats():
+    return cube_service.stats()
+
+
+# ---- rollups: grain / dimensions / זמינות ----
+@app.get("/rollups")
+def rollups():
+    return rollup_registry.stats()
+
+
+# ---- סטטיסטיקות sessions ----
+@app.get("/sessions/stats")
+def sessions_stats():
+    return session_manager.stats()
+
+
+@app.on_event("startup")
+async def _start_cube():
+    # טעינה ראשונה + refresh אינקרמנטלי ברקע (לא חוסם את ה-startup)
+    cube_service.start()
+    # duckdb / hybrid: sync תקופתי של הימים האחרונים ל-Parquet מקומי
+    start_local_sync()
+    # managed rollups: refresh יומי של הימים האחרונים + watermark
+    rollup_refresher.start()
+
+
+@app.on_event("shutdown")
+async def _close_bq():
+    # קודם עוצרים את ה-refresh של ה-cube, flush של use_count והיסטוריית הצ'אט
+    # שממתינים, ואז סגירת ה-clients
+    await cube_service.stop()
+    await stop_local_sync()
+    await rollup_refresher.stop()
+    CacheService.shutdown()
+    chat_history.shutdown()
+    close_bq_clients()
+
 # ---- Request schema ----
 class ChatRequest(BaseModel):
     message: str
+    session_id: str | None = None
+    user_id: str | None = None
 
 
 # ---- Helper: run agent ----
-async def run_agent(message: str):
-    # יצירת session אם לא קיים
-    session = await session_service.get_session(
-        app_name=adk_app.name,
-        user_id=USER_ID,
-        session_id=SESSION_ID
-    )
-    
-    if not session:
-        session = await session_service.create_session(
-            app_name=adk_app.name,
-            user_id=USER_ID,
-            session_id=SESSION_ID
-        )
-    
+async def run_agent(message: str, user_id: str, session_id: str):
     # יצירת תוכן ההודעה
     content = types.Content(role='user', parts=[types.Part(text=message)])
     
     last_event = None
     
-    # הרצת האגנט
-    async with Aclosing(
-        runner.run_async(
-            user_id=USER_ID,
-            session_id=SESSION_ID,
-            new_message=content
-        )
-    ) as agen:
-        async for event in agen:
-            last_event = event
+    # הרצת האגנט (ה-session נוצר / ננעל ע"י session_manager)
+    async with session_manager.turn(user_id, session_id):
+        async with Aclosing(
+            runner.run_async(
+                user_id=user_id,
+                session_id=session_id,
+                new_message=content
+            )
+        ) as agen:
+            async for event in agen:
+                last_event = event
 
     if not last_event:
         return {"error": "No response from agent"}
@@ -107,38 +208,144 @@ async def run_agent(message: str):
     return {"error": "Unknown agent response"}
 
 
-# ---- API endpoint ----
-@app.post("/chat")
-async def chat(req: ChatRequest):
+# ---- Helper: stream agent (SSE) ----
+def _sse(payload: dict) -> str:
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+def _event_text(event) -> str:
+    if not event.content or not event.content.parts:
+        return ""
+    return "".join(part.text or "" for part in event.content.parts)
+
+
+async def stream_agent(message: str, user_id: str, session_id: str):
+    """
+    מריץ את האגנט ב-StreamingMode.SSE ומעביר ללקוח אירועים ברגע שהם מגיעים:
+      {"type": "stage", "stage": "<agent>"}      – מעבר לשלב חדש ב-pipeline
+      {"type": "delta", "text": "..."}           – טקסט חלקי מהמודל
+      {"type": "message", "text": "..."}         – טקסט סופי של שלב
+      {"type": "component", "payload": {...}}    – __REACT_COMPONENT__ מ-react_visual_agent
+      {"type": "error", "message": "..."} / {"type": "done"}
+
+    אותו deadline כמו /chat (CHAT_REQUEST_TIMEOUT_SECONDS). הריצה עצמה היא
+    task נפרד שכותב לתור – כך הביטול (ואיתו ה-job של BigQuery) תופס גם
+    כשה-generator עומד על yield; בחריגה נשלח {"type": "error"}.
+    ניתוק הלקוח → ה-task מבוטל גם הוא.
+    """
+    chat_history.add(session_id, user_id, "user", message)
+
+    queue: asyncio.Queue = asyncio.Queue()
+    producer = asyncio.create_task(_produce_stream(message, user_id, session_id, queue))
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + CHAT_REQUEST_TIMEOUT_SECONDS
+
     try:
-        # שמירת הודעת המשתמש
-        if bq_client:
+        while True:
             try:
-                bq_client.save_chat_message(
-                    session_id=SESSION_ID,
-                    user_id=USER_ID,
-                    role="user",
-                    message=req.message
+                payload = await asyncio.wait_for(queue.get(), timeout=max(deadline - loop.time(), 0))
+            except asyncio.TimeoutError:
+                producer.cancel()
+                logger.warning(f"Streaming agent run timed out after {CHAT_REQUEST_TIMEOUT_SECONDS:.0f}s")
+                yield _sse({"type": "error", "message": "Agent timed out"})
+                break
+            if payload is None:
+                break
+            yield _sse(payload)
+    finally:
+        if not producer.done():
+            producer.cancel()
+
+    yield _sse({"type": "done"})
+
+
+async def _produce_stream(message: str, user_id: str, session_id: str, queue: asyncio.Queue):
+    """ריצת האגנט: payloads ל-queue, None בסוף."""
+    content = types.Content(role='user', parts=[types.Part(text=message)])
+    run_config = RunConfig(streaming_mode=StreamingMode.SSE)
+    current_stage = None
+    final_text = None
+
+    try:
+        async with session_manager.turn(user_id, session_id):
+            async with Aclosing(
+                runner.run_async(
+                    user_id=user_id,
+                    session_id=session_id,
+                    new_message=content,
+                    run_config=run_config,
                 )
-            except Exception as e:
-                logger.error(f"Failed to save user message: {e}")
+            ) as agen:
+                async for event in agen:
+                    if event.author and event.author != current_stage:
+                        current_stage = event.author
+                        queue.put_nowait({"type": "stage", "stage": current_stage})
+
+                    if event.author in INTERNAL_AUTHORS:
+                        continue
+
+                    text = _event_text(event)
+                    if not text:
+                        continue
+
+                    if event.partial:
+                        queue.put_nowait({"type": "delta", "text": text})
+                    elif text.startswith(REACT_COMPONENT_PREFIX):
+                        try:
+                            payload = json.loads(text[len(REACT_COMPONENT_PREFIX):])
+                        except json.JSONDecodeError:
+                            continue
+                        queue.put_nowait({"type": "component", "payload": payload})
+                    else:
+                        final_text = text
+                        queue.put_nowait({"type": "message", "text": text})
+    except Exception as e:
+        logger.exception("Streaming agent run failed")
+        queue.put_nowait({"type": "error", "message": str(e)})
+
+    if final_text is not None:
+        chat_history.add(session_id, user_id, "assistant", final_text)
+
+    queue.put_nowait(None)
+
+
+# ---- API endpoint ----
+@app.post("/chat/stream")
+async def chat_stream(req: ChatRequest):
+    user_id = req.user_id or DEFAULT_USER_ID
+    session_id = req.session_id or session_manager.new_session_id()
+
+    return StreamingResponse(
+        stream_agent(req.message, user_id, session_id),
+        media_type="text/event-stream",
+        headers={"X-Session-Id": session_id, "Cache-Control": "no-cache"},
+    )
+
+
+@app.post("/chat")
+async def chat(req: ChatRequest, http_response: Response):
+    user_id = req.user_id or DEFAULT_USER_ID
+    session_id = req.session_id or session_manager.new_session_id()
+    http_response.headers["X-Session-Id"] = session_id
+
+    try:
+        # שמירת הודעת המשתמש (לתור – נכתבת ברקע)
+        chat_history.add(session_id, user_id, "user", req.message)
         
         # הרצת האגנט
-        response = await run_agent(req.message)
+        try:
+            response = await asyncio.wait_for(
+                run_agent(req.message, user_id, session_id), timeout=CHAT_REQUEST_TIMEOUT_SECONDS
+            )
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=504, detail="Agent timed out")
         
         # שמירת תשובת האגנט
-        if bq_client:
-            try:
-                bq_client.save_chat_message(
-                    session_id=SESSION_ID,
-                    user_id=USER_ID,
-                    role="assistant",
-                    message=str(response)
-                )
-            except Exception as e:
-                logger.error(f"Failed to save assistant message: {e}")
+        chat_history.add(session_id, user_id, "assistant", str(response))
         
         return response
+    except HTTPException:
+        raise
     except Exception as e:
         import traceback
         traceback.print_exc()  # 👈 זה מה שחשוב עכשיו
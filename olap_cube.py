@@ -0,0 +1,415 @@
+"""
+OLAP cube בזיכרון מעל ה-hourly rollups: date × hr × key.
+
+לכל rollup עם dimension אחד (by_app / by_media_source / by_site) נטען חלון
+מתגלגל של CUBE_WINDOW_DAYS ימים (עד היום; עם backend מקומי – רק הימים
+שסונכרנו, data_window()) למערכי NumPy צפופים:
+    values[day, hr, key]  – SUM(total_events)
+    present[day, hr, key] – יש שורה ב-rollup (כדי שה-GROUP BY / find bottom
+                            יחזירו בדיוק את ה-keys שה-SQL היה מחזיר)
+ה-keys מקודדים במילון (key → index).
+
+refresh אינקרמנטלי: ימים שכבר נטענו מועתקים כמו שהם, ורק CUBE_RELOAD_DAYS
+הימים האחרונים (היום + אתמול) והימים החדשים נטענים מחדש מה-rollup.
+
+answer(plan) מחזיר pyarrow.Table באותה צורה שה-SQL של compiler.py מחזיר,
+או None – ואז השאילתה רצה כרגיל. None כאשר: אין date_range, התאריכים מחוץ
+לחלון, dimensions / filters שאין cube שמכסה אותם, או שה-cube לא נטען
+(למשל כי הוא חורג מ-CUBE_MAX_BYTES).
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from datetime import date, timedelta
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from AppsFlyerAgent.bq import run_blocking
+from AppsFlyerAgent.execution_backend import get_execution_backend
+from AppsFlyerAgent.flow_manager_agent.utils.dates import today_local
+from AppsFlyerAgent.flow_manager_agent.sub_agents.protected_query_builder_agent.rollups import (
+    DAY_COLUMN,
+    HOUR_COLUMN,
+    METRIC,
+    Rollup,
+    rollup_registry,
+)
+
+logger = logging.getLogger(__name__)
+
+OLAP_CUBE_ENABLED = os.getenv("OLAP_CUBE_ENABLED", "1") != "0"
+CUBE_ROLLUPS = [n.strip() for n in os.getenv("CUBE_ROLLUPS", "by_app,by_media_source,by_site").split(",") if n.strip()]
+CUBE_WINDOW_DAYS = int(os.getenv("CUBE_WINDOW_DAYS", "30"))
+# ימים אחרונים שנטענים מחדש בכל refresh (נתונים מאוחרים / היום החלקי)
+CUBE_RELOAD_DAYS = int(os.getenv("CUBE_RELOAD_DAYS", "2"))
+CUBE_REFRESH_SECONDS = float(os.getenv("CUBE_REFRESH_SECONDS", "900"))
+# תקציב זיכרון לכל ה-cubes יחד; cube שלא נכנס לא נטען (→ BigQuery)
+CUBE_MAX_BYTES = int(os.getenv("CUBE_MAX_BYTES", str(512 * 1024 ** 2)))
+
+HOURS = 24
+
+# ANALYTICS_LIMIT של compiler.py
+ANALYTICS_LIMIT = 100
+
+# הערכה גסה ל-overhead של key במילון (str + entry ב-dict + list)
+_KEY_OVERHEAD_BYTES = 120
+
+
+@dataclass(frozen=True)
+class CubeState:
+    """snapshot בלתי משתנה – refresh בונה חדש ומחליף, קוראים לא צריכים lock."""
+    start: date
+    end: date
+    values: np.ndarray          # int64 [days, 24, keys]
+    present: np.ndarray         # bool  [days, 24, keys]
+    keys: list
+    key_index: dict
+    loaded_at: float
+
+    @property
+    def nbytes(self) -> int:
+        key_bytes = sum(len(str(k)) + _KEY_OVERHEAD_BYTES for k in self.keys)
+        return self.values.nbytes + self.present.nbytes + key_bytes
+
+
+def _state_bytes(days: int, keys: int) -> int:
+    return days * HOURS * keys * (np.dtype(np.int64).itemsize + np.dtype(np.bool_).itemsize)
+
+
+# ============================================================
+# Cube של rollup אחד
+# ============================================================
+class HourlyCube:
+    def __init__(self, rollup: Rollup):
+        if rollup.grain != "hour" or len(rollup.dimensions) != 1:
+            raise ValueError(f"{rollup.name}: cube needs an hourly rollup with one dimension")
+        self.rollup = rollup
+        self.dimension = next(iter(rollup.dimensions))
+        self.state: CubeState | None = None
+        self.disabled_reason: str | None = None
+        self.refreshes = 0
+        self.answered = 0
+
+    # -------------------------------------------------------
+    # Load / incremental refresh
+    # -------------------------------------------------------
+    def load_range(self, old: CubeState | None, today: date,
+                   available: tuple[date, date] | None = None) -> tuple[date, date, date, date]:
+        """
+        (window_start, window_end, load_start, load_end) ל-refresh הבא.
+        available – הימים שה-backend מחזיק (duckdb: LOCAL_SYNC_DAYS); החלון נחתך
+        אליהם, אחרת ימים שלא סונכרנו נטענים כאפסים ו-covers() מקבל אותם.
+        """
+        start, end = today - timedelta(days=CUBE_WINDOW_DAYS - 1), today
+        if available is not None:
+            start, end = max(start, available[0]), min(end, available[1])
+        if old is None or old.end < start or old.start > start:
+            return start, end, start, end
+        keep_end = min(old.end, today - timedelta(days=CUBE_RELOAD_DAYS))
+        load_start = max(start, keep_end + timedelta(days=1))
+        return start, end, load_start, end
+
+    def load_sql(self, load_start: date, load_end: date) -> str:
+        return (
+            f"SELECT {DAY_COLUMN}, {HOUR_COLUMN}, {self.dimension}, SUM({METRIC}) AS {METRIC}\n"
+            f"FROM {self.rollup.table}\n"
+            f"WHERE {DAY_COLUMN} BETWEEN '{load_start}' AND '{load_end}'\n"
+            f"GROUP BY {DAY_COLUMN}, {HOUR_COLUMN}, {self.dimension}"
+        )
+
+    def build(self, old: CubeState | None, table: pa.Table, start: date, end: date,
+              load_start: date, byte_budget: int) -> CubeState | None:
+        """
+        state חדש: הימים [start, load_start) מ-old, [load_start, end] מ-table.
+        None אם ה-state לא נכנס ב-byte_budget.
+        """
+        days = (end - start).days + 1
+
+        keys = list(old.keys) if old else []
+        key_index = dict(old.key_index) if old else {}
+
+        encoded = pc.dictionary_encode(table[self.dimension].combine_chunks(), null_encoding="encode")
+        local_keys = encoded.dictionary.to_pylist()
+        local_to_cube = np.empty(len(local_keys), dtype=np.int64)
+        for i, key in enumerate(local_keys):
+            if key not in key_index:
+                key_index[key] = len(keys)
+                keys.append(key)
+            local_to_cube[i] = key_index[key]
+
+        if _state_bytes(days, len(keys)) > byte_budget:
+            return None
+
+        values = np.zeros((days, HOURS, len(keys)), dtype=np.int64)
+        present = np.zeros((days, HOURS, len(keys)), dtype=np.bool_)
+
+        # ימים שנשמרים מה-state הקודם
+        if old is not None:
+            copy_start = max(start, old.start)
+            copy_end = min(old.end, load_start - timedelta(days=1))
+            if copy_start <= copy_end:
+                src = slice((copy_start - old.start).days, (copy_end - old.start).days + 1)
+                dst = slice((copy_start - start).days, (copy_end - start).days + 1)
+                values[dst, :, :len(old.keys)] = old.values[src]
+                present[dst, :, :len(old.keys)] = old.present[src]
+
+        if table.num_rows:
+            day_idx = (
+                table[DAY_COLUMN].to_numpy().astype("datetime64[D]") - np.datetime64(start, "D")
+            ).astype(np.int64)
+            hour_idx = pc.fill_null(table[HOUR_COLUMN], -1).to_numpy().astype(np.int64)
+            key_idx = local_to_cube[encoded.indices.to_numpy(zero_copy_only=False)]
+            totals = pc.fill_null(table[METRIC], 0).to_numpy().astype(np.int64)
+
+            ok = (day_idx >= 0) & (day_idx < days) & (hour_idx >= 0) & (hour_idx < HOURS)
+            if not ok.all():
+                logger.warning("[CUBE] %s: skipped %d rows outside the window / hour range",
+                               self.rollup.name, int((~ok).sum()))
+            index = (day_idx[ok], hour_idx[ok], key_idx[ok])
+            np.add.at(values, index, totals[ok])
+            present[index] = True
+
+        # keys שיצאו מהחלון לגמרי → מחוץ למילון (הזיכרון לא גדל לאורך זמן)
+        live = present.any(axis=(0, 1))
+        if not live.all():
+            values, present = values[:, :, live], present[:, :, live]
+            keys = [key for key, keep in zip(keys, live) if keep]
+            key_index = {key: i for i, key in enumerate(keys)}
+
+        return CubeState(start, end, values, present, keys, key_index, time.time())
+
+    # -------------------------------------------------------
+    # Query
+    # -------------------------------------------------------
+    def covers(self, dims: list, filters: dict, date_range) -> bool:
+        state = self.state
+        if state is None or not date_range:
+            return False
+        if not self.rollup.covers(dims, filters):
+            return False
+        start, end = (date.fromisoformat(d) for d in date_range)
+        if not (state.start <= start <= end <= state.end):
+            return False
+        # היום החלקי – רק אם ה-snapshot טרי
+        if end >= state.end and time.time() - state.loaded_at > 2 * CUBE_REFRESH_SECONDS:
+            return False
+        return True
+
+    def query(self, intent: str, dims: list, filters: dict, date_range) -> pa.Table | None:
+        state = self.state
+        start, end = (date.fromisoformat(d) for d in date_range)
+        day_slice = slice((start - state.start).days, (end - state.start).days + 1)
+
+        hours = _filter_values(filters.get(HOUR_COLUMN), int)
+        if HOUR_COLUMN in filters and hours is None:
+            return None
+        key_values = _filter_values(filters.get(self.dimension), str)
+        if self.dimension in filters and key_values is None:
+            return None
+
+        hour_idx = np.arange(HOURS) if hours is None else np.array(
+            sorted({h for h in hours if 0 <= h < HOURS}), dtype=np.int64
+        )
+        if key_values is None:
+            key_idx = np.arange(len(state.keys))
+        else:
+            key_idx = np.array(
+                sorted({state.key_index[k] for k in key_values if k in state.key_index}),
+                dtype=np.int64,
+            )
+
+        grid = np.ix_(np.arange(day_slice.start, day_slice.stop), hour_idx, key_idx)
+        values = state.values[grid]
+        present = state.present[grid]
+        keys = [state.keys[i] for i in key_idx]
+        hours_out = hour_idx.tolist()
+
+        if not dims:
+            total = int(values.sum()) if present.any() else None
+            return pa.table({METRIC: pa.array([total], type=pa.int64())})
+
+        # סכימה על ה-axes שלא ב-GROUP BY → groups (hr, key)
+        by_hour = HOUR_COLUMN in dims
+        by_key = self.dimension in dims
+        axes = (0,) + (() if by_hour else (1,)) + (() if by_key else (2,))
+        sums = values.sum(axis=axes)
+        has = present.any(axis=axes)
+
+        if by_hour and by_key:
+            h_pos, k_pos = np.nonzero(has)
+            group = {HOUR_COLUMN: [hours_out[i] for i in h_pos], self.dimension: [keys[i] for i in k_pos]}
+            totals = sums[h_pos, k_pos]
+        elif by_hour:
+            (h_pos,) = np.nonzero(has)
+            group = {HOUR_COLUMN: [hours_out[i] for i in h_pos]}
+            totals = sums[h_pos]
+        else:
+            (k_pos,) = np.nonzero(has)
+            group = {self.dimension: [keys[i] for i in k_pos]}
+            totals = sums[k_pos]
+
+        if intent in ("find top", "find bottom"):
+            if totals.size:
+                target = totals.max() if intent == "find top" else totals.min()
+                chosen = np.nonzero(totals == target)[0]
+            else:
+                chosen = np.array([], dtype=np.int64)
+        else:
+            # ORDER BY total DESC LIMIT ANALYTICS_LIMIT
+            chosen = np.argsort(-totals, kind="stable")[:ANALYTICS_LIMIT]
+
+        columns = {}
+        for dim in dims:
+            column = group[dim]
+            dtype = pa.int64() if dim == HOUR_COLUMN else pa.string()
+            columns[dim] = pa.array([column[i] for i in chosen], type=dtype)
+        columns[METRIC] = pa.array(totals[chosen], type=pa.int64())
+        return pa.table(columns)
+
+    def stats(self) -> dict:
+        state = self.state
+        stats = {
+            "rollup": self.rollup.name,
+            "dimension": self.dimension,
+            "refreshes": self.refreshes,
+            "answered": self.answered,
+            "disabled_reason": self.disabled_reason,
+        }
+        if state is not None:
+            stats.update({
+                "window": [str(state.start), str(state.end)],
+                "keys": len(state.keys),
+                "bytes": state.nbytes,
+                "age_seconds": round(time.time() - state.loaded_at, 1),
+            })
+        return stats
+
+
+def _filter_values(raw, cast):
+    """ערך / רשימת ערכים של filter → list (None = אין filter, או ערך לא תקין)."""
+    if raw is None:
+        return None
+    items = raw if isinstance(raw, (list, tuple)) else [raw]
+    try:
+        return [cast(str(v).strip()) if cast is int else cast(v) for v in items
+                if not isinstance(v, (bool, dict, list))] or None
+    except ValueError:
+        return None
+
+
+# ============================================================
+# Service: כל ה-cubes + refresh ברקע
+# ============================================================
+class CubeService:
+    def __init__(self, rollup_names=CUBE_ROLLUPS, max_bytes: int = CUBE_MAX_BYTES):
+        self.cubes = [HourlyCube(rollup_registry.get(name)) for name in rollup_names]
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._task: asyncio.Task | None = None
+
+    # -------------------------------------------------------
+    def answer(self, plan: dict | None) -> pa.Table | None:
+        """plan של compiler.py → pyarrow.Table, או None (→ BigQuery)."""
+        if not OLAP_CUBE_ENABLED or not plan or plan.get("intent") not in ("analytics", "find top", "find bottom"):
+            return None
+        dims = list(plan.get("dimensions") or [])
+        filters = dict(plan.get("filters") or {})
+        date_range = plan.get("date_range")
+
+        for cube in self.cubes:
+            if cube.covers(dims, filters, date_range):
+                started = time.perf_counter()
+                table = cube.query(plan["intent"], dims, filters, date_range)
+                if table is None:
+                    break
+                self.hits += 1
+                cube.answered += 1
+                logger.info("[CUBE] %s answered %s in %.3f ms (%d rows)", cube.rollup.name,
+                            plan["intent"], (time.perf_counter() - started) * 1000, table.num_rows)
+                return table
+
+        self.misses += 1
+        return None
+
+    # -------------------------------------------------------
+    async def refresh(self):
+        """refresh אינקרמנטלי של כל ה-cubes (אחד אחרי השני)."""
+        today = today_local()
+        backend = get_execution_backend()
+        for cube in self.cubes:
+            old = cube.state
+            try:
+                available = backend.data_window(cube.rollup.table_id)
+                start, end, load_start, load_end = cube.load_range(old, today, available)
+                if end < start:
+                    cube.state = None
+                    cube.disabled_reason = "no data in the execution backend window"
+                    logger.warning("[CUBE] %s: backend holds no days of the cube window - served by SQL",
+                                   cube.rollup.name)
+                    continue
+                table = await backend.run(cube.load_sql(load_start, load_end), intent="olap_cube")
+                budget = self.max_bytes - self._bytes_excluding(cube)
+                state = await run_blocking(cube.build, old, table, start, end, load_start, budget)
+            except Exception:
+                logger.exception("[CUBE] refresh of %s failed - keeping the previous snapshot",
+                                 cube.rollup.name)
+                continue
+
+            if state is None:
+                cube.state = None
+                cube.disabled_reason = "memory budget exceeded"
+                logger.warning("[CUBE] %s does not fit in CUBE_MAX_BYTES=%d - served by BigQuery",
+                               cube.rollup.name, self.max_bytes)
+                continue
+
+            cube.state = state
+            cube.disabled_reason = None
+            cube.refreshes += 1
+            logger.info("[CUBE] %s refreshed %s..%s (%d keys, %d bytes)",
+                        cube.rollup.name, load_start, load_end, len(state.keys), state.nbytes)
+
+    def _bytes_excluding(self, cube: HourlyCube) -> int:
+        return sum(c.state.nbytes for c in self.cubes if c is not cube and c.state is not None)
+
+    async def _refresh_loop(self):
+        while True:
+            await self.refresh()
+            await asyncio.sleep(CUBE_REFRESH_SECONDS)
+
+    def start(self):
+        """מתחיל את לולאת ה-refresh על ה-event loop הנוכחי (startup של FastAPI)."""
+        if not OLAP_CUBE_ENABLED or not self.cubes:
+            return
+        with self._lock:
+            if self._task is None or self._task.done():
+                self._task = asyncio.get_running_loop().create_task(self._refresh_loop())
+
+    async def stop(self):
+        with self._lock:
+            task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    def stats(self) -> dict:
+        return {
+            "enabled": OLAP_CUBE_ENABLED,
+            "hits": self.hits,
+            "misses": self.misses,
+            "bytes": sum(c.state.nbytes for c in self.cubes if c.state is not None),
+            "max_bytes": self.max_bytes,
+            "cubes": [cube.stats() for cube in self.cubes],
+        }
+
+
+cube_service = CubeService()
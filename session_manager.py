@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+from google.adk.sessions.in_memory_session_service import InMemorySessionService
+
+logger = logging.getLogger(__name__)
+
+# גבולות זיכרון / מקביליות (אפשר לדרוס מה-env)
+MAX_EVENTS_PER_SESSION = int(os.getenv("MAX_EVENTS_PER_SESSION", "60"))
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", "500"))
+SESSION_IDLE_TTL_SECONDS = float(os.getenv("SESSION_IDLE_TTL_SECONDS", "1800"))
+MAX_CONCURRENT_RUNS = int(os.getenv("MAX_CONCURRENT_RUNS", "20"))
+
+
+class BoundedInMemorySessionService(InMemorySessionService):
+    """
+    InMemorySessionService שמחזיק רק את N האירועים האחרונים בכל session,
+    כדי שההיסטוריה (והפרומפט של כל turn) לא יגדלו בלי סוף.
+    ה-state של ה-session לא נחתך – רק רשימת ה-events.
+    """
+
+    def __init__(self, max_events_per_session: int = MAX_EVENTS_PER_SESSION):
+        super().__init__()
+        self.max_events_per_session = max_events_per_session
+
+    async def append_event(self, session, event):
+        event = await super().append_event(session, event)
+        if getattr(event, "partial", False):
+            return event
+
+        self._trim(session)
+        stored = (
+            getattr(self, "sessions", {})
+            .get(session.app_name, {})
+            .get(session.user_id, {})
+            .get(session.id)
+        )
+        if stored is not None and stored is not session:
+            self._trim(stored)
+        return event
+
+    def _trim(self, session):
+        overflow = len(session.events) - self.max_events_per_session
+        if overflow > 0:
+            del session.events[:overflow]
+
+
+class SessionManager:
+    """
+    מנהל sessions לכל לקוח:
+
+    - session נפרד לכל (user_id, session_id) – אין יותר state משותף לכולם.
+    - turn() נועל את ה-session (turns של אותו session רצים בתור),
+      אבל sessions שונים רצים במקביל, עד MAX_CONCURRENT_RUNS.
+      קודם ה-lock של ה-session ורק אז slot גלובלי – turn שממתין בתור של
+      ה-session שלו לא תופס slot של לקוחות אחרים.
+    - sessions שלא היו פעילים SESSION_IDLE_TTL_SECONDS נמחקים,
+      ומעל MAX_SESSIONS נמחקים הישנים ביותר (LRU). session עם turn
+      שרץ או ממתין (in-flight) לא נמחק.
+    """
+
+    def __init__(
+        self,
+        session_service: InMemorySessionService,
+        app_name: str,
+        max_sessions: int = MAX_SESSIONS,
+        idle_ttl_seconds: float = SESSION_IDLE_TTL_SECONDS,
+        max_concurrent_runs: int = MAX_CONCURRENT_RUNS,
+    ):
+        self.session_service = session_service
+        self.app_name = app_name
+        self.max_sessions = max_sessions
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self._last_seen: OrderedDict = OrderedDict()
+        self._locks: dict = {}
+        self._inflight: dict = {}   # key -> turns שרצים / ממתינים
+        self._run_slots = asyncio.Semaphore(max_concurrent_runs)
+        self.evicted = 0
+
+    @staticmethod
+    def new_session_id() -> str:
+        return uuid.uuid4().hex
+
+    @asynccontextmanager
+    async def turn(self, user_id: str, session_id: str):
+        """מבטיח שה-session קיים ומריץ turn אחד בתוכו."""
+        key = (user_id, session_id)
+        # נרשם לפני ה-await הראשון → evict() לא יבחר את ה-session הזה
+        self._inflight[key] = self._inflight.get(key, 0) + 1
+        try:
+            lock = self._locks.setdefault(key, asyncio.Lock())
+            async with lock, self._run_slots:
+                await self._ensure_session(user_id, session_id)
+                self._touch(key)
+                try:
+                    yield
+                finally:
+                    self._touch(key)
+        finally:
+            self._inflight[key] -= 1
+            if not self._inflight[key]:
+                del self._inflight[key]
+
+        await self.evict()
+
+    async def evict(self):
+        """מוחק sessions לא פעילים / עודפים (לא נוגע ב-session עם turn in-flight)."""
+        now = time.monotonic()
+        victims = []
+        over = len(self._last_seen) - self.max_sessions
+
+        for key, seen in self._last_seen.items():
+            if key in self._inflight:
+                continue
+            if over > 0 or now - seen > self.idle_ttl_seconds:
+                victims.append(key)
+                over -= 1
+            else:
+                # OrderedDict ממוין לפי שימוש אחרון – מכאן והלאה כולם חדשים יותר
+                break
+
+        evicted = 0
+        for key in victims:
+            # turn שהתחיל בינתיים (בזמן ה-await של מחיקה קודמת) → משאירים
+            if key in self._inflight:
+                continue
+            user_id, session_id = key
+            self._last_seen.pop(key, None)
+            # turn שמגיע בזמן המחיקה ממתין על ה-lock ומקבל session חדש אחריה
+            lock = self._locks.setdefault(key, asyncio.Lock())
+            async with lock:
+                try:
+                    await self.session_service.delete_session(
+                        app_name=self.app_name, user_id=user_id, session_id=session_id
+                    )
+                except Exception:
+                    logger.exception(f"[SESSIONS] Failed to delete session {session_id}")
+            if key not in self._inflight:
+                self._locks.pop(key, None)
+            evicted += 1
+
+        self.evicted += evicted
+        if evicted:
+            logger.info(f"[SESSIONS] Evicted {evicted} sessions")
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self._last_seen),
+            "active_turns": sum(self._inflight.values()),
+            "max_sessions": self.max_sessions,
+            "idle_ttl_seconds": self.idle_ttl_seconds,
+            "evicted": self.evicted,
+        }
+
+    # -------------------------------------------------------
+    async def _ensure_session(self, user_id: str, session_id: str):
+        session = await self.session_service.get_session(
+            app_name=self.app_name, user_id=user_id, session_id=session_id
+        )
+        if not session:
+            await self.session_service.create_session(
+                app_name=self.app_name, user_id=user_id, session_id=session_id
+            )
+
+    def _touch(self, key):
+        self._last_seen[key] = time.monotonic()
+        self._last_seen.move_to_end(key)
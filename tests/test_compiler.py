@@ -0,0 +1,41 @@
+"""
+compile_intent: תאריך לא חוקי ב-date_range → None (fallback ל-LLM builder), לא ValueError.
+"""
+import pytest
+
+from AppsFlyerAgent.flow_manager_agent.sub_agents.protected_query_builder_agent.compiler import compile_intent
+
+
+def _analytics(date_range: dict) -> dict:
+    return {
+        "intent": "analytics",
+        "metric": "total_events",
+        "dimensions": ["media_source"],
+        "filters": {},
+        "date_range": date_range,
+    }
+
+
+def test_valid_date_range_compiles():
+    built = compile_intent(_analytics({"start_date": "2025-10-01", "end_date": "2025-10-07"}))
+
+    assert built["status"] == "ok"
+    assert "event_date BETWEEN '2025-10-01' AND '2025-10-07'" in built["sql"]
+    assert built["plan"]["date_range"] == ["2025-10-01", "2025-10-07"]
+
+
+@pytest.mark.parametrize("date_range", [
+    {"start_date": "2025-13-45", "end_date": "2025-13-45"},
+    {"start_date": "2025-10-01", "end_date": "2025-02-30"},
+    {"start_date": "2025-00-10"},
+])
+def test_invalid_calendar_date_falls_back_to_llm(date_range):
+    assert compile_intent(_analytics(date_range)) is None
+
+
+@pytest.mark.parametrize("intent", ["find top", "find bottom"])
+def test_invalid_calendar_date_in_ranking_falls_back_to_llm(intent):
+    parsed = _analytics({"start_date": "2025-13-45", "end_date": "2025-13-45"})
+    parsed["intent"] = intent
+
+    assert compile_intent(parsed) is None
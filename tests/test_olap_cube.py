@@ -0,0 +1,73 @@
+"""
+OLAP cube מעל DuckDBBackend: החלון של ה-cube נחתך לימים שסונכרנו מקומית,
+ושאלה על ימים מחוץ לחלון הזה לא נענית מה-cube (→ SQL), במקום אפסים.
+"""
+import asyncio
+from datetime import timedelta
+
+import pytest
+
+pytest.importorskip("duckdb")
+pa = pytest.importorskip("pyarrow")
+
+from AppsFlyerAgent import olap_cube
+from AppsFlyerAgent.execution_backend import DuckDBBackend
+from AppsFlyerAgent.flow_manager_agent.utils.dates import today_local
+
+SYNC_DAYS = 7
+
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    backend = DuckDBBackend(data_dir=tmp_path)
+    rollup = olap_cube.rollup_registry.get("by_media_source")
+
+    end = today_local() - timedelta(days=1)
+    start = end - timedelta(days=SYNC_DAYS - 1)
+    days = [start + timedelta(days=n) for n in range(SYNC_DAYS)]
+    table = pa.table({
+        "event_date": pa.array([day for day in days for _ in range(2)], pa.date32()),
+        "hr": pa.array([10, 11] * SYNC_DAYS, pa.int64()),
+        "media_source": ["a", "b"] * SYNC_DAYS,
+        "total_events": pa.array([5, 7] * SYNC_DAYS, pa.int64()),
+    })
+    backend.load_table(rollup.table_id, table, start, end)
+
+    monkeypatch.setattr(olap_cube, "OLAP_CUBE_ENABLED", True)
+    monkeypatch.setattr(olap_cube, "get_execution_backend", lambda: backend)
+    service = olap_cube.CubeService(rollup_names=["by_media_source"])
+    asyncio.run(service.refresh())
+    return service, start, end
+
+
+def _plan(start, end) -> dict:
+    return {
+        "intent": "analytics",
+        "dimensions": ["media_source"],
+        "filters": {},
+        "date_range": [str(start), str(end)],
+    }
+
+
+def test_cube_window_is_limited_to_the_synced_days(service):
+    service, start, end = service
+    state = service.cubes[0].state
+
+    assert (state.start, state.end) == (start, end)
+
+
+def test_days_inside_the_synced_window_are_answered(service):
+    service, start, end = service
+
+    table = service.answer(_plan(start, end))
+
+    assert table is not None
+    totals = dict(zip(table["media_source"].to_pylist(), table["total_events"].to_pylist()))
+    assert totals == {"a": 5 * SYNC_DAYS, "b": 7 * SYNC_DAYS}
+
+
+def test_days_before_the_synced_window_go_to_sql(service):
+    service, start, end = service
+
+    assert service.answer(_plan(start - timedelta(days=10), end)) is None
+    assert service.answer(_plan(start - timedelta(days=20), start - timedelta(days=8))) is None
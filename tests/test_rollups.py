@@ -0,0 +1,112 @@
+"""
+create_rollups / refresh_rollups / route מול DuckDB (execution_backend.DuckDBBackend):
+הסכומים ב-rollup שווים לסכומים ב-raw, ו-route חוזר ל-raw אחרי ה-watermark.
+"""
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+
+pytest.importorskip("duckdb")
+pa = pytest.importorskip("pyarrow")
+
+from AppsFlyerAgent.execution_backend import RAW_TABLE_ID, DuckDBBackend
+from AppsFlyerAgent.flow_manager_agent.sub_agents.protected_query_builder_agent.rollups import (
+    DAY_COLUMN,
+    METRIC,
+    RAW_TABLE,
+    RollupRegistry,
+    create_rollups,
+    refresh_rollups,
+)
+
+START = date(2026, 9, 1)
+DAYS = 5
+WATERMARK = START + timedelta(days=DAYS - 1)
+
+
+def _raw_rows(day: date, seed: int) -> list[dict]:
+    rows = []
+    for hour in range(0, 24, 5):
+        for i, (partner, engagement_type) in enumerate(
+            [("p1", "click"), ("p2", "view"), (None, "click"), ("p1", None)]
+        ):
+            rows.append({
+                "event_time": datetime(day.year, day.month, day.day, hour, tzinfo=timezone.utc),
+                "hr": hour,
+                "partner": partner,
+                "engagement_type": engagement_type,
+                "total_events": seed + hour + i,
+            })
+    return rows
+
+
+def _load_raw(backend: DuckDBBackend, rows: list[dict], end: date):
+    table = pa.Table.from_pylist(rows, schema=pa.schema([
+        ("event_time", pa.timestamp("us", tz="UTC")),
+        ("hr", pa.int64()),
+        ("partner", pa.string()),
+        ("engagement_type", pa.string()),
+        ("total_events", pa.int64()),
+    ]))
+    backend.load_table(RAW_TABLE_ID, table, START, end)
+
+
+def _total(backend: DuckDBBackend, table: str, day_column: str, start: date, end: date) -> int:
+    day = day_column if day_column == DAY_COLUMN else f"DATE({day_column})"
+    sql = f"SELECT SUM({METRIC}) FROM {table} WHERE {day} BETWEEN DATE('{start}') AND DATE('{end}')"
+    return backend.execute(sql).fetchone()[0]
+
+
+@pytest.fixture
+def setup(tmp_path):
+    backend = DuckDBBackend(data_dir=tmp_path)
+    rows = [row for n in range(DAYS) for row in _raw_rows(START + timedelta(days=n), n)]
+    _load_raw(backend, rows, WATERMARK)
+    registry = RollupRegistry()
+    created = create_rollups(backend.execute, registry, partitioned=False, fresh_through=WATERMARK)
+    return backend, registry, rows, created
+
+
+def test_rollup_totals_match_raw(setup):
+    backend, registry, _, created = setup
+    assert created
+
+    for name in created:
+        rollup = registry.get(name)
+        assert registry.fresh_through(rollup) == WATERMARK
+        for n in range(DAYS):
+            day = START + timedelta(days=n)
+            assert _total(backend, rollup.table, DAY_COLUMN, day, day) == \
+                _total(backend, RAW_TABLE, "event_time", day, day)
+
+
+def test_route_uses_rollup_only_up_to_watermark(setup):
+    _, registry, _, _ = setup
+
+    inside = (str(START), str(WATERMARK))
+    past = (str(START), str(WATERMARK + timedelta(days=1)))
+
+    assert registry.route([], [], inside).name == "daily_clicks_total"
+    assert registry.route(["partner"], [], inside).name == "by_partner"
+    assert registry.route([], [], past) is None
+    assert registry.route(["partner"], [], past) is None
+    # בלי date_range – כולל את היום הנוכחי, תמיד אחרי ה-watermark
+    assert registry.route([], []) is None
+
+
+def test_refresh_rollups_advances_watermark_and_matches_raw(setup):
+    backend, registry, rows, created = setup
+
+    # נתונים מאוחרים לאתמול + יום חדש
+    new_day = WATERMARK + timedelta(days=1)
+    rows = rows + _raw_rows(WATERMARK, 100) + _raw_rows(new_day, 7)
+    _load_raw(backend, rows, new_day)
+
+    refreshed = refresh_rollups(backend.execute, registry, through=new_day, days=2)
+    assert refreshed == {name: new_day for name in created}
+
+    for name in created:
+        rollup = registry.get(name)
+        assert _total(backend, rollup.table, DAY_COLUMN, START, new_day) == \
+            _total(backend, RAW_TABLE, "event_time", START, new_day)
+    assert registry.route([], [], (str(START), str(new_day))).name == "daily_clicks_total"
@@ -1,7 +1,7 @@
 import pandas as pd
 import matplotlib.pyplot as plt
 
-from bq import BQClient
+from bq import get_bq_client
 
 
 # השאילתה - בדיוק כמו שכתבת
@@ -23,7 +23,7 @@ ORDER BY
 
 
 def main():
-    client = BQClient()
+    client = get_bq_client()
 
     # מריצים את השאילתה ומקבלים DataFrame
     df = client.execute_query(ALL_MEDIA_SQL, "all_media_by_hour").to_dataframe()